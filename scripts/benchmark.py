@@ -0,0 +1,119 @@
+"""
+Microbenchmarks of the server's hot paths against the code they replaced.
+
+The old implementations are the copies the tests keep to check the new
+ones give the same results, so this has to run from a checkout with tests/.
+
+Usage, from the repository root:
+    python scripts/benchmark.py [name ...]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Register a benchmark. It returns the seconds taken by (the old code, the new code)."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def timed(func, *args):
+    """Call a function, returning (its result, seconds taken)."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+@benchmark
+def framing():
+    """A large read full of small packets, as sent when a client floods or reconnects."""
+    from server.network.framing import PacketFramer
+    from tests.test_framing import _legacy_split
+
+    data = b"CT#Phoenix#Objection!#0#%" * 20000
+    (_, expected), legacy = timed(_legacy_split, "", data)
+    framer = PacketFramer(1024)
+    messages, new = timed(lambda: [str(frame, "utf-8", "ignore") for frame in framer.feed(data)])
+    assert messages == expected
+    return legacy, new
+
+
+@benchmark
+def ms_parser():
+    """Parse every MS protocol layout, most recent first like real traffic."""
+    from server.network.ms_parser import parse_ms
+    from tests.test_ms_parser import _all_protocol_args, _legacy_parse_ms
+
+    messages = list(reversed(_all_protocol_args())) * 2000
+    expected, legacy = timed(lambda: [_legacy_parse_ms(args) for args in messages])
+    parsed, new = timed(lambda: [parse_ms(args) for args in messages])
+    assert len(parsed) == len(expected)
+    return legacy, new
+
+
+@benchmark
+def censor():
+    """An 800-word censor list against IC-sized messages, compiling the list included."""
+    from server.censor import Censor
+    from tests.test_censor import _legacy_scrub, _sample
+
+    whole, partial, texts = _sample(messages=50)
+    expected, legacy = timed(lambda: [_legacy_scrub(text, whole, partial) for text in texts])
+
+    def scrub_all():
+        compiled = Censor(whole, partial)
+        return [compiled.scrub(text) for text in texts]
+
+    scrubbed, new = timed(scrub_all)
+    assert scrubbed == expected
+    return legacy, new
+
+
+@benchmark
+def ipranges():
+    """A large community blocklist checked for every connection."""
+    from server.ipranges import IPRangeBans
+    from tests.test_ipranges import _legacy_match
+
+    lines = [f"{a}.{b}." for a in range(1, 40) for b in range(0, 256, 2)]
+    addresses = [f"{a}.{a * 7 % 256}.3.4" for a in range(1, 256)]
+    expected, legacy = timed(lambda: [_legacy_match(lines, address, "Loopback") for address in addresses])
+    bans = IPRangeBans(lines)
+    matched, new = timed(lambda: [bans.match(address, "Loopback") for address in addresses])
+    assert matched == expected
+    return legacy, new
+
+
+@benchmark
+def music_lookup():
+    """Look up tracks in a 5,000 track list, as every MC packet does. The index is built beforehand, like on load."""
+    from server.music import MusicIndex, find_track
+    from tests.test_music import _generated_list, _legacy_get_song_data
+
+    music_list = _generated_list()
+    names = [f"{c}/track {s}.opus" for c in range(0, 50, 7) for s in range(0, 100, 9)]
+    expected, legacy = timed(lambda: [_legacy_get_song_data(music_list, name) for name in names])
+    index = MusicIndex(music_list)
+    found, new = timed(lambda: [find_track([index], name) for name in names])
+    assert found == expected
+    return legacy, new
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark {name}, pick from: {', '.join(BENCHMARKS)}")
+            return 1
+        legacy, new = BENCHMARKS[name]()
+        print(f"{name}: old {legacy * 1000:.2f}ms, new {new * 1000:.2f}ms ({legacy / new:.1f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
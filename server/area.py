@@ -3,7 +3,8 @@ from server import commands
 from server.evidence import EvidenceList
 from server.exceptions import ClientError, AreaError, ArgumentError, ServerError
 from server.timer import Timer
-from server.constants import MusicEffect, ReportCardReason, derelative, censor
+from server.music import MusicIndex, music_lists, music_versions, pick_from_pools, pick_vote
+from server.constants import MusicEffect, ReportCardReason, derelative
 
 from collections import OrderedDict
 
@@ -13,8 +14,6 @@ import time
 import arrow
 import json
 
-import oyaml as yaml  # ordered yaml
-import os
 import logging
 import traceback
 
@@ -26,9 +25,13 @@ class Area:
 
     def __init__(self, area_manager, name):
         self.clients = set()
+        # Clients in the area that aren't hidden, see Client.update_visibility
+        self.unhidden_count = 0
         self.invite_list = set()
         self.area_manager = area_manager
         self._name = name
+        # Index in the AreaManager's 'areas' list, kept up to date by the AreaManager
+        self._id = -1
 
         # Initialize prefs
         self._background = "default"
@@ -169,7 +172,9 @@ class Area:
         self.jukebox_votes = []
         self.jukebox_prev_char_id = -1
 
-        self.music_list = []
+        self._music_list = []
+        self._music_index = None
+        self.music_version = next(music_versions)
 
         self._owners = set()
         self.afkers = []
@@ -236,10 +241,31 @@ class Area:
             self._name = self._name.replace("<num>", "").replace("<percent>", "")
         self.abbreviation = self.abbreviate()
 
+    @property
+    def abbreviation(self):
+        """Area's abbreviation string."""
+        return self._abbreviation
+
+    @abbreviation.setter
+    def abbreviation(self, value):
+        self._abbreviation = value
+        self.area_manager.invalidate_area_lookup()
+
+    @property
+    def hide_clients(self):
+        """Whether this area's clients are hidden from playercounts."""
+        return self._hide_clients
+
+    @hide_clients.setter
+    def hide_clients(self, value):
+        self._hide_clients = value
+        for client in self.clients:
+            client.update_visibility()
+
     @property
     def id(self):
         """Get area's index in the AreaManager's 'areas' list if present in its areas. Otherwise, return -1."""
-        return self.area_manager.areas.index(self) if self in self.area_manager.areas else -1
+        return self._id
 
     @property
     def server(self):
@@ -417,7 +443,7 @@ class Area:
             if self.music_ref == "":
                 self.clear_music()
         if self.music_ref != "":
-            if os.path.isfile(f"storage/musiclists/read_only/{self.music_ref}.yaml"):
+            if music_lists.isfile(f"storage/musiclists/read_only/{self.music_ref}.yaml"):
                 self.load_music(f"storage/musiclists/read_only/{self.music_ref}.yaml")
             else:
                 self.load_music(f"storage/musiclists/{self.music_ref}.yaml")
@@ -650,6 +676,9 @@ class Area:
     def new_client(self, client):
         """Add a client to the area."""
         self.clients.add(client)
+        self.area_manager.clients.add(client)
+        self.area_manager.hub_manager.clients.add(client)
+        client.update_visibility()
         if client.char_id is not None:
             database.log_area("area.join", client, self)
 
@@ -684,34 +713,32 @@ class Area:
             jd = 0
         client.send_command("JD", jd)
 
-    def update_timers(self, client, running_only=False):
-        """Update the timers for the target client"""
+    def update_timers(self, client, running_only=False, changed_only=False):
+        """
+        Update the timers for the target client
+        :param client: client to send the timers to
+        :param running_only: only send timers that are set
+        :param changed_only: skip timers the client is already in sync with (see Client.timer_in_sync)
+        """
         # this client didn't even pick char yet
         if client.char_id is None:
             return
 
-        # Hub timers
-        timer = client.area.area_manager.timer
-        if timer.set:
-            current_time = timer.static
-            if timer.started:
-                current_time = timer.target - arrow.get()
-            int_time = int(current_time.total_seconds()) * 1000
-            client.send_timer_set_time(0, int_time, timer.started)
-        elif not running_only:
-            client.send_timer_set_time(0, None, False)
-
-        # Area timers
-        for timer_id, timer in enumerate(self.timers):
+        # Hub timers first, then area timers
+        timers = [(0, client.area.area_manager.timer)]
+        timers += [(timer_id + 1, timer) for timer_id, timer in enumerate(self.timers)]
+        for timer_id, timer in timers:
             # Send static time if applicable
             if timer.set:
                 current_time = timer.static
                 if timer.started:
                     current_time = timer.target - arrow.get()
                 int_time = int(current_time.total_seconds()) * 1000
-                client.send_timer_set_time(timer_id + 1, int_time, timer.started)
+                if changed_only and client.timer_in_sync(timer_id, timer, int_time, timer.started):
+                    continue
+                client.send_timer_set_time(timer_id, int_time, timer.started)
             elif not running_only:
-                client.send_timer_set_time(timer_id + 1, None, False)
+                client.send_timer_set_time(timer_id, None, False)
 
     def remove_client(self, client):
         """Remove a disconnected client from the area."""
@@ -730,6 +757,9 @@ class Area:
         self.trigger("leave", client)
         if client in self.clients:
             self.clients.remove(client)
+            self.area_manager.clients.discard(client)
+            self.area_manager.hub_manager.clients.discard(client)
+            client.update_visibility()
         if client in self.afkers:
             self.afkers.remove(client)
             self.server.client_manager.toggle_afk(client)
@@ -849,37 +879,43 @@ class Area:
             raise AreaError("No available characters.")
         return random.choice(tuple(avail_set))
 
-    def send_command(self, cmd, *args):
+    def send_command(self, cmd, *args, cache=None):
         """
         Broadcast an AO-compatible command to all clients in the area.
+        The packet is encoded once per distinct per-client variant.
+        :param cache: encoding cache to share with other recipients of the same broadcast
         """
+        if cache is None:
+            cache = {}
         for c in self.clients:
-            c.send_command(cmd, *args)
+            c.send_command(cmd, *args, cache=cache)
 
     def send_owner_command(self, cmd, *args):
         """
         Send an AO-compatible command to all owners of the area
         that are not currently in the area.
         """
+        cache = {}
         for c in self.owners:
             if c in self.clients:
                 continue
             if c.remote_listen == 3 or (cmd == "CT" and c.remote_listen == 2) or (cmd == "MS" and c.remote_listen == 1):
-                c.send_command(cmd, *args)
+                c.send_command(cmd, *args, cache=cache)
 
     def send_owner_ic(self, bg, cmd, *args):
         """
         Send an IC message to all owners of the area
         that are not currently in the area, with the specified bg.
         """
+        cache = {}
         for c in self.owners:
             if c in self.clients:
                 continue
             if c.remote_listen == 3 or (cmd == "MS" and c.remote_listen == 1):
                 # Make sure the correct listen BG displays
                 if c.area.background != bg:
-                    c.send_command("BN", bg, "", "", 0)
-                c.send_command(cmd, *args)
+                    c.send_command("BN", bg, "", "", 0, cache=cache)
+                c.send_command(cmd, *args, cache=cache)
 
     def send_timer_set_time(self, timer_id=None, new_time=None, start=False):
         """Broadcast a timer to all clients in this area."""
@@ -1127,6 +1163,8 @@ class Area:
             # add all targets of the broadcasted areas as well
             for area in self.broadcast_list:
                 targets = set(list(targets) + list(area.clients))
+        # Recipients getting identical packets share the encoded bytes
+        cache = {}
         for c in targets:
             # Blinded clients don't receive IC messages
             if c.blinded:
@@ -1142,13 +1180,13 @@ class Area:
                     # Send the mesage as OOC.
                     # Woulda been nice if there was a packet to send messages to IC log
                     # without displaying it in the viewport.
-                    c.send_command("CT", f"[pos '{pos}'] {name}", msg)
+                    c.send_command("CT", f"[pos '{pos}'] {name}", msg, cache=cache)
                     continue
 
             # Before we send the message, if our remote_listen is different...
             if c.remote_listen in [1, 3]:
                 # Make sure to reset the BG back to normal since remote_listen IC/ALL clients might be off sync
-                c.send_command("BN", c.area.background, "", c.area.overlay, 0)
+                c.send_command("BN", c.area.background, "", c.area.overlay, 0, cache=cache)
             msg_to_send = msg
             if c.area != self:
                 msg_to_send = "}}}[" + str(self.id) + "] {{{" + msg
@@ -1191,6 +1229,7 @@ class Area:
                 third_offset,
                 third_flip,
                 video,
+                cache=cache,
             )
         if self.recording:
             # See if the testimony is supposed to end here.
@@ -1323,12 +1362,13 @@ class Area:
             statement = self.testimony[idx]
             self.testimony_index = idx
             targets = self.clients
+            cache = {}
             for c in targets:
                 # Blinded clients don't receive IC messages
                 if c.blinded:
                     continue
                 # Ignore those losers with listenpos for testimony
-                c.send_command("MS", *statement)
+                c.send_command("MS", *statement, cache=cache)
         except (ValueError, IndexError):
             raise AreaError("Invalid testimony reference!")
 
@@ -1457,34 +1497,33 @@ class Area:
             return True
         return not self.server.char_emotes[char].validate(preanim, anim, sfx)
 
+    @property
+    def music_list(self):
+        """Area's music list. Replacing it invalidates the hub's join cache."""
+        return self._music_list
+
+    @music_list.setter
+    def music_list(self, value):
+        self._music_list = value
+        self._music_index = None
+        self.music_version = next(music_versions)
+        self.area_manager.invalidate_join_cache()
+
+    @property
+    def music_index(self):
+        """Lookup tables for the area's music list, rebuilt after it's replaced."""
+        if self._music_index is None:
+            self._music_index = MusicIndex(self._music_list)
+        return self._music_index
+
     def clear_music(self):
-        self.music_list.clear()
+        # Replaced rather than cleared, loaded music lists are shared
+        self.music_list = []
         self.music_ref = ""
 
     def load_music(self, path):
-        try:
-            with open(path, "r", encoding="utf-8") as stream:
-                music_list = yaml.safe_load(stream)
-
-            prepath = ""
-            for item in music_list:
-                # deprecated, use 'replace_music' area pref instead
-                # if 'replace' in item:
-                #     self.replace_music = item['replace'] is True
-                if "use_unique_folder" in item and item["use_unique_folder"] is True:
-                    prepath = os.path.splitext(os.path.basename(path))[0] + "/"
-
-                if "category" not in item:
-                    continue
-
-                if "songs" in item:
-                    for song in item["songs"]:
-                        song["name"] = prepath + song["name"]
-            self.music_list = music_list
-        except ValueError:
-            raise
-        except AreaError:
-            raise
+        """Load a music list from storage/musiclists/, shared with anyone else loading it."""
+        self.music_list, self._music_index = music_lists.load(path)
 
     def add_jukebox_vote(self, client, music_name, length=-1, showname=""):
         """
@@ -1526,53 +1565,49 @@ class Area:
         if not silent:
             client.send_ooc("You removed your song from the jukebox.")
 
+    def music_sources(self):
+        """
+        Get whose music lists make up the area's music list, in order: the server, hub and area.
+        Hubs and areas with replace_music set hide the lists before them.
+        """
+        sources = [self.server]
+
+        # Hub music list
+        if self.area_manager.music_ref != "" and len(self.area_manager.music_list) > 0:
+            if self.area_manager.replace_music:
+                sources = [self.area_manager]
+            else:
+                sources = sources + [self.area_manager]
+
+        # Area music list
+        if self.music_ref != "" and self.music_ref != self.area_manager.music_ref and len(self.music_list) > 0:
+            if self.replace_music:
+                sources = [self]
+            else:
+                sources = sources + [self]
+
+        return sources
+
+    def music_indexes(self):
+        """Get the MusicIndex of each layer of the area's music list."""
+        return [source.music_index for source in self.music_sources()]
+
     def get_jukebox_picked(self):
         """Randomly choose a track from the jukebox."""
         if not self.jukebox:
             return
         if len(self.jukebox_votes) == 0:
-            # Server music list
-            song_list = self.server.music_list
-
-            # Hub music list
-            if self.area_manager.music_ref != "" and len(self.area_manager.music_list) > 0:
-                if self.area_manager.replace_music:
-                    song_list = self.area_manager.music_list
-                else:
-                    song_list = song_list + self.area_manager.music_list
-
-            # Area music list
-            if self.music_ref != "" and self.music_ref != self.area_manager.music_ref and len(self.music_list) > 0:
-                if self.replace_music:
-                    song_list = self.music_list
-                else:
-                    song_list = song_list + self.music_list
-
-            songs = []
-            for c in song_list:
-                if "category" in c:
-                    # Either play a completely random category, or play a category the last song was in
-                    if "songs" in c:
-                        if self.music == "" or self.music in [b["name"] for b in c["songs"]]:
-                            for s in c["songs"]:
-                                looping = "length" not in s or s["length"] == -1
-                                if not looping or s["name"] == self.music:
-                                    continue
-                                songs = songs + [s]
-            song = random.choice(songs)
-            return self.JukeboxVote(None, song["name"], song["length"], "Jukebox")
+            # Either play a completely random category, or play a category the last song was in
+            song = pick_from_pools([index.jukebox_pool(self.music) for index in self.music_indexes()])
+            if song is None:
+                return None
+            return self.JukeboxVote(None, song["name"], song.get("length", -1), "Jukebox")
         elif len(self.jukebox_votes) == 1:
             song = self.jukebox_votes[0]
             self.remove_jukebox_vote(song.client, True)
             return song
         else:
-            weighted_votes = []
-            for current_vote in self.jukebox_votes:
-                i = 0
-                while i < current_vote.chance:
-                    weighted_votes.append(current_vote)
-                    i += 1
-            song = random.choice(weighted_votes)
+            song = pick_vote(self.jukebox_votes)
             self.remove_jukebox_vote(song.client, True)
             return song
 
@@ -1777,18 +1812,7 @@ class Area:
         Set the status of the area.
         :param value: status code
         """
-        value = censor(
-            value,
-            self.server.censors["whole"],
-            self.server.censors["replace"],
-            True,
-        )
-        value = censor(
-            value,
-            self.server.censors["partial"],
-            self.server.censors["replace"],
-            False,
-        )
+        value = self.server.censors.scrub(value)
         if value.lower() == "hub":
             raise AreaError("Hub Status is a restricted value.")
         if value.lower() == "lfp":
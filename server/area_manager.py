@@ -1,14 +1,29 @@
 from server.exceptions import AreaError, ServerError
 from server.area import Area
+from server.constants import encode_ao_command
 from server.timer import Timer
+from server.music import MusicIndex, music_lists, music_versions
 from collections import OrderedDict
 
 import oyaml as yaml  # ordered yaml
+import asyncio
 import os
 import logging
 
 logger = logging.getLogger("areamanager")
 
+# ARUP list types, sent as the first argument of the packet
+ARUP_PLAYERS = 0
+ARUP_STATUS = 1
+ARUP_CMS = 2
+ARUP_LOCK = 3
+# What's shown for the hub entry at the top of the area list when there are several hubs
+ARUP_HUB_ENTRIES = {
+    ARUP_STATUS: "HUB",
+    ARUP_CMS: "Double-Click for Hubs",
+    ARUP_LOCK: "",
+}
+
 
 class AreaManager:
     """Holds the list of all areas."""
@@ -17,6 +32,26 @@ class AreaManager:
         self.hub_manager = hub_manager
         self.areas = []
         self.owners = set()
+        # Clients in any of our areas, kept up to date by Area.new_client/remove_client
+        self.clients = set()
+        # Clients that show up in this hub's player count (see Client.update_visibility)
+        self.count = 0
+        # Clients that aren't hidden, whether or not their area hides its playercount
+        self.unhidden_count = 0
+
+        # Index in the HubManager's 'hubs' list, kept up to date by the HubManager
+        self._id = -1
+        # Areas by name and abbreviation, rebuilt on demand (see area_lookup)
+        self._area_lookup = None
+
+        # Pre-encoded packets sent to every client joining the hub, see join_packet
+        self.join_cache = {}
+        self.join_cache_version = 0
+
+        # ARUP lists waiting to be sent to the whole hub, and to specific clients (see queue_arup)
+        self.arup_pending_all = set()
+        self.arup_pending = {}
+        self.arup_handle = None
 
         # prefs
         self._name = name
@@ -43,7 +78,9 @@ class AreaManager:
         self.o_name = self._name
         self.o_abbreviation = self.abbreviation
 
-        self.music_list = []
+        self._music_list = []
+        self._music_index = None
+        self.music_version = next(music_versions)
 
         # Save character information for character select screen ID's in the hub data
         # ex. {"1": {"keys": [1, 2, 3, 5], "fatigue": 100.0, "hunger": 34.0}, "2": {"keys": [4, 6, 8]}}
@@ -81,23 +118,45 @@ class AreaManager:
             self._name = self._name.replace("<num>", "").replace("<percent>", "")
         self.abbreviation = self.abbreviate()
 
+    @property
+    def abbreviation(self):
+        """Hub's abbreviation string."""
+        return self._abbreviation
+
+    @abbreviation.setter
+    def abbreviation(self, value):
+        self._abbreviation = value
+        self.hub_manager.invalidate_hub_lookup()
+
+    @property
+    def music_list(self):
+        """Hub's music list. Replacing it invalidates the join cache."""
+        return self._music_list
+
+    @music_list.setter
+    def music_list(self, value):
+        self._music_list = value
+        self._music_index = None
+        self.music_version = next(music_versions)
+        self.invalidate_join_cache()
+
+    @property
+    def music_index(self):
+        """Lookup tables for the hub's music list, rebuilt after it's replaced."""
+        if self._music_index is None:
+            self._music_index = MusicIndex(self._music_list)
+        return self._music_index
+
     @property
     def id(self):
-        """Get area's index in the HubManager's 'hubs' list."""
-        return self.hub_manager.hubs.index(self)
+        """Get hub's index in the HubManager's 'hubs' list, or -1 if it was removed."""
+        return self._id
 
     @property
     def server(self):
         """Area's server. Accesses HubManager's 'server' property"""
         return self.hub_manager.server
 
-    @property
-    def clients(self):
-        clients = set()
-        for area in self.areas:
-            clients = clients | area.clients
-        return clients
-
     def abbreviate(self):
         """Abbreviate our name."""
         if self.name.lower().startswith("hub"):
@@ -150,7 +209,7 @@ class AreaManager:
                     if hub[entry] == "":
                         self.clear_music()
                     else:
-                        if os.path.isfile(f"storage/musiclists/read_only/{hub[entry]}.yaml"):
+                        if music_lists.isfile(f"storage/musiclists/read_only/{hub[entry]}.yaml"):
                             self.load_music(f"storage/musiclists/read_only/{hub[entry]}.yaml")
                         else:
                             self.load_music(f"storage/musiclists/{hub[entry]}.yaml")
@@ -192,12 +251,33 @@ class AreaManager:
         else:
             self.char_list = self.server.char_list
 
+        self.invalidate_join_cache()
         for client in self.clients:
             self.send_characters(client)
             client.char_select()
 
     def send_characters(self, client):
-        client.send_command("SC", *self.char_list)
+        client.send_raw_bytes(self.join_packet(("SC",), lambda: ("SC", self.char_list)))
+
+    def join_packet(self, key, build):
+        """
+        Get an encoded packet that's the same for everyone joining the hub,
+        encoding it only the first time it's asked for.
+        :param key: hashable key covering everything the packet depends on
+        :param build: called to get the (command, args) to encode if the packet isn't cached
+        :returns: encoded packet
+        """
+        try:
+            return self.join_cache[key]
+        except KeyError:
+            command, args = build()
+            data = self.join_cache[key] = encode_ao_command(command, args)
+            return data
+
+    def invalidate_join_cache(self):
+        """Throw away the cached join packets, for when characters or music change."""
+        self.join_cache.clear()
+        self.join_cache_version += 1
 
     def is_valid_char_id(self, char_id):
         """
@@ -255,36 +335,16 @@ class AreaManager:
         return hub
 
     def clear_music(self):
-        self.music_list.clear()
+        # Replaced rather than cleared, loaded music lists are shared
+        self.music_list = []
         self.music_ref = ""
         self.replace_music = False
 
     def load_music(self, path):
-        try:
-            if not os.path.isfile(path):
-                raise AreaError(f"Hub {self.name} trying to load music list: File path {path} is invalid!")
-            with open(path, "r", encoding="utf-8") as stream:
-                music_list = yaml.safe_load(stream)
-
-            prepath = ""
-            for item in music_list:
-                # deprecated, use 'replace_music' hub pref instead
-                # if 'replace' in item:
-                #    self.replace_music = item['replace'] is True
-                if "use_unique_folder" in item and item["use_unique_folder"] is True:
-                    prepath = os.path.splitext(os.path.basename(path))[0] + "/"
-
-                if "category" not in item:
-                    continue
-
-                if "songs" in item:
-                    for song in item["songs"]:
-                        song["name"] = prepath + song["name"]
-            self.music_list = music_list
-        except ValueError:
-            raise
-        except AreaError:
-            raise
+        """Load a music list from storage/musiclists/, shared with anyone else loading it."""
+        if not music_lists.isfile(path):
+            raise AreaError(f"Hub {self.name} trying to load music list: File path {path} is invalid!")
+        self.music_list, self._music_index = music_lists.load(path)
 
     def load_character_data(self, path="config/character_data.yaml"):
         """
@@ -357,7 +417,9 @@ class AreaManager:
         if self.max_areas != -1 and idx >= self.max_areas:
             raise AreaError(f"Area limit reached! ({self.max_areas})")
         area = Area(self, f"Area {idx}")
+        area._id = idx
         self.areas.append(area)
+        self.invalidate_area_lookup()
         return area
 
     def remove_area(self, area):
@@ -390,6 +452,10 @@ class AreaManager:
                 elif link == str(area.id):
                     del ar.links[link]
         self.areas.remove(area)
+        for i in range(area.id, len(self.areas)):
+            self.areas[i]._id = i
+        area._id = -1
+        self.invalidate_area_lookup()
 
     def swap_area(self, area1, area2, fix_links=True):
         """
@@ -408,6 +474,8 @@ class AreaManager:
 
         # Swap 'em good
         self.areas[a], self.areas[b] = self.areas[b], self.areas[a]
+        self.areas[a]._id, self.areas[b]._id = a, b
+        self.invalidate_area_lookup()
 
         if fix_links:
             # Turn indexes to string
@@ -479,28 +547,47 @@ class AreaManager:
         """Get the default area."""
         return self.areas[0]
 
+    def area_lookup(self):
+        """
+        Get the tables used to find areas by name and abbreviation.
+        When several areas share a key, the first one wins.
+        :returns: tuple of dicts (by name, by lowercase name, by abbreviation)
+        """
+        if self._area_lookup is None:
+            by_name, by_lower_name, by_abbreviation = {}, {}, {}
+            for area in self.areas:
+                by_name.setdefault(area.name, area)
+                by_lower_name.setdefault(area.name.lower(), area)
+                by_abbreviation.setdefault(area.abbreviation, area)
+            self._area_lookup = (by_name, by_lower_name, by_abbreviation)
+        return self._area_lookup
+
+    def invalidate_area_lookup(self):
+        """Rebuild the area lookup tables next time they're needed."""
+        self._area_lookup = None
+
     def get_area_by_name(self, name, case_insensitive=True):
         """Get an area by name."""
-        for area in self.areas:
-            a_name = area.name.lower() if case_insensitive else area.name
-            name = name.lower() if case_insensitive else name
-            if a_name == name:
-                return area
-        raise AreaError("Area not found.")
+        by_name, by_lower_name, _ = self.area_lookup()
+        try:
+            if case_insensitive:
+                return by_lower_name[name.lower()]
+            return by_name[name]
+        except KeyError:
+            raise AreaError("Area not found.")
 
     def get_area_by_id(self, num):
         """Get an area by ID."""
-        for area in self.areas:
-            if area.id == num:
-                return area
+        if isinstance(num, int) and 0 <= num < len(self.areas):
+            return self.areas[num]
         raise AreaError("Area not found.")
 
     def get_area_by_abbreviation(self, abbr):
         """Get an area by abbreviation."""
-        for area in self.areas:
-            if area.abbreviation == abbr:
-                return area
-        raise AreaError("Area not found.")
+        try:
+            return self.area_lookup()[2][abbr]
+        except KeyError:
+            raise AreaError("Area not found.")
 
     def get_areas_by_args(self, args):
         """
@@ -531,8 +618,9 @@ class AreaManager:
         """
         Broadcast an AO-compatible command to all areas and all clients in those areas.
         """
+        cache = {}
         for area in self.areas:
-            area.send_command(cmd, *args)
+            area.send_command(cmd, *args, cache=cache)
 
     def send_remote_command(self, area_list, cmd, *args):
         """
@@ -583,77 +671,123 @@ class AreaManager:
 
     def send_arup_players(self, clients=None):
         """Broadcast ARUP packet containing player counts."""
-        if not self.arup_enabled:
-            return
-        players_list = [0]
-        if len(self.server.hub_manager.hubs) > 1:
-            players_list = [0, -1]
-        if clients is None:
-            clients = self.clients
-        for client in clients:
-            for area in client.local_area_list:
-                playercount = -1
-                if not self.hide_clients and not area.hide_clients:
-                    playercount = len([c for c in area.clients if not c.hidden])
-                players_list.append(playercount)
-                playerhubcount = 0
-                for area in client.local_area_list:
-                    for c in area.clients:
-                        if not self.hide_clients and not area.hide_clients and not c.hidden:
-                            playerhubcount = playerhubcount + 1
-                if len(self.server.hub_manager.hubs) > 1:
-                    players_list[1] = playerhubcount
-            self.server.send_arup(client, players_list)
+        self.queue_arup(ARUP_PLAYERS, clients)
 
     def send_arup_status(self, clients=None):
         """Broadcast ARUP packet containing area statuses."""
-        if not self.arup_enabled:
-            return
-        status_list = [1]
-        if len(self.server.hub_manager.hubs) > 1:
-            status_list = [0, "HUB"]
-        if clients is None:
-            clients = self.clients
-        for client in clients:
-            for area in client.local_area_list:
-                status = area.status
-                if status == "IDLE":
-                    status = ""
-                status_list.append(status)
-            self.server.send_arup(client, status_list)
+        self.queue_arup(ARUP_STATUS, clients)
 
     def send_arup_cms(self, clients=None):
         """Broadcast ARUP packet containing area CMs."""
-        if not self.arup_enabled:
-            return
-        cms_list = [2]
-        if len(self.server.hub_manager.hubs) > 1:
-            cms_list = [2, "Double-Click for Hubs"]
-        if clients is None:
-            clients = self.clients
-        for client in clients:
-            for area in client.local_area_list:
-                cm = ""
-                if len(area.owners) > 0:
-                    cm = area.get_owners()
-                cms_list.append(cm)
-            self.server.send_arup(client, cms_list)
+        self.queue_arup(ARUP_CMS, clients)
 
     def send_arup_lock(self, clients=None):
         """Broadcast ARUP packet containing the lock status of each area."""
+        self.queue_arup(ARUP_LOCK, clients)
+
+    def queue_arup(self, kind, clients=None):
+        """
+        Mark an ARUP list as changed. Everything queued within arup_delay seconds
+        is sent together by flush_arup.
+        :param kind: ARUP list type (ARUP_PLAYERS, ARUP_STATUS, ARUP_CMS or ARUP_LOCK)
+        :param clients: clients that must be sent the list even if it looks unchanged to them,
+        or None to update the whole hub
+
+        """
         if not self.arup_enabled:
             return
-        lock_list = [3]
-        if len(self.server.hub_manager.hubs) > 1:
-            lock_list = [3, ""]
         if clients is None:
-            clients = self.clients
-        for client in clients:
-            for area in client.local_area_list:
-                state = ""
-                if area.locked:
-                    state = "LOCKED"
-                elif area.muted:
-                    state = "SPECTATABLE"
-                lock_list.append(state)
-            self.server.send_arup(client, lock_list)
+            self.arup_pending_all.add(kind)
+        else:
+            for client in clients:
+                self.arup_pending.setdefault(client, set()).add(kind)
+        if self.arup_handle is None:
+            try:
+                self.arup_handle = asyncio.get_running_loop().call_later(
+                    self.server.config["arup_delay"], self.flush_arup
+                )
+            except RuntimeError:
+                # No event loop to wait for, just send it out
+                self.flush_arup()
+
+    def arup_value(self, kind, area):
+        """
+        Get what an ARUP list shows for an area.
+        :param kind: ARUP list type
+        :param area: area to describe
+        """
+        if kind == ARUP_PLAYERS:
+            if self.hide_clients or area.hide_clients:
+                return -1
+            return area.unhidden_count
+        if kind == ARUP_STATUS:
+            return "" if area.status == "IDLE" else area.status
+        if kind == ARUP_CMS:
+            return area.get_owners()
+        if area.locked:
+            return "LOCKED"
+        if area.muted:
+            return "SPECTATABLE"
+        return ""
+
+    def arup_view(self, kind, values, areas):
+        """
+        Build the ARUP arguments for a client that can see the given areas.
+        :param kind: ARUP list type
+        :param values: dict of area -> value already worked out for this kind, filled in as needed
+        :param areas: the client's local area list
+        :returns: tuple of ARUP arguments
+        """
+        view = []
+        for area in areas:
+            if area not in values:
+                values[area] = self.arup_value(kind, area)
+            view.append(values[area])
+        if len(self.server.hub_manager.hubs) > 1:
+            # The first entry of the area list is the hub itself
+            if kind == ARUP_PLAYERS:
+                hub_entry = sum(count for count in view if count > 0)
+            else:
+                hub_entry = ARUP_HUB_ENTRIES[kind]
+            return (kind, hub_entry, *view)
+        return (kind, *view)
+
+    def flush_arup(self):
+        """
+        Send every queued ARUP list. Per-area values are computed once, every distinct
+        view is encoded once, and clients aren't sent a view they already have.
+        """
+        if self.arup_handle is not None:
+            self.arup_handle.cancel()
+            self.arup_handle = None
+        pending_all, self.arup_pending_all = self.arup_pending_all, set()
+        pending, self.arup_pending = self.arup_pending, {}
+        if not self.arup_enabled:
+            return
+
+        values = {}
+        views = {}
+        cache = {}
+        clients = self.clients if pending_all else pending.keys()
+        for client in list(clients):
+            forced = pending.pop(client, ())
+            if client not in self.clients:
+                # Moved to another hub since this was queued
+                continue
+            areas = tuple(client.local_area_list)
+            for kind in pending_all.union(forced):
+                key = (kind, areas)
+                if key not in views:
+                    views[key] = self.arup_view(kind, values.setdefault(kind, {}), areas)
+                view = views[key]
+                if kind not in forced and client.arup_sent.get(kind) == view:
+                    continue
+                if len(view) < 2:
+                    # Nothing to show
+                    continue
+                client.send_command("ARUP", *view, cache=cache)
+                if client.write_paused:
+                    # The packet was dropped, make sure the next update goes through
+                    client.arup_sent.pop(kind, None)
+                else:
+                    client.arup_sent[kind] = view
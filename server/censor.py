@@ -0,0 +1,162 @@
+"""Scrubbing banned words (config/censors.yaml) out of chat messages, shownames and statuses."""
+
+import logging
+import re
+
+logger = logging.getLogger("censor")
+
+# Characters that make a censor entry a regex instead of a plain word
+REGEX_CHARACTERS = frozenset(".^$*+?{}[]\\|()")
+
+
+def is_word_character(char):
+    """Whether a character counts as part of a word for `\\b`."""
+    return char.isalnum() or char == "_"
+
+
+class Censor:
+    """
+    The censor list, compiled once so a string is scrubbed in a single pass.
+
+    Plain words go into an Aho-Corasick automaton, which finds every
+    occurrence of every word while walking the string once, however long the
+    list is. Whole words are only kept if they sit on word boundaries, the
+    same as `\\bword\\b`. Entries using regex syntax, which censors.yaml has
+    always allowed, are joined into one alternation and searched separately.
+
+    Every character covered by a match is replaced with the replace string,
+    so overlapping words are both censored, and a regex entry hides as many
+    characters as it matched (not as many as the regex is long).
+    """
+
+    def __init__(self, whole=None, partial=None, replace="*"):
+        self.replace = replace
+        # The automaton: goto[node] maps a character to the next node, fail[node] is where to
+        # continue from when there's no match, out[node] lists the (length, whole word) entries ending there.
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        self.words = 0
+        regexes = {True: [], False: []}
+        for words, whole_words in ((whole, True), (partial, False)):
+            for word in words or ():
+                word = str(word)
+                if word == "":
+                    continue
+                if REGEX_CHARACTERS.isdisjoint(word):
+                    self.add_word(word.lower(), whole_words)
+                    continue
+                try:
+                    re.compile(word)
+                except re.error as ex:
+                    logger.warning("Ignoring invalid censor %s: %s", word, ex)
+                    continue
+                regexes[whole_words].append(word)
+                self.words += 1
+        self.link()
+
+        branches = []
+        if regexes[True]:
+            whole_regexes = "|".join(regexes[True])
+            branches.append(rf"\b(?:{whole_regexes})\b")
+        branches += regexes[False]
+        self.pattern = None
+        if branches:
+            self.pattern = re.compile("|".join(branches), flags=re.IGNORECASE)
+
+    @classmethod
+    def from_config(cls, censors):
+        """
+        Compile the contents of censors.yaml.
+        :param censors: dict with the whole, partial and replace keys, or None
+        """
+        if not censors:
+            return cls()
+        return cls(censors.get("whole"), censors.get("partial"), censors.get("replace") or "*")
+
+    def add_word(self, word, whole_word):
+        """Add a lowercase word to the automaton's trie. link() has to be called afterwards."""
+        node = 0
+        for char in word:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][char] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            node = next_node
+        self.out[node].append((len(word), whole_word))
+        self.words += 1
+
+    def link(self):
+        """Work out the failure links breadth first, so each node also reports the words ending in its suffixes."""
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+                queue.append(child)
+
+    def find(self, text):
+        """
+        Find every censored span in a string.
+        :param text: string to search
+        :returns: list of (start, end) tuples, unordered and possibly overlapping
+        """
+        spans = []
+        if len(self.goto[0]) > 0:
+            lowered = text.lower()
+            if len(lowered) != len(text):
+                # Some characters lowercase to several, keep those as they are so indexes line up
+                lowered = "".join(char.lower() if len(char.lower()) == 1 else char for char in text)
+            goto = self.goto
+            fail = self.fail
+            out = self.out
+            node = 0
+            for end, char in enumerate(lowered, 1):
+                while node and char not in goto[node]:
+                    node = fail[node]
+                node = goto[node].get(char, 0)
+                for length, whole_word in out[node]:
+                    start = end - length
+                    if whole_word and not (self.is_boundary(text, start) and self.is_boundary(text, end)):
+                        continue
+                    spans.append((start, end))
+        if self.pattern is not None:
+            spans += [match.span() for match in self.pattern.finditer(text) if match.end() > match.start()]
+        return spans
+
+    @staticmethod
+    def is_boundary(text, index):
+        """Whether there's a word boundary (`\\b`) at an index of a string."""
+        before = index > 0 and is_word_character(text[index - 1])
+        after = index < len(text) and is_word_character(text[index])
+        return before != after
+
+    def scrub(self, text):
+        """
+        Replace every censored word in a string.
+        :param text: string to scrub
+        :returns: the scrubbed string
+        """
+        spans = self.find(text)
+        if not spans:
+            return text
+        spans.sort()
+        parts = []
+        position = 0
+        for start, end in spans:
+            if end <= position:
+                continue
+            start = max(start, position)
+            parts.append(text[position:start])
+            parts.append(self.replace * (end - start))
+            position = end
+        parts.append(text[position:])
+        return "".join(parts)
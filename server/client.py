@@ -1,23 +1,25 @@
 import asyncio
 import json
+import logging
 from typing import TYPE_CHECKING
 
 import math
-import os
 import re
 import string
 import time
 
 import arrow
-import oyaml as yaml
 
 from server import database
-from server.constants import contains_URL, derelative, encode_ao_packet
+from server.constants import contains_URL, derelative, encode_ao_command
 from server.exceptions import AreaError, ClientError, ServerError
+from server.music import MusicIndex, find_track, is_category, music_lists, music_versions
 
 if TYPE_CHECKING:
     from tsuserver import TsuServer3
 
+logger = logging.getLogger("client")
+
 
 class Client:
     """Represents a single instance of a user.
@@ -25,6 +27,13 @@ class Client:
     Clients may only belong to a single area.
     """
 
+    # Packets skipped while the client isn't keeping up with what we send.
+    # Later updates replace them anyway (timers, area status, player lists).
+    droppable_commands = frozenset({"TT", "ARUP", "LP"})
+    # How far (in seconds) a running timer may be off from what we last told the client before it's resent.
+    # Timers are sent in whole seconds, so anything under a second is just rounding.
+    timer_drift_tolerance = 1.0
+
     def __init__(
         self,
         server: "TsuServer3",
@@ -34,9 +43,26 @@ class Client:
     ):
         self.is_checked = False
         self.transport = transport
+        # When we last heard CHECK#% from them, the keepalive sweeper drops clients gone quiet for too long
+        self.last_seen = time.monotonic()
+        # ASN ban check still waiting on the GeoIP database, the handshake waits for it
+        self.asn_check = None
+        # Packets waiting to be written out at the end of this loop iteration
+        self.outbound = []
+        self.flush_handle = None
+        # Whether the transport asked us to stop writing (see pause_writing)
+        self.write_paused = False
+        self.slow_client_handle = None
+        self.dropped_packets = 0
         self.hdid = ""
         self.id = user_id
-        self.char_id = None
+        # Area whose player counters include us and whether we count towards its hub's visible count
+        self.counted_in = (None, False)
+        # Last ARUP values sent to us by kind, so unchanged ones aren't sent again
+        self.arup_sent = {}
+        # Timer ID -> (timer, (format, interval), what we told the client about it, when), see timer_in_sync
+        self.timers_sent = {}
+        self._char_id = None
         self.area = server.hub_manager.default_hub().default_area()
         self.server = server
         self.name = ""
@@ -84,25 +110,6 @@ class Client:
         self.casing_jur = False
         self.casing_steno = False
 
-        # flood-guard stuff
-        self.mus_counter = 0
-        self.mus_mute_time = 0
-        self.mus_change_time = [
-            x * self.server.config["music_change_floodguard"]["interval_length"]
-            for x in range(self.server.config["music_change_floodguard"]["times_per_interval"])
-        ]
-        self.wtce_counter = 0
-        self.wtce_mute_time = 0
-        self.wtce_time = [
-            x * self.server.config["wtce_floodguard"]["interval_length"]
-            for x in range(self.server.config["wtce_floodguard"]["times_per_interval"])
-        ]
-        self.ooc_counter = 0
-        self.ooc_mute_time = 0
-        self.ooc_time = [
-            x * self.server.config["ooc_floodguard"]["interval_length"]
-            for x in range(self.server.config["ooc_floodguard"]["times_per_interval"])
-        ]
         # security stuff
         self.clientscon = 0
         self.gm_save_time = 0
@@ -151,9 +158,12 @@ class Client:
         self.local_area_list = []
         # a list of all songs the client can currently see
         self.local_music_list = []
+        # versions of the music lists local_music_list was built from, see music_view()
+        self.local_music_key = None
         # reference to the storage/musiclists/ref.yaml for displaying purposes
         self.music_ref = ""
         # a music list that was loaded manually by the client
+        self._music_index = None
         self.music_list = []
         # whether or not to replace music list with ours
         self.replace_music = False
@@ -198,15 +208,123 @@ class Client:
         Send a raw packet over TCP.
         :param msg: string to send
         """
-        self.transport.write(msg.encode("utf-8"))
+        self.send_raw_bytes(msg.encode("utf-8"))
+
+    def send_raw_bytes(self, data, flush=False):
+        """
+        Send an already encoded packet over TCP.
+        Packets are collected and written out together once per event loop iteration.
+        :param data: bytes to send
+        :param flush: write everything out right away instead of waiting for the loop
+        """
+        self.outbound.append(data)
+        if flush:
+            self.flush()
+        elif self.flush_handle is None:
+            try:
+                self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+            except RuntimeError:
+                # No event loop to wait for (e.g. shutting down), just write it out
+                self.flush()
 
-    def send_command(self, command, *args):
+    def flush(self):
+        """
+        Write every queued packet to the transport in one go. TCP transports
+        send them as one buffer, websocket ones keep them apart as frames.
+        """
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.outbound:
+            return
+        packets = self.outbound
+        self.outbound = []
+        self.transport.writelines(packets)
+        if self.write_paused and self.transport.get_write_buffer_size() > self.server.config["slow_client_max_buffer"]:
+            self.evict_slow_consumer()
+
+    @property
+    def buffered_bytes(self):
+        """Amount of outbound bytes not handed to the OS yet, queued here or in the transport."""
+        size = sum(len(data) for data in self.outbound)
+        get_write_buffer_size = getattr(self.transport, "get_write_buffer_size", None)
+        if get_write_buffer_size is not None:
+            size += get_write_buffer_size()
+        return size
+
+    def pause_writing(self):
+        """
+        The transport's buffer went over the high watermark.
+        Non-essential packets are skipped until it drains, and the client
+        is dropped if it doesn't catch up within slow_client_timeout seconds.
+        """
+        self.write_paused = True
+        timeout = self.server.config["slow_client_timeout"]
+        if timeout and self.slow_client_handle is None:
+            self.slow_client_handle = asyncio.get_running_loop().call_later(timeout, self.evict_slow_consumer)
+
+    def resume_writing(self):
+        """The transport's buffer drained below the low watermark."""
+        self.write_paused = False
+        if self.slow_client_handle is not None:
+            self.slow_client_handle.cancel()
+            self.slow_client_handle = None
+
+    def evict_slow_consumer(self):
+        """Drop a client that can't keep up with what we're sending."""
+        logger.warning(
+            "Disconnecting slow client %s (%s) with %s bytes buffered", self.id, self.ipid, self.buffered_bytes
+        )
+        self.resume_writing()
+        self.drop_output()
+        # Don't wait for the buffer to drain like close() would, that's the whole problem
+        self.transport.abort()
+
+    def drop_output(self):
+        """Throw away queued packets, used once the connection is gone."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.outbound.clear()
+
+    def send_command(self, command, *args, cache=None, flush=False):
         """
         Compose and send an AO-compatible message, with arguments
         delimited by `#` and ending with `#%`.
         :param command: Command name
         :param args: List of arguments
+        :param cache: dict shared by every recipient of a broadcast, so that
+        clients receiving the exact same packet reuse the encoded bytes
+        :param flush: write the packet out right away (see send_raw_bytes)
+        """
+        if self.write_paused and command in self.droppable_commands:
+            self.dropped_packets += 1
+            return
+        for command, args in self.prepare_command(command, args):
+            if cache is None:
+                data = encode_ao_command(command, args)
+            else:
+                # 1 == True == 1.0 but they encode differently, so the types are part of the key
+                key = (command, args, tuple(map(type, args)))
+                try:
+                    data = cache[key]
+                except KeyError:
+                    data = cache[key] = encode_ao_command(command, args)
+                except TypeError:
+                    # Unhashable arguments (such as lists) can't be shared
+                    data = encode_ao_command(command, args)
+            self.send_raw_bytes(data)
+        if flush:
+            self.flush()
+
+    def prepare_command(self, command, args):
+        """
+        Apply the client-specific rewrites to an outgoing command.
+        :param command: Command name
+        :param args: tuple of arguments
+        :returns: list of (command, args) packets to send, empty if the client should not receive it
         """
+        packets = []
         if args:
             # Music packet
             if command == "MC":
@@ -215,7 +333,7 @@ class Client:
                 # ...or we got an invalid channel
                 if channel < 0 or (channel > 0 and not self.has_multilayer_audio):
                     # Ignore the packet, don't send the music
-                    return
+                    return packets
                 if channel in [0, 1]:
                     self.playing_audio[channel] = args[0]
             # IC Message packet
@@ -288,7 +406,7 @@ class Client:
 
                         # Send the result!
                         json_data = json.dumps(pair_jsn_packet)
-                        self.send_command("JSN", json_data)
+                        packets.append(("JSN", (json_data,)))
                     # No pair :(
                     else:
                         pair_jsn_packet = {"packet": "pair", "data": {}}
@@ -297,7 +415,7 @@ class Client:
                         pair_jsn_packet["data"]["offset_left"] = 0
                         pair_jsn_packet["data"]["offset_right"] = 0
                         json_data = json.dumps(pair_jsn_packet)
-                        self.send_command("JSN", json_data)
+                        packets.append(("JSN", (json_data,)))
                     # Now, modify the packet
                     lst = list(args)
                     # make sure to pad the list out
@@ -312,15 +430,8 @@ class Client:
                     lst[21] = 1000  # offset_s
                     args = tuple(lst)
                     # Packet modified!
-        command, *args = encode_ao_packet([command] + list(args))
-        message = f"{command}#"
-        for arg in args:
-            # Evidence packet uses tuples to construct its evidence entries
-            if type(arg) is tuple:
-                # AO2 evidence packet uses & to separate pieces of evidence
-                arg = "&".join(arg)
-            message += f"{arg}#"
-        self.send_raw_message(message + "%")
+        packets.append((command, args))
+        return packets
 
     def send_ooc(self, msg):
         """
@@ -377,6 +488,51 @@ class Client:
                 self.send_command("TI", timer_id, int(not start), new_time)  # Set timer with value and start
                 self.send_command("TF", timer_id, timer.format, new_time)
                 self.send_command("TIN", timer_id, timer.interval)
+        self.timers_sent[timer_id] = (
+            timer,
+            (timer.format, timer.interval),
+            self.timer_state(new_time, start),
+            time.monotonic(),
+        )
+
+    @staticmethod
+    def timer_state(new_time, start):
+        """
+        What a client should be showing for a timer after being sent it.
+        :param new_time: time in milliseconds, or None if the timer is hidden
+        :param start: whether the timer is running
+        :returns: None if hidden, (True, expiry in monotonic seconds) if running, (False, new_time) if paused
+        """
+        if new_time is None:
+            return None
+        if start:
+            return (True, time.monotonic() + new_time / 1000)
+        return (False, new_time)
+
+    def timer_in_sync(self, timer_id, timer, new_time, start):
+        """
+        Check whether the client's copy of a timer still matches ours, so the
+        keepalive doesn't have to resend it. Running timers are resent anyway
+        every timer_resync_interval seconds to correct the client's own clock.
+        :param timer_id: timer ID
+        :param timer: the Timer object
+        :param new_time: time in milliseconds we'd send, or None if hidden
+        :param start: whether the timer is running
+        """
+        sent = self.timers_sent.get(timer_id)
+        if sent is None or sent[0] is not timer:
+            return False
+        _, sent_settings, sent_state, sent_at = sent
+        if sent_settings != (timer.format, timer.interval):
+            return False
+        state = self.timer_state(new_time, start)
+        if state is None or not state[0]:
+            return state == sent_state
+        if sent_state is None or not sent_state[0]:
+            return False
+        if time.monotonic() - sent_at >= self.server.config["timer_resync_interval"]:
+            return False
+        return abs(state[1] - sent_state[1]) < self.timer_drift_tolerance
 
     def send_timer_set_interval(self, timer_id, timer):
         if timer.started:
@@ -420,6 +576,8 @@ class Client:
 
     def disconnect(self):
         """Disconnect the client gracefully."""
+        # Make sure anything we told them on the way out (e.g. a ban message) arrives
+        self.flush()
         self.transport.close()
 
     def change_character(self, char_id, force=False):
@@ -513,22 +671,7 @@ class Client:
         if len(players) <= 1:
             return 0
 
-        if self.mus_mute_time:
-            if time.time() - self.mus_mute_time < self.server.config["music_change_floodguard"]["mute_length"]:
-                return self.server.config["music_change_floodguard"]["mute_length"] - (time.time() - self.mus_mute_time)
-            else:
-                self.mus_mute_time = 0
-        times_per_interval = self.server.config["music_change_floodguard"]["times_per_interval"]
-        interval_length = self.server.config["music_change_floodguard"]["interval_length"]
-        if (
-            time.time() - self.mus_change_time[(self.mus_counter - times_per_interval + 1) % times_per_interval]
-            < interval_length
-        ):
-            self.mus_mute_time = time.time()
-            return self.server.config["music_change_floodguard"]["mute_length"]
-        self.mus_counter = (self.mus_counter + 1) % times_per_interval
-        self.mus_change_time[self.mus_counter] = time.time()
-        return 0
+        return self.server.client_manager.rate_limiter.check(self.ipid, "music")
 
     def change_music(self, song, cid, showname="", effects=0, loop=True):
         if self.is_muted:  # Checks to see if the client has been muted by a mod
@@ -543,15 +686,12 @@ class Client:
         # Decode AO packet
         song = song.replace("<num>", "#").replace("<percent>", "%").replace("<dollar>", "$").replace("<and>", "&")
         try:
-            if (
-                song == "~stop.mp3"
-                or song.strip() == ""
-                or self.server.get_song_is_category(self.construct_music_list(), song)
-            ):
+            music_indexes = self.music_indexes()
+            if song == "~stop.mp3" or song.strip() == "" or is_category(music_indexes, song):
                 name, length = "~stop.mp3", 0
             else:
                 try:
-                    name, length = self.server.get_song_data(self.construct_music_list(), song)
+                    name, length = find_track(music_indexes, song)
                 except ServerError:
                     if self.is_mod or self in self.area.owners:
                         name = song
@@ -687,22 +827,7 @@ class Client:
         """
         if self.is_mod or self in self.area.owners:
             return 0
-        if self.wtce_mute_time:
-            if time.time() - self.wtce_mute_time < self.server.config["wtce_floodguard"]["mute_length"]:
-                return self.server.config["wtce_floodguard"]["mute_length"] - (time.time() - self.wtce_mute_time)
-            else:
-                self.wtce_mute_time = 0
-        times_per_interval = self.server.config["wtce_floodguard"]["times_per_interval"]
-        interval_length = self.server.config["wtce_floodguard"]["interval_length"]
-        if (
-            time.time() - self.wtce_time[(self.wtce_counter - times_per_interval + 1) % times_per_interval]
-            < interval_length
-        ):
-            self.wtce_mute_time = time.time()
-            return self.server.config["music_change_floodguard"]["mute_length"]
-        self.wtce_counter = (self.wtce_counter + 1) % times_per_interval
-        self.wtce_time[self.wtce_counter] = time.time()
-        return 0
+        return self.server.client_manager.rate_limiter.check(self.ipid, "wtce")
 
     def ooc_mute(self):
         """
@@ -711,22 +836,7 @@ class Client:
         """
         if self.is_mod or self in self.area.owners:
             return 0
-        if self.ooc_mute_time:
-            if time.time() - self.ooc_mute_time < self.server.config["ooc_floodguard"]["mute_length"]:
-                return self.server.config["ooc_floodguard"]["mute_length"] - (time.time() - self.ooc_mute_time)
-            else:
-                self.ooc_mute_time = 0
-        times_per_interval = self.server.config["ooc_floodguard"]["times_per_interval"]
-        interval_length = self.server.config["ooc_floodguard"]["interval_length"]
-        if (
-            time.time() - self.ooc_time[(self.ooc_counter - times_per_interval + 1) % times_per_interval]
-            < interval_length
-        ):
-            self.ooc_mute_time = time.time()
-            return self.server.config["music_change_floodguard"]["mute_length"]
-        self.ooc_counter = (self.ooc_counter + 1) % times_per_interval
-        self.ooc_time[self.ooc_counter] = time.time()
-        return 0
+        return self.server.client_manager.rate_limiter.check(self.ipid, "ooc")
 
     def reload_character(self):
         """Reload the state of the current character."""
@@ -737,56 +847,37 @@ class Client:
 
     def clear_music(self):
         self.music_ref = ""
-        self.music_list.clear()
+        # Replaced rather than cleared, loaded music lists are shared
+        self.music_list = []
 
     def load_music(self, path):
-        """Load a music list from a path. Use it for the local music list and reload it."""
-        # TODO: Move the musiclist parsing function to tsuserver3.py or something
-        try:
-            with open(path, "r", encoding="utf-8") as stream:
-                music_list = yaml.safe_load(stream)
+        """Load a music list from a path, shared with anyone else loading it. Use it for the local music list."""
+        self.music_list, self._music_index = music_lists.load(path)
 
-            prepath = ""
-            for item in music_list:
-                if "use_unique_folder" in item and item["use_unique_folder"] is True:
-                    prepath = os.path.splitext(os.path.basename(path))[0] + "/"
+    @property
+    def music_list(self):
+        """Music list loaded by the client themselves."""
+        return self._music_list
 
-                if "category" not in item:
-                    continue
+    @music_list.setter
+    def music_list(self, value):
+        self._music_list = value
+        self._music_index = None
+        self.music_version = next(music_versions)
 
-                for song in item["songs"]:
-                    song["name"] = prepath + song["name"]
-            self.music_list = music_list
-        except ValueError:
-            raise
-        except AreaError:
-            raise
+    @property
+    def music_index(self):
+        """Lookup tables for the client's own music list, rebuilt after it's replaced."""
+        if self._music_index is None:
+            self._music_index = MusicIndex(self._music_list)
+        return self._music_index
 
-    def construct_music_list(self):
+    def music_sources(self):
         """
-        Obtain the most relevant music list for the client.
-        :param client_music: when True, include the client's music in the equation.
+        Get whose music lists make up the client's music list, in order:
+        the server, hub, area and the client themselves (see Area.music_sources).
         """
-        # Server music list
-        song_list = self.server.music_list
-
-        # Hub music list
-        if self.area.area_manager.music_ref != "" and len(self.area.area_manager.music_list) > 0:
-            if self.area.area_manager.replace_music:
-                song_list = self.area.area_manager.music_list
-            else:
-                song_list = song_list + self.area.area_manager.music_list
-
-        # Area music list
-        if (
-            self.area.music_ref != ""
-            and self.area.music_ref != self.area.area_manager.music_ref
-            and len(self.area.music_list) > 0
-        ):
-            if self.area.replace_music:
-                song_list = self.area.music_list
-            else:
-                song_list = song_list + self.area.music_list
+        sources = self.area.music_sources()
 
         # Client music list
         if (
@@ -797,19 +888,37 @@ class Client:
             and len(self.music_list) > 0
         ):
             if self.replace_music:
-                song_list = self.music_list
+                sources = [self]
             else:
-                song_list = song_list + self.music_list
+                sources = sources + [self]
+
+        return sources
+
+    def music_indexes(self):
+        """Get the MusicIndex of each layer of the client's music list."""
+        return [source.music_index for source in self.music_sources()]
+
+    def music_view(self):
+        """Get the client's music list layered together, shared with clients seeing the same lists."""
+        return self.server.music_views.get(self.music_sources())
 
-        return song_list
+    def construct_music_list(self):
+        """
+        Obtain the most relevant music list for the client.
+        """
+        return self.music_view().music_list
 
     def refresh_music(self, reload=False):
         """
-        Rebuild the client's music list, updating the local music list if there was a change.
+        Rebuild the client's music list, sending it if any of the lists it's made of changed since last time.
+        :param reload: send it even if nothing changed
         """
-        song_list = self.construct_music_list()
-        if self.local_music_list != song_list or reload:
-            self.reload_music_list(song_list)
+        view = self.music_view()
+        if self.local_music_key != view.key or reload:
+            self.local_music_list = view.music_list
+            self.local_music_key = view.key
+            # Everyone with the same view gets the same encoded FM packet
+            self.send_raw_bytes(view.packet)
 
     def reload_music_list(self, music=[]):
         """
@@ -823,6 +932,7 @@ class Client:
             song_list = self.server.music_list
 
         self.local_music_list = music
+        self.local_music_key = None
         song_list = self.server.build_music_list(song_list)
         # KEEP THE ASTERISK
         self.send_command("FM", *song_list)
@@ -848,6 +958,8 @@ class Client:
                 area_list.append(a)
 
         self.local_area_list = areas
+        # The client rebuilds its area list, so it has to be sent every ARUP list again
+        self.arup_sent.clear()
         # If we're currently viewing hub list, just update our local area list
         if self.viewing_hub_list:
             return
@@ -903,21 +1015,7 @@ class Client:
 
         self.area.area_manager.send_arup_players()
 
-        for hub in self.server.hub_manager.hubs:
-            count = 0
-            for c in hub.clients:
-                if not c.area.hide_clients and not c.hidden:
-                    count = count + 1
-            hub.count = count
-        for c in self.server.client_manager.clients:
-            if c.viewing_hub_list:
-                c.send_command(
-                    "FA",
-                    *[
-                        "🌐 Hubs 🌐\n Double-Click me to see Areas\n  _______",
-                        *[f"[{hub.id}] {hub.name} (users: {hub.count})" for hub in self.server.hub_manager.hubs],
-                    ],
-                )
+        self.server.hub_manager.broadcast_hub_list()
 
         # Update everyone's available characters list
         # Commented out due to potentially causing clientside lag...
@@ -1616,7 +1714,7 @@ class Client:
                 msg += " ◽ "
             else:
                 msg += " ◾ "
-            msg += f"[{hub.id}] {hub.name} (users: {len([c for c in hub.clients if not c.hidden])}) GM(s): {owner}"
+            msg += f"[{hub.id}] {hub.name} (users: {hub.unhidden_count}) GM(s): {owner}"
         self.send_ooc(msg)
 
     def send_done(self):
@@ -1804,6 +1902,43 @@ class Client:
         """Set the character's description character data."""
         self.area.area_manager.set_character_data(self.char_id, "desc", value)
 
+    @property
+    def char_id(self):
+        """Get the character ID, -1 when spectating and None before picking one."""
+        return self._char_id
+
+    @char_id.setter
+    def char_id(self, value):
+        """Set the character ID, keeping the spectator and player counters up to date."""
+        if (self._char_id == -1) != (value == -1) and self in self.server.client_manager.clients:
+            self.server.client_manager.spectator_count += 1 if value == -1 else -1
+        self._char_id = value
+        self.update_visibility()
+
+    def update_visibility(self):
+        """
+        Move ourselves between area and hub player counters after anything that decides whether
+        we're counted changed: our area, our hidden state or the area hiding its clients.
+        """
+        counted = None
+        visible = False
+        area = self.area
+        if area is not None and self in area.clients and not self.hidden:
+            counted = area
+            visible = not area.hide_clients
+        if (counted, visible) == self.counted_in:
+            return
+        old_area, old_visible = self.counted_in
+        if old_area is not None:
+            old_area.unhidden_count -= 1
+            old_area.area_manager.unhidden_count -= 1
+            old_area.area_manager.count -= old_visible
+        if counted is not None:
+            counted.unhidden_count += 1
+            counted.area_manager.unhidden_count += 1
+            counted.area_manager.count += visible
+        self.counted_in = (counted, visible)
+
     @property
     def hidden(self):
         """Return if the character is hidden or not. Always True if char_id is -1 (spectator)"""
@@ -1866,6 +2001,7 @@ class Client:
                     self.last_move_time = round(time.time() * 1000.0)
 
         self._hidden = tog
+        self.update_visibility()
         self.send_ooc(f"You are {msg} from /getarea and playercounts.")
         self.area.area_manager.send_arup_players()
         if not self.sneaking:
@@ -1,4 +1,6 @@
 import asyncio
+import logging
+import time
 from heapq import heappop, heappush
 from typing import Any, Dict, Iterable, List, Optional, Set, Union, TYPE_CHECKING
 
@@ -6,20 +8,43 @@ from server import database
 from server.client import Client
 from server.constants import TargetType
 from server.exceptions import ClientError
+from server.ratelimit import RateLimiter
 
 if TYPE_CHECKING:
     from tsuserver import TsuServer3
 
+logger = logging.getLogger("client_manager")
+
+# How often (in seconds) the keepalive sweeper looks for clients that stopped sending CHECK#%
+KEEPALIVE_SWEEP_INTERVAL = 5
+
 
 class ClientManager:
     """Holds the list of all clients currently connected to the server."""
 
     def __init__(self, server: "TsuServer3") -> None:
         self.clients: Set[Client] = set()
+        # How many of our clients are spectating (char_id -1), kept up to date by Client.char_id
+        self.spectator_count: int = 0
         self.server = server
         self.cur_id: List[int] = [i for i in range(self.server.config["playerlimit"])]
         # Mapping of ipid -> spam_type -> delay seconds
         self.delays: Dict[str, Dict[str, float]] = {}
+        # Floodguards and packet limits, shared by every client of an IPID
+        self.rate_limiter = RateLimiter()
+        self.load_rate_limits()
+
+    def load_rate_limits(self) -> None:
+        """(Re)load the floodguards and packet limits from the config."""
+        limits = {
+            "music": self.server.config["music_change_floodguard"],
+            "wtce": self.server.config["wtce_floodguard"],
+            "ooc": self.server.config["ooc_floodguard"],
+        }
+        # Packet limits are checked against the raw packet, so they go by the command as bytes
+        for command, limit in self.server.config["packet_floodguard"].items():
+            limits[command.encode()] = limit
+        self.rate_limiter.configure(limits)
 
     def set_spam_delay(self, ipid: int, spam_type: str, value: float) -> None:
         if str(ipid) not in self.delays:
@@ -33,6 +58,31 @@ class ClientManager:
             return 0
         return self.delays[str(ipid)][spam_type]
 
+    def disconnect_stale(self, timeout: float) -> List[Client]:
+        """
+        Disconnect every client that hasn't sent CHECK#% in a while.
+        Their connections are aborted, there's no point flushing to a dead peer,
+        and clients already on their way out are left alone.
+        :param timeout: seconds of silence after which a client is considered dead
+        :returns: the disconnected clients
+        """
+        deadline = time.monotonic() - timeout
+        stale = [c for c in self.clients if c.last_seen < deadline and not c.transport.is_closing()]
+        for c in stale:
+            logger.debug("%s timed out.", c.ipid)
+            c.transport.abort()
+        return stale
+
+    async def keepalive_sweeper(self) -> None:
+        """
+        Periodically drop clients that went silent for longer than the configured timeout,
+        and forget rate limits nobody is close to hitting.
+        """
+        while True:
+            await asyncio.sleep(KEEPALIVE_SWEEP_INTERVAL)
+            self.disconnect_stale(self.server.config["timeout"])
+            self.rate_limiter.prune()
+
     def new_client_preauth(self, client: Client) -> bool:
         maxclients = self.server.config["multiclient_limit"]
         for c in self.server.client_manager.clients:
@@ -85,6 +135,8 @@ class ClientManager:
             if c.following == client:
                 c.unfollow()
         self.clients.remove(client)
+        if client.char_id == -1:
+            self.spectator_count -= 1
 
         # TODO: Maybe take into account than sending the "CU" packet can reveal your cover.
         # So you could simply treat the hidden client as if they didn't declare their char_url.
@@ -95,21 +147,7 @@ class ClientManager:
             clients = (c for c in client.area.clients if c.id != client.id)
             for c in clients:
                 c.remove_user_link(client.char_name)
-        for hub in self.server.hub_manager.hubs:
-            count = 0
-            for c in hub.clients:
-                if not c.area.hide_clients and not c.hidden:
-                    count = count + 1
-            hub.count = count
-        for c in self.server.client_manager.clients:
-            if c.viewing_hub_list:
-                c.send_command(
-                    "FA",
-                    *[
-                        "🌐 Hubs 🌐\n Double-Click me to see Areas\n  _______",
-                        *[f"[{hub.id}] {hub.name} (users: {hub.count})" for hub in self.server.hub_manager.hubs],
-                    ],
-                )
+        self.server.hub_manager.broadcast_hub_list()
 
     def get_targets(
         self,
@@ -33,6 +33,7 @@ __all__ = [
     "ooc_cmd_restart",
     "ooc_cmd_myid",
     "ooc_cmd_multiclients",
+    "ooc_cmd_netstats",
 ]
 
 
@@ -538,3 +539,33 @@ def ooc_cmd_multiclients(client, arg):
             info += f": {c.name}"
     info += f"\nMatched {len(found_clients)} online clients."
     client.send_ooc(info)
+
+
+@mod_only()
+def ooc_cmd_netstats(client, arg):
+    """
+    Show how much outgoing data is waiting to be sent, the clients that are furthest behind,
+    how many log events are waiting to be written and how many actions were rate limited.
+    Usage: /netstats
+    """
+    if len(arg) != 0:
+        raise ArgumentError("This command doesn't take any arguments")
+    clients = sorted(client.server.client_manager.clients, key=lambda c: c.buffered_bytes, reverse=True)
+    paused = [c for c in clients if c.write_paused]
+    info = "Outbound network stats:"
+    info += f"\nBuffered: {sum(c.buffered_bytes for c in clients)} bytes across {len(clients)} clients"
+    info += f"\nPaused clients: {len(paused)}"
+    info += f"\nSkipped packets: {sum(c.dropped_packets for c in clients)}"
+    info += f"\nEvent log: {database.events.depth} queued, {database.events.dropped} dropped"
+    rate_limiter = client.server.client_manager.rate_limiter
+    info += f"\nRate limits: {len(rate_limiter.buckets)} active, {rate_limiter.rejected} rejected"
+    resolver = client.server.asn_resolver
+    if resolver is not None:
+        info += f"\nGeoIP cache: {len(resolver.cache)} entries, {resolver.hits} hits, {resolver.misses} misses"
+    for c in clients[:5]:
+        if c.buffered_bytes <= 0:
+            break
+        info += f"\n[{c.id}] {c.showname} ({c.ipid}): {c.buffered_bytes} bytes"
+        if c.write_paused:
+            info += " (paused)"
+    client.send_ooc(info)
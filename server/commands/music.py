@@ -1,3 +1,4 @@
+import copy
 import random
 import shlex
 import os
@@ -6,6 +7,7 @@ import yaml
 from server import database
 from server.constants import TargetType, derelative
 from server.exceptions import ClientError, ArgumentError, AreaError
+from server.music import music_lists
 
 from . import mod_only
 
@@ -277,7 +279,7 @@ def ooc_cmd_musiclist(client, arg):
             client.clear_music()
             client.send_ooc("Clearing local musiclist.")
         else:
-            if os.path.isfile(f"storage/musiclists/read_only/{arg}.yaml"):
+            if music_lists.isfile(f"storage/musiclists/read_only/{arg}.yaml"):
                 client.load_music(f"storage/musiclists/read_only/{arg}.yaml")
             else:
                 client.load_music(f"storage/musiclists/{arg}.yaml")
@@ -303,7 +305,7 @@ def ooc_cmd_area_musiclist(client, arg):
             client.area.clear_music()
             client.send_ooc("Clearing area musiclist.")
         else:
-            if os.path.isfile(f"storage/musiclists/read_only/{arg}.yaml"):
+            if music_lists.isfile(f"storage/musiclists/read_only/{arg}.yaml"):
                 client.area.load_music(f"storage/musiclists/read_only/{arg}.yaml")
             else:
                 client.area.load_music(f"storage/musiclists/{arg}.yaml")
@@ -329,7 +331,7 @@ def ooc_cmd_hub_musiclist(client, arg):
             client.area.area_manager.clear_music()
             client.send_ooc("Clearing hub musiclist.")
         else:
-            if os.path.isfile(f"storage/musiclists/read_only/{arg}.yaml"):
+            if music_lists.isfile(f"storage/musiclists/read_only/{arg}.yaml"):
                 client.area.area_manager.load_music(f"storage/musiclists/read_only/{arg}.yaml")
             else:
                 client.area.area_manager.load_music(f"storage/musiclists/{arg}.yaml")
@@ -446,21 +448,22 @@ def ooc_cmd_musiclist_remove(client, arg):
         )
         return
 
+    # Edit a copy, loaded music lists are shared by everyone who loaded them
     if args[0] == "local":
         targets = [client]
-        musiclist = client.music_list
+        musiclist = copy.deepcopy(client.music_list)
     elif args[0] == "area":
         if client not in client.area.owners and client not in client.area.area_manager.owners and not client.is_mod:
             client.send_ooc("You should be at least cm to add a song in a musiclist!")
             return
         targets = client.area.clients
-        musiclist = client.area.music_list
+        musiclist = copy.deepcopy(client.area.music_list)
     else:
         if client not in client.area.area_manager.owners and not client.is_mod:
             client.send_ooc("You should be at least gm to add a song in a musiclist!")
             return
         targets = client.area.area_manager.clients
-        musiclist = client.area.area_manager.music_list
+        musiclist = copy.deepcopy(client.area.area_manager.music_list)
 
     if musiclist == []:
         client.send_ooc("You cannot remove a song, if there aren't songs in the musiclist.")
@@ -526,21 +529,22 @@ def ooc_cmd_musiclist_add(client, arg):
         )
         return
 
+    # Edit a copy, loaded music lists are shared by everyone who loaded them
     if args[0] == "local":
         targets = [client]
-        musiclist = client.music_list
+        musiclist = copy.deepcopy(client.music_list)
     elif args[0] == "area":
         if client not in client.area.owners and client not in client.area.area_manager.owners and not client.is_mod:
             client.send_ooc("You should be at least cm to add a song in a musiclist!")
             return
         targets = client.area.clients
-        musiclist = client.area.music_list
+        musiclist = copy.deepcopy(client.area.music_list)
     else:
         if client not in client.area.area_manager.owners and not client.is_mod:
             client.send_ooc("You should be at least gm to add a song in a musiclist!")
             return
         targets = client.area.area_manager.clients
-        musiclist = client.area.area_manager.music_list
+        musiclist = copy.deepcopy(client.area.area_manager.music_list)
 
     if musiclist == []:
         musiclist.append({})
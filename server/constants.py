@@ -1,7 +1,10 @@
+import functools
 import re
 from enum import Enum
 from enum import IntFlag
 
+from server.censor import Censor
+
 
 class TargetType(Enum):
     # possible keys: ip, OOC, id, cname, ipid, hdid, afk
@@ -29,6 +32,18 @@ class ReportCardReason(IntFlag):
     NoPlayerList = 4
 
 
+@functools.lru_cache(maxsize=8)
+def zalgo_pattern(tolerance):
+    """Compile the dezalgo regex for a tolerance, once."""
+    return re.compile(
+        "([\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f"
+        + "\u115f\u1160\u3164]"
+        + "{"
+        + re.escape(str(tolerance))
+        + ",})"
+    )
+
+
 def dezalgo(input, tolerance=3):
     """
     Turns any string into a de-zalgo'd version, with a tolerance to allow for normal diacritic use.
@@ -44,34 +59,21 @@ def dezalgo(input, tolerance=3):
     U+3164          - HANGUL FILLER
     """
 
-    filtered = re.sub(
-        "([\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f"
-        + "\u115f\u1160\u3164]"
-        + "{"
-        + re.escape(str(tolerance))
-        + ",})",
-        "",
-        input,
-    )
-    return filtered
+    return zalgo_pattern(tolerance).sub("", input)
 
 
 def censor(text, censor_list=[], replace="*", whole_words=True):
     """
     Checks if the string contains any of the passed restricted words and replaces them with the replace char.
     Returns a parsed string.
+    Compiles the list on every call, keep a server.censor.Censor around instead when scrubbing more than once.
     :param censor_list: list of swear words to replace
     :param replace: what to replace every letter of the word with
     :param whole_word: if true, we'll only match full words instead of partial matches
     """
-    if censor_list is None or len(censor_list) <= 0:
-        return text
-    regex = r"%s"
     if whole_words:
-        regex = r"\b%s\b"
-    for word in censor_list:
-        text = re.sub(regex % word, len(word) * replace, text, flags=re.IGNORECASE)
-    return text
+        return Censor(whole=censor_list, replace=replace).scrub(text)
+    return Censor(partial=censor_list, replace=replace).scrub(text)
 
 
 def remove_URL(sample):
@@ -97,7 +99,24 @@ def encode_ao_packet(params):
     return new_params
 
 
+def encode_ao_command(command, args):
+    """
+    Serialize an AO command into the bytes sent over the wire, e.g. `CT#name#msg#%`.
+    :param command: command name
+    :param args: sequence of arguments, tuples are joined with `&` (evidence entries)
+    """
+    parts = encode_ao_packet([command, *args])
+    for i, arg in enumerate(parts):
+        # AO2 evidence packet uses & to separate pieces of evidence
+        if type(arg) is tuple:
+            parts[i] = "&".join(arg)
+    parts.append("%")
+    return "#".join(parts).encode("utf-8")
+
+
 def derelative(sample):
+    if ".." not in sample:
+        return sample
     while "../" in sample or "/.." in sample or "..\\" in sample or "\\.." in sample:
         sample = sample.replace("../", "").replace("/..", "").replace("..\\", "").replace("\\..", "")
     return sample
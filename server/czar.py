@@ -1,4 +1,5 @@
 import sys
+import time
 import logging
 import asyncio
 import importlib
@@ -11,15 +12,19 @@ import yaml
 import server.logger
 from server import database
 from server.hub_manager import HubManager
+from server.geoip import ASNResolver, UNKNOWN_ASN
+from server.ipranges import IPRangeBans
+from server.censor import Censor
+from server.music import MusicIndex, MusicViews, music_list_names, music_lists, music_versions
 from server.client_manager import ClientManager
-from server.emotes import Emotes
+from server.emotes import EmoteCache, Emotes
 from server.discordbot import Bridgebot
-from server.exceptions import ClientError, ServerError
+from server.exceptions import ClientError
 from server.network.aoprotocol import AOProtocol
 from server.network.aoprotocol_ws import new_websocket_client
 from server.network.masterserverclient import MasterServerClient
 from server.network.webhooks import Webhooks
-from server.constants import remove_URL, dezalgo
+from server.sanitize import discord_to_ic
 from server.medieval_parser import MedievalParser
 
 logger = logging.getLogger("main")
@@ -35,19 +40,27 @@ class CzarServer:
         self.minor_version = 0
 
         self.config = None
-        self.censors = None
+        self.censors = Censor()
         self.allowed_iniswaps = []
         self.char_list = None
         self.char_emotes = None
+        self.emote_cache = EmoteCache()
+        self.emote_cache.load()
+        # Running warm_emotes tasks, kept so they aren't garbage collected
+        self.emote_warmers = set()
+        self._music_index = None
         self.music_list = []
+        # Layered music lists clients see, shared between clients seeing the same ones
+        self.music_views = MusicViews()
         self.music_whitelist = []
         self.backgrounds = None
         self.backgrounds_categories = None
         self.server_links = None
         self.zalgo_tolerance = None
-        self.ipRange_bans = []
+        self.ipRange_bans = IPRangeBans()
         self.geoIpReader = None
         self.useGeoIp = False
+        self.asn_resolver = None
         self.need_webhook = False
         self.supported_features = [
             "yellowtext",
@@ -82,6 +95,7 @@ class CzarServer:
 
         self.ms_client = None
         sys.setrecursionlimit(50)
+        load_start = time.perf_counter()
         try:
             self.load_config()
             self.load_command_aliases()
@@ -108,12 +122,20 @@ class CzarServer:
             print("Please check sample config files for the correct format.")
             sys.exit(1)
 
+        if self.useGeoIp:
+            self.asn_resolver = ASNResolver(
+                self.geoIpReader,
+                self.config["geoip_cache_size"],
+                self.config["geoip_cache_ttl"],
+            )
+
         self.medieval_parser = MedievalParser()
         self.client_manager = ClientManager(self)
         server.logger.setup_logging(debug=self.config["debug"])
 
         self.webhooks = Webhooks(self)
         self.bridgebot = None
+        logger.info("Loaded configuration in %.2fs", time.perf_counter() - load_start)
 
     def start(self):
         """Start the server."""
@@ -158,7 +180,11 @@ class CzarServer:
         if "need_webhook" in self.config and self.config["need_webhook"]["enabled"]:
             self.need_webhook = True
 
-        asyncio.ensure_future(self.schedule_unbans())
+        asyncio.ensure_future(database.unban_scheduler())
+        asyncio.ensure_future(self.client_manager.keepalive_sweeper())
+        # Parse the music lists in the background, /musiclist and friends then won't touch the disk
+        asyncio.ensure_future(asyncio.to_thread(music_lists.preload, "storage/musiclists"))
+        self.warm_emotes()
 
         database.log_misc("start")
         print("Server started and is listening on port {}".format(self.config["port"]))
@@ -170,16 +196,13 @@ class CzarServer:
             loop.stop()
 
         database.log_misc("stop")
+        # Make sure every logged event makes it to the database before exiting
+        database.shutdown()
 
         ao_server.close()
         loop.run_until_complete(ao_server.wait_closed())
         loop.close()
 
-    async def schedule_unbans(self):
-        while True:
-            database.schedule_unbans()
-            await asyncio.sleep(3600 * 12)
-
     @property
     def version(self):
         """Get the server's current version."""
@@ -195,42 +218,63 @@ class CzarServer:
         peername = transport.get_extra_info("peername")[0]
 
         if self.useGeoIp:
-            try:
-                geoIpResponse = self.geoIpReader.asn(peername)
-                asn = str(geoIpResponse.autonomous_system_number)
-            except geoip2.errors.AddressNotFoundError:
-                asn = "Loopback"
-                pass
+            # None if it's not cached, the ASN ban is then checked once the lookup is done
+            asn = self.asn_resolver.get(peername)
         else:
-            asn = "Loopback"
-
-        for line, rangeBan in enumerate(self.ipRange_bans):
-            if rangeBan != "" and (
-                (peername.startswith(rangeBan) and (rangeBan.endswith(".") or rangeBan.endswith(":")))
-                or asn == rangeBan
-            ):
-                msg = "BD#"
-                msg += "Abuse\r\n"
-                msg += f"ID: {line}\r\n"
-                msg += "Until: N/A"
-                msg += "#%"
-
-                transport.write(msg.encode("utf-8"))
-                raise ClientError
+            asn = UNKNOWN_ASN
+
+        line = self.ipRange_bans.match(peername, asn)
+        if line is not None:
+            msg = "BD#"
+            msg += "Abuse\r\n"
+            msg += f"ID: {line}\r\n"
+            msg += "Until: N/A"
+            msg += "#%"
+
+            transport.write(msg.encode("utf-8"))
+            raise ClientError
 
         c = self.client_manager.new_client(transport)
         c.server = self
         c.area = self.hub_manager.default_hub().default_area()
-        c.area.new_client(c)
+        if asn is None:
+            # Keep them out of the area until we know they're not from a banned ASN
+            c.asn_check = asyncio.ensure_future(self.check_asn_ban(c, peername))
+        else:
+            c.area.new_client(c)
         return c
 
+    async def check_asn_ban(self, client, peername):
+        """
+        Disconnect a client if its ASN turns out to be banned, otherwise
+        put them in their area. The client's handshake (HI) is held until this is done.
+        :param client: newly connected client
+        :param peername: client's IP address
+        """
+        try:
+            asn = await self.asn_resolver.resolve(peername)
+        except Exception:
+            # Their IP was already checked against the IP range bans, and a broken
+            # GeoIP database shouldn't lock everyone out of the server
+            logger.exception("Couldn't look up the ASN of %s, letting them in", peername)
+            asn = None
+        if client.transport.is_closing():
+            return
+        line = None if asn is None else self.ipRange_bans.match_asn(asn)
+        if line is not None:
+            client.send_command("BD", f"Abuse\r\nID: {line}\r\nUntil: N/A")
+            client.disconnect()
+            return
+        client.area.new_client(client)
+
     def remove_client(self, client):
         """
         Remove a disconnected client.
         :param client: client object
 
         """
-        if client.area:
+        # They might have left before the ASN ban check let them into their area
+        if client.area and client in client.area.clients:
             area = client.area
             if not area.dark and not area.force_sneak and not client.sneaking and not client.hidden:
                 area.broadcast_ooc(f"[{client.id}] {client.showname} has disconnected.")
@@ -240,7 +284,7 @@ class CzarServer:
     @property
     def player_count(self):
         """Get the number of non-spectating clients."""
-        return len([client for client in self.client_manager.clients if client.char_id != -1])
+        return len(self.client_manager.clients) - self.client_manager.spectator_count
 
     def load_config(self):
         """Load the main server configuration from a YAML file."""
@@ -273,6 +317,10 @@ class CzarServer:
                 "mute_length": 0,
             }
 
+        if not self.config.get("packet_floodguard"):
+            # Off unless configured
+            self.config["packet_floodguard"] = {}
+
         if "zalgo_tolerance" not in self.config:
             self.config["zalgo_tolerance"] = 3
 
@@ -290,6 +338,24 @@ class CzarServer:
             self.config["global_chat"] = True
         if "music_allow_url" not in self.config:
             self.config["music_allow_url"] = True
+        if "outbound_high_water" not in self.config:
+            self.config["outbound_high_water"] = 256 * 1024
+        if "outbound_low_water" not in self.config:
+            self.config["outbound_low_water"] = 64 * 1024
+        if "slow_client_timeout" not in self.config:
+            self.config["slow_client_timeout"] = 30
+        if "slow_client_max_buffer" not in self.config:
+            self.config["slow_client_max_buffer"] = 4 * 1024 * 1024
+        if "websocket_queue_size" not in self.config:
+            self.config["websocket_queue_size"] = 1024
+        if "arup_delay" not in self.config:
+            self.config["arup_delay"] = 0.1
+        if "timer_resync_interval" not in self.config:
+            self.config["timer_resync_interval"] = 60
+        if "geoip_cache_size" not in self.config:
+            self.config["geoip_cache_size"] = 4096
+        if "geoip_cache_ttl" not in self.config:
+            self.config["geoip_cache_ttl"] = 3600
 
     def load_command_aliases(self):
         """Load a list of alternative command names."""
@@ -303,15 +369,27 @@ class CzarServer:
         """Load a list of banned words to scrub from chats."""
         try:
             with open("config/censors.yaml", "r", encoding="utf-8") as censors:
-                self.censors = yaml.safe_load(censors)
+                self.censors = Censor.from_config(yaml.safe_load(censors))
         except Exception:
             logger.debug("Cannot find censors.yaml")
 
     def load_characters(self):
-        """Load the character list from a YAML file."""
+        """Load the character list from a YAML file. Their emotes are read from char.ini files when first needed."""
         with open("config/characters.yaml", "r", encoding="utf-8") as chars:
             self.char_list = yaml.safe_load(chars)
-        self.char_emotes = {char: Emotes(char) for char in self.char_list}
+        self.char_emotes = {char: Emotes(char, self.emote_cache) for char in self.char_list}
+
+    def warm_emotes(self):
+        """Read every character's emotes in a thread, so the first messages don't wait on char.ini files."""
+        task = asyncio.ensure_future(asyncio.to_thread(self.emote_cache.warm, list(self.char_emotes.values())))
+        self.emote_warmers.add(task)
+        task.add_done_callback(self.emotes_warmed)
+
+    def emotes_warmed(self, task):
+        """Log what went wrong if warming the emotes failed. Emotes are then read as they're needed."""
+        self.emote_warmers.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Couldn't load character emotes", exc_info=task.exception())
 
     def load_music(self):
         self.load_music_list()
@@ -346,10 +424,11 @@ class CzarServer:
             logger.debug("Cannot find iniswaps.yaml")
 
     def load_ipranges(self):
-        """Load a list of banned IP ranges."""
+        """Load a list of banned IP ranges and ASNs."""
         try:
             with open("config/iprange_ban.txt", "r", encoding="utf-8") as ipranges:
-                self.ipRange_bans = ipranges.read().splitlines()
+                # Build the new matcher fully before swapping it in
+                self.ipRange_bans = IPRangeBans(ipranges.read().splitlines())
         except Exception:
             logger.debug("Cannot find iprange_ban.txt")
 
@@ -365,63 +444,36 @@ class CzarServer:
         except Exception:
             logger.debug("Cannot find url.txt")
 
+    @property
+    def music_list(self):
+        """The server's music list (config/music.yaml)."""
+        return self._music_list
+
+    @music_list.setter
+    def music_list(self, value):
+        self._music_list = value
+        self._music_index = None
+        self.music_version = next(music_versions)
+
+    @property
+    def music_index(self):
+        """Lookup tables for the server's music list, rebuilt after it's replaced."""
+        if self._music_index is None:
+            self._music_index = MusicIndex(self._music_list)
+        return self._music_index
+
     def build_music_list(self, music_list):
-        song_list = []
-        for item in music_list:
-            if "category" not in item:  # skip settings n stuff
-                continue
-            song_list.append(item["category"])
-            for song in item["songs"]:
-                song_list.append(song["name"])
-        return song_list
-
-    def get_song_data(self, music_list, music):
-        """
-        Get information about a track, if exists.
-        :param music_list: music list to search
-        :param music: track name
-        :returns: tuple (name, length or -1)
-        :raises: ServerError if track not found
-        """
-        for item in music_list:
-            if "category" not in item:  # skip settings n stuff
-                continue
-            if item["category"] == music:
-                return item["category"], 0
-            for song in item["songs"]:
-                if song["name"] == music:
-                    length = -1
-                    if "length" in song:
-                        length = song["length"]
-
-                    if "path" in song:
-                        return song["path"], length
-
-                    return song["name"], length
-        raise ServerError("Music not found.")
-
-    def get_song_is_category(self, music_list, music):
-        """
-        Get whether a track is a category.
-        :param music_list: music list to search
-        :param music: track name
-        :returns: bool
-        """
-        for item in music_list:
-            if "category" not in item:  # skip settings n stuff
-                continue
-            if item["category"] == music:
-                return True
-        return False
+        return music_list_names(music_list)
 
     def send_all_cmd_pred(self, cmd, *args, pred=lambda x: True):
         """
         Broadcast an AO-compatible command to all clients that satisfy
         a predicate.
         """
+        cache = {}
         for client in self.client_manager.clients:
             if pred(client):
-                client.send_command(cmd, *args)
+                client.send_command(cmd, *args, cache=cache)
 
     def broadcast_global(self, client, msg, as_mod=False):
         """
@@ -465,59 +517,10 @@ class CzarServer:
             pred=lambda x: not x.muted_adverts,
         )
 
-    def send_arup(self, client, args):
-        """Update the area properties for this 2.6 client.
-
-        Playercount:
-            ARUP#0#<area1_p: int>#<area2_p: int>#...
-        Status:
-            ARUP#1#<area1_s: string>#<area2_s: string>#...
-        CM:
-            ARUP#2#<area1_cm: string>#<area2_cm: string>#...
-        Lockedness:
-            ARUP#3#<area1_l: string>#<area2_l: string>#...
-
-        :param args:
-
-        """
-        if len(args) < 2:
-            # An argument count smaller than 2 means we only got the identifier of ARUP.
-            return
-        if args[0] not in (0, 1, 2, 3):
-            return
-
-        if args[0] == 0:
-            for part_arg in args[1:]:
-                try:
-                    int(part_arg)
-                except Exception:
-                    return
-        elif args[0] in (1, 2, 3):
-            for part_arg in args[1:]:
-                try:
-                    str(part_arg)
-                except Exception:
-                    return
-
-        client.send_command("ARUP", *args)
-
     def send_discord_chat(self, name, message, hub_id=0, area_id=0):
         area = self.hub_manager.get_hub_by_id(hub_id).get_area_by_id(area_id)
         area.area_manager.get_char_id_by_name(self.config["bridgebot"]["character"])
-        message = dezalgo(message)
-        message = remove_URL(message)
-        message = (
-            message.replace("}", "\\}")
-            .replace("{", "\\{")
-            .replace("`", "\\`")
-            .replace("|", "\\|")
-            .replace("~", "\\~")
-            .replace("º", "\\º")
-            .replace("№", "\\№")
-            .replace("√", "\\√")
-            .replace("\\s", "")
-            .replace("\\f", "")
-        )
+        message = discord_to_ic(message)
         message = self.config["bridgebot"]["prefix"] + message
         if len(name) > 14:
             name = name[:14].rstrip() + "."
@@ -568,12 +571,16 @@ class CzarServer:
             self.config["modpass"] = cfg_yaml["modpass"]
 
         self.load_config()
+        self.client_manager.load_rate_limits()
         self.load_command_aliases()
         self.load_censors()
         self.load_iniswaps()
         self.load_characters()
+        self.warm_emotes()
         self.load_music()
         self.load_backgrounds()
+        for hub in self.hub_manager.hubs:
+            hub.invalidate_join_cache()
 
         # TODO: Only do the refresh if the server link list has changed
         # Clear the list of user links so they can be reloaded after.
@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from datetime import datetime
 from functools import reduce
+from itertools import groupby
+from operator import itemgetter
 from textwrap import dedent
 
 from .exceptions import ServerError
@@ -8,7 +10,11 @@ from .exceptions import ServerError
 import os
 
 import asyncio
+import heapq
+import queue
 import sqlite3
+import threading
+import time
 import json
 
 import arrow
@@ -21,6 +27,36 @@ logger = logging.getLogger("database")
 DB_FILE = "storage/db.sqlite3"
 _database_singleton = None
 
+# Log events are written on a background thread, committing up to EVENT_BATCH_SIZE
+# rows at once or whatever arrived within EVENT_BATCH_INTERVAL seconds of the first one.
+# Once EVENT_QUEUE_SIZE events are waiting, new ones are dropped.
+EVENT_QUEUE_SIZE = 10000
+EVENT_BATCH_SIZE = 500
+EVENT_BATCH_INTERVAL = 0.05
+
+# Longest the unban scheduler sleeps before checking the clock again, in case it jumped
+UNBAN_MAX_SLEEP = 3600
+
+# Insert statements for the event writer, built once so SQLite can reuse the prepared statement
+INSERT_AREA_EVENT = dedent("""
+    INSERT INTO area_events(event_subtype, ipid, hub_id, hub_name, area_id, area_name, ic_name, char_name,
+        ooc_name, message, target_ipid)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """)
+INSERT_CONNECT_EVENT = dedent("""
+    INSERT INTO connect_events(ipid, hdid, failed) VALUES (?, ?, ?)
+    """)
+INSERT_IPID = dedent("""
+    INSERT INTO ipids(ipid, ip_address) VALUES (?, ?)
+    """)
+INSERT_HDID = dedent("""
+    INSERT OR IGNORE INTO hdids(hdid, ipid) VALUES (?, ?)
+    """)
+INSERT_MISC_EVENT = dedent("""
+    INSERT INTO misc_events(event_subtype, ipid, target_ipid,
+        event_data) VALUES (?, ?, ?, ?)
+    """)
+
 
 def __getattr__(name):
     global _database_singleton
@@ -36,13 +72,32 @@ class Database:
     """
 
     def __init__(self):
-        new = not os.path.exists("storage/db.sqlite3")
+        new = not os.path.exists(DB_FILE)
         self.db = sqlite3.connect(DB_FILE)
         self.db.execute("PRAGMA foreign_keys = ON")
+        # Lets the event writer commit without blocking reads, and skips an fsync per commit
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
         self.db.row_factory = sqlite3.Row
         if new:
             self.migrate_json_to_v1()
         self.migrate()
+        # (event type, subtype name) -> subtype ID, see _subtype_atom
+        self.atoms = {}
+        self.load_atoms()
+        # ip -> IPID, HDID -> set of IPIDs, IPID -> ban ID and HDID -> ban ID, see load_identities
+        self.ip_ipids = {}
+        self.hdid_ipids = {}
+        self.ipid_bans = {}
+        self.hdid_bans = {}
+        self.next_ipid = 1
+        self.load_identities()
+        # Heap of (unban timestamp, ban ID) and the current unban timestamp of each ban, see unban_scheduler
+        self.unban_heap = []
+        self.unban_dates = {}
+        self.unban_wakeup = asyncio.Event()
+        self.load_unbans()
+        self.events = EventWriter(DB_FILE)
 
     def migrate_json_to_v1(self):
         """Migrate to v1 of the database from JSON."""
@@ -144,32 +199,47 @@ class Database:
                 conn.executescript(file.read())
         logger.debug("Migration to v%s complete", version)
 
+    def load_identities(self):
+        """Load the IPIDs, HDIDs and bans checked on every connection into memory."""
+        with self.db as conn:
+            for ipid, ip in conn.execute("SELECT ipid, ip_address FROM ipids"):
+                self.ip_ipids[ip] = ipid
+                self.next_ipid = max(self.next_ipid, ipid + 1)
+            for hdid, ipid in conn.execute("SELECT hdid, ipid FROM hdids"):
+                self.hdid_ipids.setdefault(hdid, set()).add(ipid)
+            for ipid, ban_id in conn.execute("SELECT ipid, ban_id FROM ip_bans"):
+                self.ipid_bans[ipid] = ban_id
+            for hdid, ban_id in conn.execute("SELECT hdid, ban_id FROM hdid_bans"):
+                self.hdid_bans[hdid] = ban_id
+
+    def defer_write(self, sql, params):
+        """Queue a write for the event writer, or run it right away if it can't take it."""
+        if not self.events.put(sql, params):
+            with self.db as conn:
+                conn.execute(sql, params)
+
     def ipid(self, ip):
-        """Get an IPID from an IP address."""
+        """Get an IPID from an IP address. Known IPs are answered from memory."""
+        try:
+            return self.ip_ipids[ip]
+        except KeyError:
+            pass
+        ipid = self.next_ipid
+        # New IPs are rare enough to save right away, so an IPID is only handed
+        # out once its row exists and a failed write can't leave it half-taken
         with self.db as conn:
-            conn.execute(
-                dedent("""
-                INSERT OR IGNORE INTO ipids(ipid, ip_address) VALUES (NULL, ?)
-                """),
-                (ip,),
-            )
-            ipid = conn.execute(
-                dedent("""
-                SELECT ipid FROM ipids WHERE ip_address = ?
-                """),
-                (ip,),
-            ).fetchone()["ipid"]
-            return ipid
+            conn.execute(INSERT_IPID, (ipid, ip))
+        self.next_ipid += 1
+        self.ip_ipids[ip] = ipid
+        return ipid
 
     def add_hdid(self, ipid, hdid):
         """Associate an HDID with an IPID."""
-        with self.db as conn:
-            conn.execute(
-                dedent("""
-                INSERT OR IGNORE INTO hdids(hdid, ipid) VALUES (?, ?)
-                """),
-                (hdid, ipid),
-            )
+        ipids = self.hdid_ipids.setdefault(hdid, set())
+        if ipid in ipids:
+            return
+        ipids.add(ipid)
+        self.defer_write(INSERT_HDID, (hdid, ipid))
 
     def ban(
         self,
@@ -186,6 +256,10 @@ class Database:
         of web users if used incorrectly.
         """
         with self.db as conn:
+            if ban_type == "hdid":
+                # The HDID might have been seen just now and still be waiting in the
+                # event writer, save it here rather than waiting for the queue
+                conn.executemany(INSERT_HDID, [(target_id, ipid) for ipid in self.hdid_ipids.get(target_id, ())])
             if ban_id is None:
                 logger.info(f"{banned_by.name} ({banned_by.ipid}) " + f"banned {target_id}: '{reason}'.")
                 ban_id = conn.execute(
@@ -218,8 +292,12 @@ class Database:
             else:
                 raise ServerError(f"unknown ban type {ban_type}")
 
+        if ban_type == "ipid":
+            self.ipid_bans[target_id] = ban_id
+        else:
+            self.hdid_bans[target_id] = ban_id
         if unban_date is not None:
-            self._schedule_unban(ban_id)
+            self._schedule_unban(ban_id, unban_date)
 
         return ban_id
 
@@ -320,56 +398,93 @@ class Database:
             else:
                 return None
 
+    def find_connection_ban(self, ipid, hdid):
+        """
+        Check if a connecting client is banned. Clients that aren't are
+        answered from memory without touching the database.
+        """
+        if ipid not in self.ipid_bans and hdid not in self.hdid_bans:
+            return None
+        return self.find_ban(ipid, hdid)
+
     def unban(self, ban_id):
         """Remove a ban entry."""
         logger.info("Unbanning %s", ban_id)
         with self.db as conn:
-            unbans = conn.execute(
-                dedent("""
-                DELETE FROM bans WHERE ban_id = ?
-                """),
-                (ban_id,),
-            ).rowcount
-            return unbans > 0
+            return len(self._delete_bans(conn, [ban_id])) > 0
 
-    def schedule_unbans(self):
+    def _delete_bans(self, conn, ban_ids):
         """
-        Schedule unbans from the database.
-
-        There is a bug in Python 3.7 and below where functions cannot be
-        scheduled with a timeout longer than one day. As a workaround,
-        schedule_unbans will only get the unbans for the next 12 hours
-        and then will have to be called again 12 hours later.
+        Delete bans inside the caller's transaction, keeping the in-memory indexes up to date.
+        :returns: IDs of the bans that existed
         """
-        dated_bans = []
-        with self.db as conn:
-            dated_bans = conn.execute(
-                dedent("""
-                SELECT ban_id FROM bans
-                WHERE unban_date IS NOT NULL AND
-                    datetime(unban_date) < datetime(?, '+12 hours')
-                """),
-                (arrow.utcnow().datetime,),
-            ).fetchall()
-
-        for ban in dated_bans:
-            self._schedule_unban(ban["ban_id"])
-
-    def _schedule_unban(self, ban_id):
-        with self.db as conn:
-            ban = conn.execute(
+        deleted = []
+        for ban_id in ban_ids:
+            row = conn.execute("SELECT ban_id FROM bans WHERE ban_id = ?", (ban_id,)).fetchone()
+            if row is None:
+                continue
+            ban_id = row["ban_id"]
+            for row in conn.execute("SELECT ipid FROM ip_bans WHERE ban_id = ?", (ban_id,)).fetchall():
+                self.ipid_bans.pop(row["ipid"], None)
+            for row in conn.execute("SELECT hdid FROM hdid_bans WHERE ban_id = ?", (ban_id,)).fetchall():
+                self.hdid_bans.pop(row["hdid"], None)
+            conn.execute(
                 dedent("""
-                SELECT unban_date FROM bans WHERE ban_id = ?
+                DELETE FROM bans WHERE ban_id = ?
                 """),
                 (ban_id,),
-            ).fetchone()
-            time_to_unban = (arrow.get(ban["unban_date"]) - arrow.utcnow()).total_seconds()
+            )
+            self.unban_dates.pop(ban_id, None)
+            deleted.append(ban_id)
+        return deleted
 
-            def auto_unban():
-                self.unban(ban_id)
-                self.log_misc("auto_unban", data={"id": ban_id})
+    def load_unbans(self):
+        """Load the expiry dates of every temporary ban."""
+        with self.db as conn:
+            for row in conn.execute("SELECT ban_id, unban_date FROM bans WHERE unban_date IS NOT NULL"):
+                self._schedule_unban(row["ban_id"], row["unban_date"])
 
-            asyncio.get_running_loop().call_later(time_to_unban, auto_unban)
+    def _schedule_unban(self, ban_id, unban_date):
+        """
+        Lift a ban once its unban date passes.
+        Scheduling a ban again replaces its previous date.
+        """
+        timestamp = arrow.get(unban_date).timestamp()
+        self.unban_dates[ban_id] = timestamp
+        heapq.heappush(self.unban_heap, (timestamp, ban_id))
+        if self.unban_heap[0][1] == ban_id:
+            # The scheduler might be sleeping until a later date
+            self.unban_wakeup.set()
+
+    def lift_expired_bans(self):
+        """Delete every ban whose unban date has passed, in one transaction."""
+        now = time.time()
+        due = []
+        while self.unban_heap and self.unban_heap[0][0] <= now:
+            timestamp, ban_id = heapq.heappop(self.unban_heap)
+            # Skip bans that were lifted by hand or given a new date since
+            if self.unban_dates.get(ban_id) == timestamp:
+                due.append(ban_id)
+        if not due:
+            return
+        with self.db as conn:
+            unbanned = self._delete_bans(conn, due)
+        for ban_id in unbanned:
+            logger.info("Ban %s expired", ban_id)
+            self.log_misc("auto_unban", data={"id": ban_id})
+
+    async def unban_scheduler(self):
+        """Lift bans as they expire, sleeping until the next unban date in between."""
+        while True:
+            self.unban_wakeup.clear()
+            self.lift_expired_bans()
+            timeout = UNBAN_MAX_SLEEP
+            if self.unban_heap:
+                timeout = min(timeout, max(self.unban_heap[0][0] - time.time(), 0))
+            try:
+                await asyncio.wait_for(self.unban_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
     def log_area(self, event_subtype, client, area, message=None, target=None):
         """
@@ -392,40 +507,29 @@ class Database:
             f"[H{area.area_manager.id} A{area.id} '{area.name}'] {showname}"
             + f"/{client.name} ({client.ipid}): event {event_subtype} ({message})"
         )
-        with self.db as conn:
-            conn.execute(
-                dedent("""
-                INSERT INTO area_events(ipid, hub_id, hub_name, area_id, area_name, ic_name, char_name, ooc_name,
-                    event_subtype, message, target_ipid)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """),
-                (
-                    ipid,
-                    area.area_manager.id,
-                    area.area_manager.name,
-                    area.id,
-                    area.name,
-                    client._showname,
-                    char_name,
-                    ooc_name,
-                    subtype_id,
-                    message,
-                    target_ipid,
-                ),
-            )
+        self.events.put(
+            INSERT_AREA_EVENT,
+            (
+                subtype_id,
+                ipid,
+                area.area_manager.id,
+                area.area_manager.name,
+                area.id,
+                area.name,
+                client._showname,
+                char_name,
+                ooc_name,
+                message,
+                target_ipid,
+            ),
+        )
 
     def log_connect(self, client, failed=False):
         """Log a connect attempt."""
         logger.info(
             f"{client.ipid} (HDID: {client.hdid}) " + f"{'was blocked from connecting' if failed else 'connected'}."
         )
-        with self.db as conn:
-            conn.execute(
-                dedent("""
-                INSERT INTO connect_events(ipid, hdid, failed) VALUES (?, ?, ?)
-                """),
-                (client.ipid, client.hdid, failed),
-            )
+        self.events.put(INSERT_CONNECT_EVENT, (client.ipid, client.hdid, failed))
 
     def log_misc(self, event_subtype, client=None, target=None, data=None):
         """
@@ -438,14 +542,11 @@ class Database:
         data_json = json.dumps(data)
         logger.info("%s (%s onto %s): %s", event_subtype, client_ipid, target_ipid, data)
 
-        with self.db as conn:
-            conn.execute(
-                dedent("""
-                INSERT INTO misc_events(ipid, target_ipid, event_subtype,
-                    event_data) VALUES (?, ?, ?, ?)
-                """),
-                (client_ipid, target_ipid, subtype_id, data_json),
-            )
+        self.events.put(INSERT_MISC_EVENT, (subtype_id, client_ipid, target_ipid, data_json))
+
+    def shutdown(self):
+        """Write out every queued log event and stop the event writer."""
+        self.events.close()
 
     def recent_bans(self, count=5):
         """
@@ -465,7 +566,22 @@ class Database:
                 ).fetchall()
             ]
 
+    def load_atoms(self):
+        """Load every known event subtype ID into memory."""
+        with self.db as conn:
+            for event_type in ("area", "misc"):
+                for type_id, type_name in conn.execute(f"SELECT type_id, type_name FROM {event_type}_event_types"):
+                    self.atoms[(event_type, type_name)] = type_id
+
     def _subtype_atom(self, event_type, event_subtype):
+        """
+        Translate an event subtype name to its ID, creating it if necessary.
+        Known subtypes come from memory, only new ones touch the database.
+        """
+        try:
+            return self.atoms[(event_type, event_subtype)]
+        except KeyError:
+            pass
         if event_type not in ("area", "misc"):
             raise AssertionError()
 
@@ -477,10 +593,141 @@ class Database:
                 """),
                 (event_subtype,),
             )
-            return conn.execute(
+            type_id = conn.execute(
                 dedent(f"""
                 SELECT type_id FROM {event_type}_event_types
                 WHERE type_name = ?
                 """),
                 (event_subtype,),
             ).fetchone()["type_id"]
+        self.atoms[(event_type, event_subtype)] = type_id
+        return type_id
+
+
+class EventWriter:
+    """
+    Inserts log events and other deferred writes from a background thread, so the event
+    loop never waits on SQLite. Events are queued and committed in batches, many rows per transaction.
+    """
+
+    def __init__(
+        self,
+        path,
+        queue_size=EVENT_QUEUE_SIZE,
+        batch_size=EVENT_BATCH_SIZE,
+        batch_interval=EVENT_BATCH_INTERVAL,
+    ):
+        self.path = path
+        # (sql, params) tuples, None stops the writer
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.thread = None
+        self.lock = threading.Lock()
+        self.closed = False
+        # Events thrown away because the queue was full, or that failed to insert
+        self.dropped = 0
+        self.failed = 0
+        self.written = 0
+
+    @property
+    def depth(self):
+        """Amount of events waiting to be written."""
+        return self.queue.qsize()
+
+    def put(self, sql, params):
+        """
+        Queue an event to be inserted.
+        :param sql: INSERT statement
+        :param params: statement parameters
+        :returns: False if the event was thrown away
+        """
+        if self.closed:
+            return False
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="event-writer", daemon=True)
+                    self.thread.start()
+        try:
+            self.queue.put_nowait((sql, params))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning("Event log queue is full, %s events dropped so far", self.dropped)
+            return False
+        return True
+
+    def flush(self):
+        """Wait until every queued event has been written."""
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        """Write out the queued events and stop the writer thread."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        try:
+            while True:
+                batch = [self.queue.get()]
+                deadline = time.monotonic() + self.batch_interval
+                while batch[-1] is not None and len(batch) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                stop = batch[-1] is None
+                if stop:
+                    batch.pop()
+                try:
+                    self.write(conn, batch)
+                finally:
+                    for _ in range(len(batch) + stop):
+                        self.queue.task_done()
+                if stop:
+                    return
+        finally:
+            conn.close()
+
+    def write(self, conn, batch):
+        """Insert a batch of events in a single transaction."""
+        try:
+            with conn:
+                conn.execute("BEGIN")
+                # Consecutive events of the same kind go through one prepared statement
+                for sql, events in groupby(batch, key=itemgetter(0)):
+                    self.write_rows(conn, sql, [params for _, params in events])
+        except sqlite3.Error:
+            logger.exception("Could not commit %s events", len(batch))
+
+    def write_rows(self, conn, sql, rows):
+        """Insert rows with the same statement, skipping the ones that fail."""
+        conn.execute("SAVEPOINT event_rows")
+        try:
+            conn.executemany(sql, rows)
+        except sqlite3.Error:
+            # Undo the partial insert and go row by row, so only the bad rows are lost
+            conn.execute("ROLLBACK TO event_rows")
+            for params in rows:
+                try:
+                    conn.execute(sql, params)
+                except sqlite3.Error as exc:
+                    self.failed += 1
+                    logger.warning("Could not log event: %s", exc)
+                else:
+                    self.written += 1
+        else:
+            self.written += len(rows)
+        conn.execute("RELEASE event_rows")
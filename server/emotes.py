@@ -1,78 +1,195 @@
 from os import path
 from configparser import ConfigParser
 
+import json
 import logging
+import os
+import threading
+import time
 
 logger = logging.getLogger("emotes")
 
 char_dir = "characters"
 
 
-class Emotes:
+def read_char_ini(char_path):
     """
-    Represents a list of emotes read in from a character INI file
-    used for validating which emotes can be sent by clients.
+    Read the emotes out of a char.ini.
+    :param char_path: path to the char.ini
+    :returns: frozenset of (preanim, anim, sfx), empty if the file is missing or broken
     """
+    emotes = set()
+    char_ini = ConfigParser(
+        comment_prefixes=("=", "-", "#", ";", "//", "\\\\"),
+        allow_no_value=True,
+        strict=False,
+        empty_lines_in_values=False,
+    )
+    try:
+        with open(char_path, encoding="utf-8-sig") as f:
+            char_ini.read_file(f)
+            logger.info("Found char.ini for %s that can be used for iniswap restrictions!", char_path)
+    except FileNotFoundError:
+        return frozenset()
 
-    def __init__(self, name):
-        self.name = name
-        self.emotes = set()
-        self.read_ini()
+    # cuz people making char.ini's don't care for no case in sections
+    char_ini = dict((k.lower(), v) for k, v in char_ini.items())
+    try:
+        for emote_id in range(1, int(char_ini["emotions"]["number"]) + 1):
+            try:
+                emote_id = str(emote_id)
+                _name, preanim, anim, _mod = char_ini["emotions"][str(emote_id)].split("#")[:4]
+                # if "soundn" in char_ini and emote_id in char_ini["soundn"]:
+                #     sfx = char_ini["soundn"][str(emote_id)] or ""
+                #     if sfx != "" and len(sfx) == 1:
+                #         # Often, a one-character SFX is a placeholder for no sfx,
+                #         # so allow it
+                #         sfx = ""
+                # else:
+                #     sfx = ""
 
-    def read_ini(self):
-        char_ini = ConfigParser(
-            comment_prefixes=("=", "-", "#", ";", "//", "\\\\"),
-            allow_no_value=True,
-            strict=False,
-            empty_lines_in_values=False,
+                # sfx checking is not performed due to custom sfx being possible, so don't bother for now
+                sfx = ""
+                emotes.add((preanim.lower(), anim.lower(), sfx.lower()))
+            except KeyError as e:
+                logger.warning(
+                    "Broken key %s in character file %s. This indicates a malformed character INI file.",
+                    e.args[0],
+                    char_path,
+                )
+    except KeyError as e:
+        logger.warning(
+            "Unknown key %s in character file %s. This indicates a malformed character INI file.",
+            e.args[0],
+            char_path,
         )
+    except ValueError as e:
+        logger.warning(
+            "Value error in character file %s:\n%ss\nThis indicates a malformed character INI file.",
+            char_path,
+            e,
+        )
+    # Keep whatever was read before running into a broken line
+    return frozenset(emotes)
+
+
+class EmoteCache:
+    """
+    Emotes read out of char.ini files, kept in a JSON file between restarts.
+    A char.ini is only parsed again if its modification time or size changed.
+    Used from both the event loop and the thread running warm().
+    """
+
+    def __init__(self, cache_path="storage/emotes.json"):
+        self.cache_path = cache_path
+        # Guards entries, dirty and parsed; INIs are parsed outside of it
+        self.lock = threading.Lock()
+        # char.ini path -> (modification time, size, emotes)
+        self.entries = {}
+        self.dirty = False
+        # char.ini files parsed since the cache was made, for the logs
+        self.parsed = 0
+
+    def load(self):
+        """Read the cache file, starting over if it's missing or unreadable."""
         try:
-            char_path = path.join(char_dir, self.name, "char.ini")
-            with open(char_path, encoding="utf-8-sig") as f:
-                char_ini.read_file(f)
-                logger.info("Found char.ini for %s that can be used for iniswap restrictions!", char_path)
+            with open(self.cache_path, encoding="utf-8") as f:
+                entries = json.load(f)
+            self.entries = {
+                char_path: (mtime, size, frozenset(tuple(emote) for emote in emotes))
+                for char_path, (mtime, size, emotes) in entries.items()
+            }
         except FileNotFoundError:
-            return
+            self.entries = {}
+        except (OSError, ValueError, TypeError) as ex:
+            logger.warning("Ignoring broken emote cache %s: %s", self.cache_path, ex)
+            self.entries = {}
+
+    def save(self):
+        """Write the cache file if anything was parsed since the last save."""
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            entries = {
+                char_path: (mtime, size, sorted(emotes)) for char_path, (mtime, size, emotes) in self.entries.items()
+            }
+        try:
+            with open(f"{self.cache_path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(f"{self.cache_path}.tmp", self.cache_path)
+        except OSError as ex:
+            logger.warning("Couldn't save emote cache %s: %s", self.cache_path, ex)
 
-        # cuz people making char.ini's don't care for no case in sections
-        char_ini = dict((k.lower(), v) for k, v in char_ini.items())
+    def get(self, char_path):
+        """
+        Get the emotes of a char.ini, parsing it only if it changed.
+        :param char_path: path to the char.ini
+        :returns: frozenset of (preanim, anim, sfx)
+        """
         try:
-            for emote_id in range(1, int(char_ini["emotions"]["number"]) + 1):
-                try:
-                    emote_id = str(emote_id)
-                    _name, preanim, anim, _mod = char_ini["emotions"][str(emote_id)].split("#")[:4]
-                    # if "soundn" in char_ini and emote_id in char_ini["soundn"]:
-                    #     sfx = char_ini["soundn"][str(emote_id)] or ""
-                    #     if sfx != "" and len(sfx) == 1:
-                    #         # Often, a one-character SFX is a placeholder for no sfx,
-                    #         # so allow it
-                    #         sfx = ""
-                    # else:
-                    #     sfx = ""
-
-                    # sfx checking is not performed due to custom sfx being possible, so don't bother for now
-                    sfx = ""
-                    self.emotes.add((preanim.lower(), anim.lower(), sfx.lower()))
-                except KeyError as e:
-                    logger.warning(
-                        "Broken key %s in character file %s. This indicates a malformed character INI file.",
-                        e.args[0],
-                        char_path,
-                    )
-        except KeyError as e:
-            logger.warning(
-                "Unknown key %s in character file %s. This indicates a malformed character INI file.",
-                e.args[0],
-                char_path,
-            )
-            return
-        except ValueError as e:
-            logger.warning(
-                "Value error in character file %s:\n%ss\nThis indicates a malformed character INI file.",
-                char_path,
-                e,
-            )
-            return
+            stat = os.stat(char_path)
+        except OSError:
+            return frozenset()
+        with self.lock:
+            entry = self.entries.get(char_path)
+        if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2]
+        emotes = read_char_ini(char_path)
+        with self.lock:
+            self.entries[char_path] = (stat.st_mtime_ns, stat.st_size, emotes)
+            self.dirty = True
+            self.parsed += 1
+        return emotes
+
+    def warm(self, char_emotes):
+        """
+        Read every character's emotes into their Emotes objects, through the
+        cache, then save the cache. Meant to be run in a thread; characters
+        used by the loop in the meantime read their own, at worst twice.
+        :param char_emotes: Emotes objects
+        """
+        start = time.perf_counter()
+        parsed = self.parsed
+        restricted = sum(len(emotes.emotes) > 0 for emotes in char_emotes)
+        self.save()
+        logger.info(
+            "Loaded emotes for %d characters (%d with a char.ini) in %.2fs, %d char.ini files parsed",
+            len(char_emotes),
+            restricted,
+            time.perf_counter() - start,
+            self.parsed - parsed,
+        )
+
+
+class Emotes:
+    """
+    Represents a list of emotes read in from a character INI file
+    used for validating which emotes can be sent by clients.
+    The INI is only read the first time the emotes are needed.
+    """
+
+    def __init__(self, name, cache=None):
+        """
+        :param name: character folder name
+        :param cache: EmoteCache to read the emotes through, or None to always parse the INI
+        """
+        self.name = name
+        self.cache = cache
+        self._emotes = None
+
+    @property
+    def emotes(self):
+        """Set of (preanim, anim, sfx) tuples, loaded on first use."""
+        if self._emotes is None:
+            self._emotes = self.read_ini()
+        return self._emotes
+
+    def read_ini(self):
+        char_path = path.join(char_dir, self.name, "char.ini")
+        if self.cache is not None:
+            return self.cache.get(char_path)
+        return read_char_ini(char_path)
 
     def validate(self, preanim, anim, sfx):
         """
@@ -0,0 +1,93 @@
+"""Looking up the autonomous system (ASN) of connecting clients with a GeoLite2 ASN database."""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import geoip2.errors
+
+logger = logging.getLogger("geoip")
+
+# What addresses missing from the database (local networks etc.) resolve to
+UNKNOWN_ASN = "Loopback"
+
+
+class ASNResolver:
+    """
+    Resolves IP addresses to ASNs, remembering recent answers.
+
+    Database reads happen on a small thread pool so they never hold up the
+    event loop, and the last `max_size` results are cached for `ttl` seconds,
+    so clients reconnecting over and over cost a dict lookup.
+    """
+
+    def __init__(self, reader, max_size=4096, ttl=3600):
+        self.reader = reader
+        self.max_size = max_size
+        self.ttl = ttl
+        # ip -> (asn, expiry time), least recently used first
+        self.cache = OrderedDict()
+        # ip -> future of a lookup in progress, so simultaneous connections share one read
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="geoip")
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, ip):
+        """
+        Read an IP's ASN from the database, skipping the cache. Blocks.
+        :param ip: IP address string
+        :returns: ASN as a string
+        """
+        try:
+            return str(self.reader.asn(ip).autonomous_system_number)
+        except (geoip2.errors.AddressNotFoundError, ValueError):
+            return UNKNOWN_ASN
+
+    def get(self, ip):
+        """
+        Get an IP's ASN if it's cached.
+        :param ip: IP address string
+        :returns: ASN as a string, or None if it has to be looked up
+        """
+        entry = self.cache.get(ip)
+        if entry is None:
+            return None
+        asn, expires = entry
+        if expires <= time.monotonic():
+            del self.cache[ip]
+            return None
+        self.cache.move_to_end(ip)
+        self.hits += 1
+        return asn
+
+    def put(self, ip, asn):
+        """Cache an IP's ASN, evicting the least recently used entry if full."""
+        self.cache[ip] = (asn, time.monotonic() + self.ttl)
+        self.cache.move_to_end(ip)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    async def resolve(self, ip):
+        """
+        Get an IP's ASN, reading the database on the thread pool if it isn't cached.
+        :param ip: IP address string
+        :returns: ASN as a string
+        """
+        asn = self.get(ip)
+        if asn is not None:
+            return asn
+        future = self.pending.get(ip)
+        if future is None:
+            self.misses += 1
+            future = asyncio.get_running_loop().run_in_executor(self.executor, self.lookup, ip)
+            self.pending[ip] = future
+            try:
+                asn = await future
+            finally:
+                del self.pending[ip]
+            self.put(ip, asn)
+            return asn
+        return await future
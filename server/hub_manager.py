@@ -10,15 +10,12 @@ class HubManager:
     def __init__(self, server):
         self.server = server
         self.hubs = []
+        # Clients in any of our hubs, kept up to date by Area.new_client/remove_client
+        self.clients = set()
+        # Hubs by lowercase name and abbreviation, rebuilt on demand (see hub_lookup)
+        self._hub_lookup = None
         self.load()
 
-    @property
-    def clients(self):
-        clients = set()
-        for hub in self.hubs:
-            clients = clients | hub.clients
-        return clients
-
     def load(self, path="config/areas.yaml", hub_id=-1):
         try:
             with open(path, "r", encoding="utf-8") as stream:
@@ -36,7 +33,7 @@ class HubManager:
         if "area" in hubs[0]:
             # Legacy support triggered! Abort operation
             if len(self.hubs) <= 0:
-                self.hubs.append(AreaManager(self, "Hub 0"))
+                self.create_hub()
             self.hubs[0].load_areas(hubs)
 
             is_dr_hub = False
@@ -67,10 +64,12 @@ class HubManager:
         for hub in hubs:
             while len(self.hubs) < len(hubs):
                 # Make sure that the hub manager contains enough hubs to update with new information
-                self.hubs.append(AreaManager(self, f"Hub {len(self.hubs)}"))
+                self.create_hub()
             while len(self.hubs) > len(hubs):
                 # Clean up excess hubs
                 h = self.hubs.pop()
+                h._id = -1
+                self.invalidate_hub_lookup()
                 clients = h.clients.copy()
                 for client in clients:
                     client.set_area(self.default_hub().default_area())
@@ -90,27 +89,69 @@ class HubManager:
         except Exception:
             raise AreaError(f"Trying to save Hub list: File path {path} is invalid!")
 
+    def create_hub(self):
+        """Create a new hub instance and return it."""
+        hub = AreaManager(self, f"Hub {len(self.hubs)}")
+        hub._id = len(self.hubs)
+        self.hubs.append(hub)
+        self.invalidate_hub_lookup()
+        return hub
+
     def default_hub(self):
         """Get the default hub."""
         return self.hubs[0]
 
+    def hub_lookup(self):
+        """
+        Get the tables used to find hubs by name and abbreviation.
+        When several hubs share a key, the first one wins.
+        :returns: tuple of dicts (by lowercase name, by lowercase abbreviation)
+        """
+        if self._hub_lookup is None:
+            by_name, by_abbreviation = {}, {}
+            for hub in self.hubs:
+                by_name.setdefault(hub.name.lower(), hub)
+                by_abbreviation.setdefault(hub.abbreviation.lower(), hub)
+            self._hub_lookup = (by_name, by_abbreviation)
+        return self._hub_lookup
+
+    def invalidate_hub_lookup(self):
+        """Rebuild the hub lookup tables next time they're needed."""
+        self._hub_lookup = None
+
     def get_hub_by_name(self, name):
         """Get a hub by name."""
-        for hub in self.hubs:
-            if hub.name.lower() == name.lower():
-                return hub
-        raise AreaError("Hub not found.")
+        try:
+            return self.hub_lookup()[0][name.lower()]
+        except KeyError:
+            raise AreaError("Hub not found.")
 
     def get_hub_by_id(self, num):
         """Get a hub by ID."""
-        for hub in self.hubs:
-            if hub.id == num:
-                return hub
+        if isinstance(num, int) and 0 <= num < len(self.hubs):
+            return self.hubs[num]
         raise AreaError("Hub not found.")
 
     def get_hub_by_abbreviation(self, abbr):
         """Get a hub by abbreviation."""
-        for hub in self.hubs:
-            if hub.abbreviation.lower() == abbr.lower():
-                return hub
-        raise AreaError("Hub not found.")
+        try:
+            return self.hub_lookup()[1][abbr.lower()]
+        except KeyError:
+            raise AreaError("Hub not found.")
+
+    def get_hub_list(self):
+        """Get the FA packet arguments listing every hub and its player count."""
+        return [
+            "🌐 Hubs 🌐\n Double-Click me to see Areas\n  _______",
+            *[f"[{hub.id}] {hub.name} (users: {hub.count})" for hub in self.hubs],
+        ]
+
+    def broadcast_hub_list(self):
+        """Send the hub list to every client currently looking at it."""
+        hub_list = None
+        cache = {}
+        for c in self.server.client_manager.clients:
+            if c.viewing_hub_list:
+                if hub_list is None:
+                    hub_list = self.get_hub_list()
+                c.send_command("FA", *hub_list, cache=cache)
@@ -0,0 +1,123 @@
+"""Matching connecting clients against the IP range and ASN ban list (config/iprange_ban.txt)."""
+
+import ipaddress
+import logging
+
+logger = logging.getLogger("ipranges")
+
+
+def parse_range(entry):
+    """
+    Turn a ban list entry into an IP network.
+    Accepts CIDR notation, single addresses and the legacy prefix form, where
+    an entry ending in `.`, `:` or `::` bans every address starting with it
+    (e.g. `10.1.` is 10.1.0.0/16, `2001:db8:` and `2001:db8::` are 2001:db8::/32).
+    :param entry: ban list line, stripped
+    :returns: ip_network
+    :raises ValueError: if the entry isn't a valid range
+    """
+    if entry.endswith("."):
+        octets = entry[:-1].split(".")
+        if len(octets) > 3:
+            raise ValueError(f"{entry} has too many octets")
+        return ipaddress.IPv4Network((".".join(octets + ["0"] * (4 - len(octets))), 8 * len(octets)))
+    if entry.endswith(":"):
+        # `2001:db8::` is as much a prefix as `2001:db8:`, not the single address 2001:db8::
+        groups = entry.rstrip(":").split(":")
+        if groups == [""]:
+            raise ValueError(f"{entry} would ban every IPv6 address")
+        if len(groups) > 7:
+            raise ValueError(f"{entry} has too many groups")
+        return ipaddress.IPv6Network((":".join(groups + ["0"] * (8 - len(groups))), 16 * len(groups)))
+    return ipaddress.ip_network(entry, strict=False)
+
+
+class IPRangeBans:
+    """
+    The IP range and ASN ban list, compiled for quick lookups.
+
+    Ranges go into a binary prefix tree per IP version, so checking an address
+    walks at most one node per bit instead of comparing it against every entry.
+    ASNs are kept in a dict. Both remember the line number of the entry, which
+    is shown to the banned client as the ban ID.
+    """
+
+    def __init__(self, lines=()):
+        # Tree nodes are [zero child, one child, line number of a range ending here]
+        self.trees = {4: [None, None, None], 6: [None, None, None]}
+        self.asns = {}
+        self.ranges = 0
+        for line, entry in enumerate(lines):
+            entry = entry.strip()
+            if entry == "" or entry.startswith("#"):
+                continue
+            if entry.isdigit():
+                self.asns.setdefault(entry, line)
+                continue
+            try:
+                network = parse_range(entry)
+            except ValueError:
+                logger.warning("Ignoring invalid IP range on line %s of the IP range ban list: %s", line, entry)
+                continue
+            self.add(network, line)
+
+    def add(self, network, line):
+        """
+        Ban an IP network.
+        :param network: ip_network
+        :param line: ban list line number
+        """
+        node = self.trees[network.version]
+        bits = int(network.network_address) >> (network.max_prefixlen - network.prefixlen)
+        for shift in range(network.prefixlen - 1, -1, -1):
+            bit = (bits >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None or line < node[2]:
+            node[2] = line
+        self.ranges += 1
+
+    def match_ip(self, ip):
+        """
+        Find the first ban list line whose range contains an IP address.
+        :param ip: IP address string
+        :returns: line number, or None
+        """
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        node = self.trees[address.version]
+        value = int(address)
+        match = node[2]
+        for shift in range(address.max_prefixlen - 1, -1, -1):
+            node = node[(value >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None and (match is None or node[2] < match):
+                match = node[2]
+        return match
+
+    def match_asn(self, asn):
+        """
+        Find the ban list line for an autonomous system.
+        :param asn: autonomous system number string
+        :returns: line number, or None
+        """
+        return self.asns.get(asn)
+
+    def match(self, ip, asn=None):
+        """
+        Find the first ban list line matching a connecting client.
+        :param ip: IP address string
+        :param asn: autonomous system number string, if known
+        :returns: line number, or None
+        """
+        match = self.match_ip(ip)
+        asn_match = self.match_asn(asn)
+        if asn_match is not None and (match is None or asn_match < match):
+            match = asn_match
+        return match
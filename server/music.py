@@ -0,0 +1,336 @@
+"""Lookup tables for music lists (config/music.yaml and storage/musiclists/)."""
+
+import asyncio
+import bisect
+import itertools
+import logging
+import os
+import random
+from collections import OrderedDict
+
+import oyaml as yaml  # ordered yaml
+
+from server.constants import encode_ao_command
+from server.exceptions import ServerError
+
+logger = logging.getLogger("music")
+
+# Music lists get a new stamp from here whenever they change, so a tuple of
+# stamps identifies what a layered music list contains
+music_versions = itertools.count(1)
+
+
+def music_list_names(music_list):
+    """
+    Flatten a music list into the category and song names shown to clients.
+    :param music_list: music list
+    :returns: list of names
+    """
+    song_list = []
+    for item in music_list:
+        if "category" not in item:  # skip settings n stuff
+            continue
+        song_list.append(item["category"])
+        for song in item["songs"]:
+            song_list.append(song["name"])
+    return song_list
+
+
+class MusicIndex:
+    """
+    A music list compiled into dicts, so finding a track doesn't mean
+    scanning every category and song.
+
+    The server, hub, area and client music lists each get their own index,
+    rebuilt when the list is replaced. A client's music list is made of up to
+    four of them layered on top of each other (see Client.music_sources), so
+    looking a track up is at most four dict lookups.
+    """
+
+    def __init__(self, music_list):
+        # Track or category name -> (path to play, length), the first entry wins like in a linear scan
+        self.tracks = {}
+        self.categories = set()
+        # Song lists of each category entry, in order
+        self.playlists = []
+        # Song name -> indexes into playlists of the categories it's in
+        self.song_playlists = {}
+        for item in music_list:
+            if "category" not in item:  # skip settings n stuff
+                continue
+            category = item["category"]
+            self.categories.add(category)
+            self.tracks.setdefault(category, (category, 0))
+            songs = item.get("songs") or []
+            for song in songs:
+                name = song["name"]
+                self.tracks.setdefault(name, (song.get("path", name), song.get("length", -1)))
+                playlists = self.song_playlists.setdefault(name, [])
+                if not playlists or playlists[-1] != len(self.playlists):
+                    playlists.append(len(self.playlists))
+            self.playlists.append(songs)
+        # Track name -> songs the jukebox can pick after it, see jukebox_pool
+        self.jukebox_pools = {}
+
+    def playlists_with(self, name):
+        """
+        Get the song lists of the categories a song is in.
+        :param name: song name, or "" for every category
+        :returns: list of song lists
+        """
+        if name == "":
+            return self.playlists
+        return [self.playlists[i] for i in self.song_playlists.get(name, ())]
+
+    def jukebox_pool(self, name):
+        """
+        Get the songs the jukebox picks from when nobody voted: the looping
+        songs of the categories a song is in, besides the song itself.
+        Worked out once per song and kept until the list is replaced.
+        :param name: song name, or "" for every category
+        :returns: tuple of songs
+        """
+        pool = self.jukebox_pools.get(name)
+        if pool is None:
+            pool = self.jukebox_pools[name] = tuple(
+                song
+                for playlist in self.playlists_with(name)
+                for song in playlist
+                if ("length" not in song or song["length"] == -1) and song["name"] != name
+            )
+        return pool
+
+
+def find_track(indexes, music):
+    """
+    Get information about a track, if exists.
+    :param indexes: MusicIndex of each music list layer, in order
+    :param music: track name
+    :returns: tuple (name, length or -1)
+    :raises: ServerError if track not found
+    """
+    for index in indexes:
+        track = index.tracks.get(music)
+        if track is not None:
+            return track
+    raise ServerError("Music not found.")
+
+
+def is_category(indexes, music):
+    """
+    Get whether a track is a category.
+    :param indexes: MusicIndex of each music list layer, in order
+    :param music: track name
+    :returns: bool
+    """
+    return any(music in index.categories for index in indexes)
+
+
+def pick_from_pools(pools):
+    """
+    Pick a song at random from several pools, as if they were one list.
+    :param pools: sequences of songs
+    :returns: song, or None if all pools are empty
+    """
+    position = random.randrange(sum(len(pool) for pool in pools) or 1)
+    for pool in pools:
+        if position < len(pool):
+            return pool[position]
+        position -= len(pool)
+    return None
+
+
+def pick_vote(votes):
+    """
+    Pick a jukebox vote at random, each one as likely as its chance.
+    :param votes: list of Area.JukeboxVote
+    :returns: vote, None if there are none
+    """
+    # Running totals of the chances, a vote is picked if the position lands in its stretch
+    totals = list(itertools.accumulate(vote.chance for vote in votes))
+    if not totals or totals[-1] <= 0:
+        # Everyone voted for the song that just played
+        return random.choice(votes) if votes else None
+    return votes[bisect.bisect_right(totals, random.randrange(totals[-1]))]
+
+
+class MusicView:
+    """
+    The music list clients see when a set of music lists are layered, built
+    once and shared by every client seeing the same layers at the same versions.
+    """
+
+    def __init__(self, key, sources):
+        """
+        :param key: tuple of the sources' music versions
+        :param sources: objects with music_list and music_index, in order (see Client.music_sources)
+        """
+        self.key = key
+        music_list = sources[0].music_list
+        for source in sources[1:]:
+            music_list = music_list + source.music_list
+        self.music_list = music_list
+        self.indexes = [source.music_index for source in sources]
+        self._names = None
+        self._packet = None
+
+    @property
+    def names(self):
+        """Category and song names, as sent in FM and SM."""
+        if self._names is None:
+            self._names = music_list_names(self.music_list)
+        return self._names
+
+    @property
+    def packet(self):
+        """The encoded FM packet, shared by everyone getting this view."""
+        if self._packet is None:
+            self._packet = encode_ao_command("FM", self.names)
+        return self._packet
+
+
+class MusicViews:
+    """Memoizes MusicViews by the versions of their sources, keeping the most recently used ones."""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.views = OrderedDict()
+
+    def get(self, sources):
+        """
+        Get the view for a set of layered music lists.
+        :param sources: objects with music_list, music_index and music_version, in order
+        :returns: MusicView
+        """
+        key = tuple(source.music_version for source in sources)
+        view = self.views.get(key)
+        if view is None:
+            view = self.views[key] = MusicView(key, sources)
+            if len(self.views) > self.max_size:
+                self.views.popitem(last=False)
+        else:
+            self.views.move_to_end(key)
+        return view
+
+
+def parse_music_list(stream, path):
+    """
+    Parse a music list file, prefixing song names with the file's name if it uses a unique folder.
+    :param stream: open file
+    :param path: path of the file
+    :returns: music list
+    """
+    music_list = yaml.safe_load(stream)
+    prepath = ""
+    for item in music_list:
+        # deprecated, use the 'replace_music' area and hub prefs instead
+        # if 'replace' in item:
+        #     self.replace_music = item['replace'] is True
+        if "use_unique_folder" in item and item["use_unique_folder"] is True:
+            prepath = os.path.splitext(os.path.basename(path))[0] + "/"
+
+        if "category" not in item:
+            continue
+
+        if "songs" in item:
+            for song in item["songs"]:
+                song["name"] = prepath + song["name"]
+    return music_list
+
+
+class MusicListCache:
+    """
+    Music lists from storage/musiclists/, parsed and indexed once per version of the file.
+
+    The lists handed out are shared by every client, area and hub that loads
+    the same file, so they must not be edited in place; replace them with an
+    edited copy instead (see the /musiclist_add command).
+
+    On the event loop, a list that was loaded before is handed out as it is
+    and checked for changes on a thread afterwards, so an edited file is
+    picked up by the next load rather than the current one.
+    """
+
+    def __init__(self):
+        # path -> (modification time, music list, MusicIndex)
+        self.lists = {}
+        # path -> task checking the file for changes
+        self.refreshing = {}
+
+    def isfile(self, path):
+        """
+        Check if a music list exists, without touching the disk for lists loaded before.
+        :param path: path to the music list
+        """
+        return os.path.normpath(path) in self.lists or os.path.isfile(path)
+
+    def load(self, path):
+        """
+        Get a music list, reading the file only if it changed since last time.
+        :param path: path to the music list
+        :returns: tuple (music list, MusicIndex)
+        :raises: OSError if the file can't be read
+        """
+        path = os.path.normpath(path)
+        cached = self.lists.get(path)
+        if cached is None:
+            # Only lists added since the server started end up here, see preload
+            return self.read(path)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self.read(path)
+        if path not in self.refreshing:
+            task = asyncio.ensure_future(asyncio.to_thread(self.read, path))
+            task.add_done_callback(lambda task: self.refreshed(path, task))
+            self.refreshing[path] = task
+        return cached[1], cached[2]
+
+    def read(self, path):
+        """
+        Read a music list if it isn't cached or changed since it was.
+        :param path: normalized path to the music list
+        :returns: tuple (music list, MusicIndex)
+        :raises: OSError if the file can't be read
+        """
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.lists.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1], cached[2]
+        with open(path, "r", encoding="utf-8") as stream:
+            music_list = parse_music_list(stream, path)
+        index = MusicIndex(music_list)
+        self.lists[path] = (mtime, music_list, index)
+        return music_list, index
+
+    def refreshed(self, path, task):
+        """Forget a music list that couldn't be read again, so the next load reports it."""
+        del self.refreshing[path]
+        if task.cancelled():
+            return
+        ex = task.exception()
+        if ex is not None:
+            self.lists.pop(path, None)
+            logger.warning("Couldn't reload music list %s: %s", path, ex)
+
+    def preload(self, directory):
+        """
+        Load every music list in a directory and its subdirectories, so the
+        commands loading them later don't have to wait on the disk.
+        Meant to be run in a thread.
+        :param directory: path to the directory
+        """
+        loaded = 0
+        for root, _, files in os.walk(directory):
+            for file in files:
+                if not file.endswith(".yaml"):
+                    continue
+                try:
+                    self.read(os.path.normpath(os.path.join(root, file)))
+                    loaded += 1
+                except (OSError, ValueError, TypeError, KeyError, yaml.YAMLError) as ex:
+                    logger.warning("Couldn't load music list %s: %s", os.path.join(root, file), ex)
+        logger.debug("Loaded %d music lists from %s", loaded, directory)
+
+
+music_lists = MusicListCache()
@@ -1,19 +1,24 @@
 from .. import commands
-from server.constants import dezalgo, censor, contains_URL, derelative
+from server.constants import dezalgo, derelative
+from server.sanitize import contains_ic_link, ic_to_discord, is_blankpost
 from server.exceptions import ClientError, AreaError, ArgumentError, ServerError
 from server import database
 from .ms_parser import parse_ms
+from .framing import PacketFramer
+import math
 import time
 import arrow
 from enum import Enum
 import asyncio
-import re
 import unicodedata
 import traceback
 import logging
 
 logger = logging.getLogger("aoprotocol")
 
+# How many bytes of a packet to look at for its command name when rate limiting, longer than any AO command
+COMMAND_PEEK = 16
+
 
 class AOProtocol(asyncio.Protocol):
     """The main class that deals with the AO protocol."""
@@ -30,8 +35,13 @@ class AOProtocol(asyncio.Protocol):
         super().__init__()
         self.server = server
         self.client = None
-        self.buffer = ""
-        self.ping_timeout = None
+        self.framer = PacketFramer(1024 * 8)
+        # Until when the client has been told they're sending too fast, so they're told once per flood
+        self.flood_notice_until = 0
+
+    def exempt_from_floodguard(self):
+        """Mods and CMs aren't held to the packet floodguard."""
+        return self.client.is_mod or self.client in self.client.area.owners
 
     def data_received(self, data):
         """Handles any data received from the network.
@@ -42,30 +52,36 @@ class AOProtocol(asyncio.Protocol):
         :param data: bytes of data
 
         """
-        buf = data
         ipid = self.client.ipid
 
-        if buf is None:
-            buf = b""
-
-        if not isinstance(buf, str):
-            # try to decode as utf-8, ignore any erroneous characters
-            buf = self.buffer + buf.decode("utf-8", "ignore")
+        if data is None:
+            data = b""
 
-        buf = buf.translate({ord(c): None for c in "\0"})
+        if isinstance(data, str):
+            # websocket frames arrive already decoded
+            data = data.encode("utf-8")
 
         packet_size = 1024  # in bits
         if "packet_size" in self.server.config:
             packet_size = self.server.config["packet_size"]
-
-        if len(buf) > packet_size * 8:  # convert bits to bytes
-            self.client.send_ooc(
-                "Your last action was dropped because it was too big! Contact the server administrator for more information."
-            )
-            logger.debug("Buffer overflow from %s with %s", ipid, len(buf))
-            return
-        self.buffer = buf
-        for msg in self.get_messages():
+        self.framer.max_size = packet_size * 8  # convert bits to bytes
+
+        dropped = self.framer.dropped
+        rate_limiter = self.server.client_manager.rate_limiter
+        for frame in self.framer.feed(data):
+            # Flooding packets are thrown away before we spend any time reading them
+            command = bytes(frame[:COMMAND_PEEK]).partition(b"#")[0]
+            if command in rate_limiter.limits and not self.exempt_from_floodguard():
+                wait = rate_limiter.check(ipid, command)
+                if wait:
+                    logger.debug("Rate limited %s packet from %s", command.decode("utf-8", "ignore"), ipid)
+                    now = time.monotonic()
+                    if now >= self.flood_notice_until:
+                        self.flood_notice_until = now + wait
+                        self.client.send_ooc(f"You are sending too fast! Try again in {math.ceil(wait)} seconds.")
+                    continue
+            # try to decode as utf-8, ignore any erroneous characters
+            msg = str(frame, "utf-8", "ignore")
             if len(msg) < 2:
                 continue
             try:
@@ -78,6 +94,12 @@ class AOProtocol(asyncio.Protocol):
                 self.client.disconnect()
                 raise
 
+        if self.framer.dropped != dropped:
+            self.client.send_ooc(
+                "Your last action was dropped because it was too big! Contact the server administrator for more information."
+            )
+            logger.debug("Dropped %s oversized packet(s) from %s", self.framer.dropped - dropped, ipid)
+
     def connection_made(self, transport):
         """Called upon a new client connecting
 
@@ -97,13 +119,29 @@ class AOProtocol(asyncio.Protocol):
             self.client.disconnect()
             return
 
+        # TCP transports and the websocket TransportWrapper both pause us past the high watermark
+        if hasattr(transport, "set_write_buffer_limits"):
+            transport.set_write_buffer_limits(
+                high=self.server.config["outbound_high_water"],
+                low=self.server.config["outbound_low_water"],
+            )
+
         # Client needs to send CHECK#% within the timeout - otherwise,
-        # it will be automatically dropped.
-        self.ping_timeout = asyncio.get_running_loop().call_later(self.server.config["timeout"], self.client.disconnect)
+        # it will be dropped by ClientManager.keepalive_sweeper.
 
         # Disables fantacrypt for clients older than 2.9, required for AO2-Client to send HDID.
         self.client.send_command("decryptor", "NOENCRYPT")
 
+    def pause_writing(self):
+        """Called when the transport's write buffer goes over the high watermark."""
+        if self.client is not None:
+            self.client.pause_writing()
+
+    def resume_writing(self):
+        """Called when the transport's write buffer drains below the low watermark."""
+        if self.client is not None:
+            self.client.resume_writing()
+
     def connection_lost(self, exc):
         """User disconnected
 
@@ -113,19 +151,7 @@ class AOProtocol(asyncio.Protocol):
         if self.client is not None:
             logger.debug("%s disconnected.", self.client.ipid)
             self.server.remove_client(self.client)
-        if self.ping_timeout is not None:
-            self.ping_timeout.cancel()
-
-    def get_messages(self):
-        """Parses out full messages from the buffer.
-
-        :return: yields messages
-
-        """
-        while "#%" in self.buffer:
-            spl = self.buffer.split("#%", 1)
-            self.buffer = spl[1]
-            yield spl[0]
+            self.client.drop_output()
 
     def validate_net_cmd(self, args, *types, needs_auth=True):
         """Makes sure the net command's arguments match expectations.
@@ -166,6 +192,12 @@ class AOProtocol(asyncio.Protocol):
         """
         if not self.validate_net_cmd(args, self.ArgType.STR, needs_auth=False):
             return
+        if self.client.asn_check is not None and not self.client.asn_check.done():
+            # Finish the handshake once we know they're not from a banned ASN
+            self.client.asn_check.add_done_callback(lambda _: self.net_cmd_hi(args))
+            return
+        if self.client.transport.is_closing():
+            return
         # We already got an assigned hdid by the server
         if self.client.hdid != "":
             self.client.send_command("KB", "Your HDID was sent a second time by your client.")
@@ -175,7 +207,7 @@ class AOProtocol(asyncio.Protocol):
         ipid = self.client.ipid
 
         database.add_hdid(ipid, hdid)
-        ban = database.find_ban(ipid, hdid)
+        ban = database.find_connection_ban(ipid, hdid)
         if ban is not None:
             if ban.unban_date is not None:
                 unban_date = arrow.get(ban.unban_date)
@@ -213,10 +245,15 @@ class AOProtocol(asyncio.Protocol):
         software, version = args[0], args[1]
         self.client.version = version
         self.client.software = software
-        preflist = self.client.server.supported_features.copy()
-        if not self.client.area.area_manager.arup_enabled and "arup" in preflist:
-            preflist.remove("arup")
-        self.client.send_command("FL", *preflist)
+        hub = self.client.area.area_manager
+
+        def build_preflist():
+            preflist = self.client.server.supported_features.copy()
+            if not hub.arup_enabled and "arup" in preflist:
+                preflist.remove("arup")
+            return "FL", preflist
+
+        self.client.send_raw_bytes(hub.join_packet(("FL", hub.arup_enabled), build_preflist))
 
         # Get the list of version vars, making sure the size of the least is at least 3 args
         verlist = self.client.version.split(".")
@@ -244,12 +281,11 @@ class AOProtocol(asyncio.Protocol):
 
         CHECK#%
         """
-        self.client.send_command("CHECK")
-        self.ping_timeout.cancel()
-        self.ping_timeout = asyncio.get_running_loop().call_later(self.server.config["timeout"], self.client.disconnect)
+        self.client.send_command("CHECK", flush=True)
+        self.client.last_seen = time.monotonic()
 
-        # Update the timers thru handshake as well to make sure they're always in sync
-        self.client.area.update_timers(self.client, running_only=True)
+        # Resync any timers that changed or drifted since we last sent them
+        self.client.area.update_timers(self.client, running_only=True, changed_only=True)
 
     def net_cmd_askchaa(self, _):
         """Ask for the counts of characters/evidence/music
@@ -292,14 +328,22 @@ class AOProtocol(asyncio.Protocol):
         else:
             song_list += [a.name for a in area_list]
 
-        self.client.local_music_list = self.client.construct_music_list()
-        if len(self.client.local_music_list) > 0:
-            songs = self.client.local_music_list
-        else:
-            songs = self.server.music_list
-        song_list += self.server.build_music_list(songs)
+        view = self.client.music_view()
+        self.client.local_music_list = view.music_list
+        self.client.local_music_key = view.key
+
+        def build_song_list():
+            return "SM", song_list + view.names
 
-        self.client.send_command("SM", *song_list)
+        if self.client.music_ref != "":
+            # The client's own music list isn't shared with anyone, don't cache it
+            command, args = build_song_list()
+            self.client.send_command(command, *args)
+            return
+        # The area list and the music list versions are all that set the packet apart,
+        # so areas showing the same ones share it
+        key = ("SM", tuple(song_list), view.key)
+        self.client.send_raw_bytes(self.client.area.area_manager.join_packet(key, build_song_list))
 
     def net_cmd_rd(self, _):
         """Asks for server metadata(charscheck, motd etc.) and a DONE#% signal(also best packet)
@@ -358,36 +402,6 @@ class AOProtocol(asyncio.Protocol):
             self.client.send_ooc(f"Something went wrong! Please report this to the developers:\n{args}")
             return
 
-        # Extract fields from parsed message
-        msg_type = ms["msg_type"]
-        pre = ms["pre"]
-        folder = ms["folder"]
-        anim = ms["anim"]
-        text = ms["text"]
-        pos = ms["pos"]
-        sfx = ms["sfx"]
-        emote_mod = ms["emote_mod"]
-        cid = ms["cid"]
-        sfx_delay = ms["sfx_delay"]
-        button = ms["button"]
-        evidence = ms["evidence"]
-        flip = ms["flip"]
-        ding = ms["ding"]
-        color = ms["color"]
-        showname = ms["showname"]
-        charid_pair = ms["charid_pair"]
-        offset_pair = ms["offset_pair"]
-        nonint_pre = ms["nonint_pre"]
-        sfx_looping = ms["sfx_looping"]
-        screenshake = ms["screenshake"]
-        frames_shake = ms["frames_shake"]
-        frames_realization = ms["frames_realization"]
-        frames_sfx = ms["frames_sfx"]
-        additive = ms["additive"]
-        effect = ms["effect"]
-        pair_order = ms["pair_order"]
-        third_charid = ms["third_charid"]
-        video = ms["video"]
         # Targets for whispering
         whisper_clients = None
 
@@ -395,80 +409,56 @@ class AOProtocol(asyncio.Protocol):
         if self.client.is_mod or self.client in self.client.area.owners:
             target_area = self.client.broadcast_list.copy()
 
-        if self.client.area.cannot_ic_interact(self.client, button):
+        if self.client.area.cannot_ic_interact(self.client, ms.button):
             self.client.send_ooc("This is a muted area - ask the CM to be included in the invite list.")
             return False
-        if button == "0" and not self.client.area.can_send_message(self.client):
+        if ms.button == "0" and not self.client.area.can_send_message(self.client):
             return
 
         if (
-            len(showname) > 0
+            len(ms.showname) > 0
             and not self.client.area.showname_changes_allowed
             and not self.client.is_mod
             and self.client not in self.client.area.owners
         ):
             self.client.send_ooc("Showname changes are forbidden in this area!")
             return
-        if self.client.area.is_iniswap(self.client, pre, anim, folder, sfx):
-            folder = self.client.char_name
+        if self.client.area.is_iniswap(self.client, ms.pre, ms.anim, ms.folder, ms.sfx):
+            ms.folder = self.client.char_name
             self.client.send_ooc(
-                f"Iniswap/custom emotes are blocked in this area for character '{folder}', pre '{pre}' anim '{anim}'."
+                f"Iniswap/custom emotes are blocked in this area for character '{ms.folder}', pre '{ms.pre}' anim '{ms.anim}'."
             )
             return
-        if len(self.client.charcurse) > 0 and folder != self.client.char_name:
+        if len(self.client.charcurse) > 0 and ms.folder != self.client.char_name:
             self.client.send_ooc("You may not iniswap while you are charcursed!")
             return
         if self.server.config["block_relative"]:
-            pre = derelative(pre)
-            anim = derelative(anim)
-            folder = derelative(folder)
-            sfx = derelative(sfx)
-            pos = derelative(pos)
-            frames_shake = derelative(frames_shake)
-            frames_realization = derelative(frames_realization)
-            frames_sfx = derelative(frames_sfx)
-            effect = derelative(effect)
+            ms.pre = derelative(ms.pre)
+            ms.anim = derelative(ms.anim)
+            ms.folder = derelative(ms.folder)
+            ms.sfx = derelative(ms.sfx)
+            ms.pos = derelative(ms.pos)
+            ms.frames_shake = derelative(ms.frames_shake)
+            ms.frames_realization = derelative(ms.frames_realization)
+            ms.frames_sfx = derelative(ms.frames_sfx)
+            ms.effect = derelative(ms.effect)
 
         if not self.client.is_mod and self.client not in self.client.area.owners:
             if not self.client.area.blankposting_allowed:
-                # Regex is slow as hell, need to change this to be more performant
-                if text.strip() == "" or (
-                    len(re.sub(r"[{}\\`|(~~)]", "", text).replace(" ", "")) < 3
-                    and not text.startswith("<")
-                    and not text.startswith(">")
-                    and not text.startswith("=")
-                ):
+                if is_blankpost(ms.text):
                     self.client.send_ooc("Blankposting is forbidden in this area!")
                     return
             elif self.client.area.blankposting_forced:
-                if text.strip() != "":
+                if ms.text.strip() != "":
                     self.client.send_ooc("You can only blankpost in this area!")
                     return
 
         # Scrub text and showname for bad words
-        if self.client.area.area_manager.censor_ic and self.server.censors is not None and len(self.server.censors) > 0:
-            text = censor(text, self.server.censors["whole"], self.server.censors["replace"], True)
-            text = censor(
-                text,
-                self.server.censors["partial"],
-                self.server.censors["replace"],
-                False,
-            )
-            if len(showname) > 0:
-                showname = censor(
-                    showname,
-                    self.server.censors["whole"],
-                    self.server.censors["replace"],
-                    True,
-                )
-                showname = censor(
-                    showname,
-                    self.server.censors["partial"],
-                    self.server.censors["replace"],
-                    False,
-                )
-        if text.lower().startswith("/a ") or text.lower().startswith("/s "):
-            part = text.split(" ")
+        if self.client.area.area_manager.censor_ic:
+            ms.text = self.server.censors.scrub(ms.text)
+            ms.showname = self.server.censors.scrub(ms.showname)
+        if ms.text.lower().startswith("/a ") or ms.text.lower().startswith("/s "):
+            part = ms.text.split(" ")
             try:
                 areas = part[1].split(",")
                 for a in areas:
@@ -492,17 +482,17 @@ class AOProtocol(asyncio.Protocol):
                 if len(target_area) <= 0:
                     self.client.send_ooc("No target areas found!")
                     return
-                text = " ".join(part)
+                ms.text = " ".join(part)
             except (ValueError, AreaError):
                 self.client.send_ooc("That does not look like a valid area ID!")
                 return
         if len(self.client.area.testimony) > 0 and (
-            text.lstrip().startswith(">") or text.lstrip().startswith("<") or text.lstrip().startswith("=")
+            ms.text.lstrip().startswith(">") or ms.text.lstrip().startswith("<") or ms.text.lstrip().startswith("=")
         ):
             if self.client.area.recording is True:
                 self.client.send_ooc("It is not cross-examination yet!")
                 return
-            cmd = text.strip()
+            cmd = ms.text.strip()
             idx = self.client.area.testimony_index
             if len(cmd) > 1:
                 try:
@@ -526,80 +516,80 @@ class AOProtocol(asyncio.Protocol):
             except Exception:
                 self.client.send_ooc("Invalid index!")
             return
-        if msg_type not in ("chat", "0", "1", "2", "3", "4", "5"):
+        if ms.msg_type not in ("chat", "0", "1", "2", "3", "4", "5"):
             self.client.send_ooc("Your message type is invalid!")
             return
         # Disable the meme functionality of desk_mod that makes you selectively hide
         # jud/hld/hlp foregrounds when showing every other foreground due to how many
         # characters are set up with that by accident, preventing many characters
         # from appearing behind desk for jud unless they were specifically made for it.
-        if msg_type == "chat":
-            msg_type = "1"
+        if ms.msg_type == "chat":
+            ms.msg_type = "1"
         # Invalid emote modifier causes the client to freeze up. Outdated clients send 4, replace it with 6.
         # Fixes https://github.com/AttorneyOnline/tsuserver3/issues/112
-        if emote_mod == 4:
-            emote_mod = 6
-        if emote_mod not in (0, 1, 2, 5, 6):
+        if ms.emote_mod == 4:
+            ms.emote_mod = 6
+        if ms.emote_mod not in (0, 1, 2, 5, 6):
             self.client.send_ooc("Your emote modifier is invalid!")
             return
-        if cid != self.client.char_id:
+        if ms.cid != self.client.char_id:
             self.client.send_ooc("Your character ID is mismatched!")
             return
-        if sfx_delay < 0:
+        if ms.sfx_delay < 0:
             self.client.send_ooc("Your sfx delay is invalid! (can't be less than 0)")
             return
-        if "4" in str(button) and "<and>" not in str(button):
-            if not button.isdigit():
+        if "4" in str(ms.button) and "<and>" not in str(ms.button):
+            if not ms.button.isdigit():
                 self.client.send_ooc("Your Objection is invalid!")
                 return
         if self.client.presenting > 0:
-            evidence = self.client.presenting
+            ms.evidence = self.client.presenting
             self.client.presenting = 0
-        if evidence < 0:
+        if ms.evidence < 0:
             self.client.send_ooc("Your evidence index is invalid!")
             return
-        if ding not in (0, 1):
+        if ms.ding not in (0, 1):
             self.client.send_ooc("Your realization flash is invalid!")
             return
-        if color < 0 or color >= 12:
+        if ms.color < 0 or ms.color >= 12:
             self.client.send_ooc("Your color is invalid!")
             return
-        if len(showname) > 20:
+        if len(ms.showname) > 20:
             self.client.send_ooc("Your IC showname is way too long!")
             return
-        if not self.client.is_mod and showname.lstrip().lower().startswith("[m"):
+        if not self.client.is_mod and ms.showname.lstrip().lower().startswith("[m"):
             self.client.send_ooc("Nice try! You may not spoof [M] tag in your showname.")
             return
-        if (nonint_pre == 1 and button in range(1, 4)) or (
+        if (ms.nonint_pre == 1 and ms.button in range(1, 4)) or (
             self.client.area.non_int_pres_only and not self.client.is_mod and self.client not in self.client.area.owners
         ):
-            if emote_mod == 1 or emote_mod == 2:
-                emote_mod = 0
-                nonint_pre = 1
-            elif emote_mod == 6:
-                emote_mod = 5
-                nonint_pre = 1
+            if ms.emote_mod == 1 or ms.emote_mod == 2:
+                ms.emote_mod = 0
+                ms.nonint_pre = 1
+            elif ms.emote_mod == 6:
+                ms.emote_mod = 5
+                ms.nonint_pre = 1
         if (
             not self.client.area.shouts_allowed
             and not self.client.is_mod
             and self.client not in self.client.area.owners
         ):
             # Old clients communicate the objecting in emote_mod.
-            if emote_mod == 2:
-                emote_mod = 1
-            elif emote_mod == 6:
-                emote_mod = 5
+            if ms.emote_mod == 2:
+                ms.emote_mod = 1
+            elif ms.emote_mod == 6:
+                ms.emote_mod = 5
             # New clients do it in a specific objection message area.
-            button = 0
+            ms.button = 0
             # Turn off the ding.
-            ding = 0
+            ms.ding = 0
         max_char = 0
         try:
             max_char = int(self.server.config["max_chars_ic"])
         except Exception:
             max_char = 256
 
-        if len(text) > max_char:
+        if len(ms.text) > max_char:
             self.client.send_ooc("Your message is too long!")
             return
 
@@ -608,37 +598,37 @@ class AOProtocol(asyncio.Protocol):
             self.server.config["block_repeat"]
             and not self.client.is_mod
             and self.client not in self.client.area.owners
-            and text.strip() != ""
+            and ms.text.strip() != ""
             and self.client.area.last_ic_message is not None
-            and cid == self.client.area.last_ic_message[8]
-            and text == self.client.area.last_ic_message[4]
+            and ms.cid == self.client.area.last_ic_message[8]
+            and ms.text == self.client.area.last_ic_message[4]
         ):
             self.client.send_ooc("Your message is a repeat of the last one, don't spam!")
             return
 
         # We are blankposting.
         if self.client.blankpost:
-            pre = "-"
-            anim = "misc/blank"
+            ms.pre = "-"
+            ms.anim = "misc/blank"
 
-        if pos != "" and self.client.pos != pos:
+        if ms.pos != "" and self.client.pos != ms.pos:
             try:
-                self.client.change_position(pos)
+                self.client.change_position(ms.pos)
             except ClientError:
-                pos = ""
-        if len(self.client.area.pos_lock) > 0 and pos not in self.client.area.pos_lock:
-            pos = self.client.area.pos_lock[0]
+                ms.pos = ""
+        if len(self.client.area.pos_lock) > 0 and ms.pos not in self.client.area.pos_lock:
+            ms.pos = self.client.area.pos_lock[0]
         if self.client.area.dark:
-            pos = self.client.area.pos_dark
+            ms.pos = self.client.area.pos_dark
 
         # We're narrating, or we're hidden in some evidence.
-        if anim == "" or self.client.narrator or self.client.hidden_in is not None:
+        if ms.anim == "" or self.client.narrator or self.client.hidden_in is not None:
             # Reuse same pos
-            pos = ""
+            ms.pos = ""
             # Set anim to narration
-            anim = ""
+            ms.anim = ""
 
-        if text.lower().lstrip().startswith("/w"):
+        if ms.text.lower().lstrip().startswith("/w"):
             if (
                 not self.client.area.can_whisper
                 and not self.client.is_mod
@@ -646,8 +636,8 @@ class AOProtocol(asyncio.Protocol):
             ):
                 self.client.send_ooc("You can't whisper in this area!")
                 return
-            text = text.lstrip()[2:]
-            part = text.lstrip().split(" ")
+            ms.text = ms.text.lstrip()[2:]
+            part = ms.text.lstrip().split(" ")
             try:
                 clients = list(dict.fromkeys(part[0].split(",")))
                 try:
@@ -666,36 +656,25 @@ class AOProtocol(asyncio.Protocol):
                         c for c in self.client.area.clients if c.pos == self.client.pos and not c == self.client
                     ]
                     clients = ""
-                text = " ".join(part)
-                text = "}}}[W" + clients + "] {{{" + text
+                ms.text = " ".join(part)
+                ms.text = "}}}[W" + clients + "] {{{" + ms.text
             except (ValueError, AreaError):
                 self.client.send_ooc("Invalid targets!")
                 return
-        if contains_URL(
-            text.replace("}", "")
-            .replace("{", "")
-            .replace("`", "")
-            .replace("|", "")
-            .replace("~", "")
-            .replace("º", "")
-            .replace("№", "")
-            .replace("√", "")
-            .replace("\\s", "")
-            .replace("\\f", "")
-        ):
+        if contains_ic_link(ms.text):
             self.client.send_ooc("You shouldn't send links in IC!")
             return
 
-        msg = dezalgo(text, self.server.zalgo_tolerance)
+        msg = dezalgo(ms.text, self.server.zalgo_tolerance)
         if self.client.shaken:
             msg = self.client.shake_message(msg)
         if self.client.disemvowel:
             msg = self.client.disemvowel_message(msg)
-        if evidence:
+        if ms.evidence:
             area = self.client.area
             try:
-                evidence = self.client.evi_list[evidence]
-                evi = area.evi_list.evidences[evidence - 1]
+                ms.evidence = self.client.evi_list[ms.evidence]
+                evi = area.evi_list.evidences[ms.evidence - 1]
                 self.client.area.broadcast_ooc(
                     f"[{self.client.id}] {self.client.showname} has presented evidence: {evi.name}."
                 )
@@ -713,12 +692,12 @@ class AOProtocol(asyncio.Protocol):
                 asyncio.get_running_loop().call_soon(evi.trigger, area, "present", self.client)
                 # target_area.trigger('present')
             except IndexError:
-                evidence = 0
+                ms.evidence = 0
         old_showname = self.client.showname
         # Update the showname ref for the client
         if self.client.used_showname_command:
-            showname = self.client.showname
-        self.client.showname = showname
+            ms.showname = self.client.showname
+        self.client.showname = ms.showname
 
         # Here, we check the pair stuff, and save info about it to the client.
         # Notably, while we only get a charid_pair and an offset, we send back a chair_pair, an emote, a talker offset
@@ -726,17 +705,17 @@ class AOProtocol(asyncio.Protocol):
 
         # Only change the charid pair if we're not overriding
         if not self.client.charid_pair_override:
-            self.client.charid_pair = charid_pair
-            self.client.pair_order = pair_order
-        charid_pair = self.client.charid_pair
-        pair_order = self.client.pair_order
-        third_charid = self.client.third_charid
-        self.client.offset_pair = offset_pair
-        if emote_mod not in (5, 6):
-            self.client.last_sprite = anim
-            self.client.last_pre = pre
-        self.client.flip = flip
-        self.client.claimed_folder = folder
+            self.client.charid_pair = ms.charid_pair
+            self.client.pair_order = ms.pair_order
+        ms.charid_pair = self.client.charid_pair
+        ms.pair_order = self.client.pair_order
+        ms.third_charid = self.client.third_charid
+        self.client.offset_pair = ms.offset_pair
+        if ms.emote_mod not in (5, 6):
+            self.client.last_sprite = ms.anim
+            self.client.last_pre = ms.pre
+        self.client.flip = ms.flip
+        self.client.claimed_folder = ms.folder
         other_offset = 0
         other_emote = ""
         other_flip = 0
@@ -747,7 +726,7 @@ class AOProtocol(asyncio.Protocol):
         third_folder = ""
 
         confirmed = False
-        if charid_pair > -1:
+        if ms.charid_pair > -1:
             for target in self.client.area.clients:
                 if (
                     not confirmed
@@ -761,15 +740,15 @@ class AOProtocol(asyncio.Protocol):
                     other_emote = target.last_sprite
                     other_flip = target.flip
                     other_folder = target.claimed_folder
-                    if pair_order != "":
-                        charid_pair = "{}^{}".format(charid_pair, pair_order)
+                    if ms.pair_order != "":
+                        ms.charid_pair = "{}^{}".format(ms.charid_pair, ms.pair_order)
                     break
 
         if not confirmed:
-            charid_pair = -1
+            ms.charid_pair = -1
 
         third_confirmed = False
-        if third_charid > -1:
+        if ms.third_charid > -1:
             for target in self.client.area.clients:
                 if (
                     not third_confirmed
@@ -784,10 +763,10 @@ class AOProtocol(asyncio.Protocol):
                     third_emote = target.last_sprite
                     third_flip = target.flip
                     third_folder = target.claimed_folder
-                    third_charid = "{}^{}".format(third_charid, 0)
+                    ms.third_charid = "{}^{}".format(ms.third_charid, 0)
 
         if not third_confirmed:
-            third_charid = -1
+            ms.third_charid = -1
 
         if self.client.area.auto_pair:
             clients_pos = [c for c in self.client.area.clients if c.pos == self.client.pos]
@@ -805,11 +784,11 @@ class AOProtocol(asyncio.Protocol):
                     client_pair = clients_pos[position - 1]
                     third_client = clients_pos[position - 2]
 
-                charid_pair = f"{client_pair.char_id}^0"
+                ms.charid_pair = f"{client_pair.char_id}^0"
                 other_emote = client_pair.last_sprite
                 other_flip = client_pair.flip
                 other_folder = client_pair.claimed_folder
-                third_charid = f"{third_client.char_id}^0"
+                ms.third_charid = f"{third_client.char_id}^0"
                 third_emote = third_client.last_sprite
                 third_flip = third_client.flip
                 third_folder = third_client.claimed_folder
@@ -823,11 +802,11 @@ class AOProtocol(asyncio.Protocol):
                     and client_pair.last_offset != third_client.last_offset
                     and not self.client.area.auto_pair_cycle
                 ):
-                    offset_pair = self.client.last_offset
+                    ms.offset_pair = self.client.last_offset
                     other_offset = client_pair.last_offset
                     third_offset = third_client.last_offset
                 else:
-                    offset_pair = 0
+                    ms.offset_pair = 0
                     other_offset = -33
                     third_offset = 33
                     self.client.last_offset = 0
@@ -835,21 +814,21 @@ class AOProtocol(asyncio.Protocol):
                     third_client.last_offset = 33
 
             else:
-                offset_pair = 0
+                ms.offset_pair = 0
                 if len(clients_pos) >= 2:
                     if clients_pos.index(self.client) == 0:
                         client_pair = clients_pos[1]
                     else:
                         client_pair = clients_pos[clients_pos.index(self.client) - 1]
                     if self.client.last_offset == -25 or client_pair.last_offset == 25:
-                        offset_pair = -25
+                        ms.offset_pair = -25
                         other_offset = 25
                     else:
-                        offset_pair = 25
+                        ms.offset_pair = 25
                         other_offset = -25
                         self.client.last_offset = 25
                         client_pair.last_offset = -25
-                    charid_pair = client_pair.char_id
+                    ms.charid_pair = client_pair.char_id
                     other_emote = client_pair.last_sprite
                     other_flip = client_pair.flip
                     other_folder = client_pair.claimed_folder
@@ -858,8 +837,8 @@ class AOProtocol(asyncio.Protocol):
         if len(ver) >= 2:
             # Client versions 2.9 or less need to get their SFX corrected due to 2.10 changes
             if ver[0].isnumeric() and int(ver[0]) <= 2 and ver[1].isnumeric() and int(ver[1]) <= 9:
-                if emote_mod not in (1, 6):
-                    sfx = ""
+                if ms.emote_mod not in (1, 6):
+                    ms.sfx = ""
 
         if whisper_clients is not None:
             whisper_clients.insert(0, self.client)
@@ -872,20 +851,20 @@ class AOProtocol(asyncio.Protocol):
         if len(target_area) > 0:
             try:
                 for a in target_area:
-                    add = additive
-                    tempos = pos
-                    tempdeskmod = msg_type
+                    add = ms.additive
+                    tempos = ms.pos
+                    tempdeskmod = ms.msg_type
                     # Additive only works on same-char messages
-                    if additive and (
+                    if ms.additive and (
                         a.last_ic_message is None
-                        or cid != a.last_ic_message[8]
+                        or ms.cid != a.last_ic_message[8]
                         or (a.last_ic_message[4].strip() == "" and a.last_ic_message[28] != 1)
                     ):
-                        additive = 0
+                        ms.additive = 0
                     if len(a.pos_lock) > 0:
                         tempos = a.pos_lock[0]
                     if a.last_ic_message is not None and (
-                        anim == "" or len(a.pos_lock) <= 0 or a.last_ic_message[5] not in a.pos_lock
+                        ms.anim == "" or len(a.pos_lock) <= 0 or a.last_ic_message[5] not in a.pos_lock
                     ):
                         # Use the same pos
                         tempos = a.last_ic_message[5]
@@ -894,41 +873,41 @@ class AOProtocol(asyncio.Protocol):
                     a.send_command(
                         "MS",
                         tempdeskmod,  # 0
-                        pre,  # 1
-                        folder,  # 2
-                        anim,  # 3
+                        ms.pre,  # 1
+                        ms.folder,  # 2
+                        ms.anim,  # 3
                         msg,  # 4
                         tempos,  # 5
-                        sfx,  # 6
-                        emote_mod,  # 7
-                        cid,  # 8
-                        sfx_delay,  # 9
-                        button,  # 10
-                        self.client.evi_list[evidence],  # 11
-                        flip,  # 12
-                        ding,  # 13
-                        color,  # 14
-                        showname,  # 15
-                        charid_pair,  # 16
+                        ms.sfx,  # 6
+                        ms.emote_mod,  # 7
+                        ms.cid,  # 8
+                        ms.sfx_delay,  # 9
+                        ms.button,  # 10
+                        self.client.evi_list[ms.evidence],  # 11
+                        ms.flip,  # 12
+                        ms.ding,  # 13
+                        ms.color,  # 14
+                        ms.showname,  # 15
+                        ms.charid_pair,  # 16
                         other_folder,  # 17
                         other_emote,  # 18
-                        offset_pair,  # 19
+                        ms.offset_pair,  # 19
                         other_offset,  # 20
                         other_flip,  # 21
-                        nonint_pre,  # 22
-                        sfx_looping,  # 23
-                        screenshake,  # 24
-                        frames_shake,  # 25
-                        frames_realization,  # 26
-                        frames_sfx,  # 27
+                        ms.nonint_pre,  # 22
+                        ms.sfx_looping,  # 23
+                        ms.screenshake,  # 24
+                        ms.frames_shake,  # 25
+                        ms.frames_realization,  # 26
+                        ms.frames_sfx,  # 27
                         add,  # 28
-                        effect,  # 29
-                        third_charid,  # 30
+                        ms.effect,  # 29
+                        ms.third_charid,  # 30
                         third_folder,  # 31
                         third_emote,  # 32
                         third_offset,  # 33
                         third_flip,  # 33
-                        video,  # 34
+                        ms.video,  # 34
                     )
                 a_list = ", ".join([str(a.id) for a in target_area])
                 if self.client.area not in target_area:
@@ -936,42 +915,42 @@ class AOProtocol(asyncio.Protocol):
                         msg = " "
                     self.client.send_command(
                         "MS",
-                        msg_type,
-                        pre,
-                        folder,
-                        anim,
+                        ms.msg_type,
+                        ms.pre,
+                        ms.folder,
+                        ms.anim,
                         "}}}[" + a_list + "] {{{" + msg,
-                        pos,
-                        sfx,
-                        emote_mod,
-                        cid,
-                        sfx_delay,
-                        button,
-                        self.client.evi_list[evidence],
-                        flip,
-                        ding,
-                        color,
-                        showname,
-                        charid_pair,
+                        ms.pos,
+                        ms.sfx,
+                        ms.emote_mod,
+                        ms.cid,
+                        ms.sfx_delay,
+                        ms.button,
+                        self.client.evi_list[ms.evidence],
+                        ms.flip,
+                        ms.ding,
+                        ms.color,
+                        ms.showname,
+                        ms.charid_pair,
                         other_folder,
                         other_emote,
-                        offset_pair,
+                        ms.offset_pair,
                         other_offset,
                         other_flip,
-                        nonint_pre,
-                        sfx_looping,
-                        screenshake,
-                        frames_shake,
-                        frames_realization,
-                        frames_sfx,
+                        ms.nonint_pre,
+                        ms.sfx_looping,
+                        ms.screenshake,
+                        ms.frames_shake,
+                        ms.frames_realization,
+                        ms.frames_sfx,
                         add,
-                        effect,
-                        third_charid,
+                        ms.effect,
+                        ms.third_charid,
                         third_folder,
                         third_emote,
                         third_offset,
                         third_flip,
-                        video,
+                        ms.video,
                     )
                 self.client.send_ooc(f"Broadcasting to areas {a_list}")
             except (AreaError, ValueError):
@@ -986,7 +965,7 @@ class AOProtocol(asyncio.Protocol):
             delay = self.client.area.parse_msg_delay(msg)
             self.client.area.next_message_time = round(time.time() * 1000.0 + delay)
             if (
-                text.strip() != ""
+                ms.text.strip() != ""
                 or self.client.area.last_ic_message is None
                 or self.client.area.last_ic_message[4].strip() != ""
             ):
@@ -998,45 +977,21 @@ class AOProtocol(asyncio.Protocol):
                     and self.client.area.id == self.server.bridgebot.area_id
                 ):
                     webname = self.client.char_name
-                    if showname != "" and showname != self.client.area.area_manager.char_list[cid]:
-                        webname = f"{showname} ({webname})"
-                    # you'll hate me for this
-                    txt = (
-                        msg.replace("}", "")
-                        .replace("{", "")
-                        .replace("`", "")
-                        .replace("|", "")
-                        .replace("~", "")
-                        .replace("º", "")
-                        .replace("№", "")
-                        .replace("√", "")
-                        .replace("\\s", "")
-                        .replace("\\f", "")
-                    )
-                    # escape chars
-                    txt = txt.replace("@", "@\u200b")  # The only way to escape a Discord ping is a zero width space...
-                    txt = txt.replace("<num>", "\\#")
-                    txt = txt.replace("<and>", "&")
-                    txt = txt.replace("<percent>", "%")
-                    txt = txt.replace("<dollar>", "$")
-                    txt = txt.replace("*", "\\*")
-                    txt = txt.replace("_", "\\_")
-                    # String is empty if we're strippin
-                    if not txt.strip():
-                        # Discord blankpost
-                        txt = "_ _"
-                    self.server.bridgebot.queue_message(webname, txt, self.client.char_name, anim)
+                    if ms.showname != "" and ms.showname != self.client.area.area_manager.char_list[ms.cid]:
+                        webname = f"{ms.showname} ({webname})"
+                    txt = ic_to_discord(msg)
+                    self.server.bridgebot.queue_message(webname, txt, self.client.char_name, ms.anim)
 
         # Check if the message can be considered to contain actions in it
-        if text.lstrip().startswith("*") or "[" in text or "|" in text or color == 3:
+        if ms.text.lstrip().startswith("*") or "[" in ms.text or "|" in ms.text or ms.color == 3:
             is_action = True
             # * at the end is "correction", don't count it as action
             if (
-                "[" not in text
-                and "|" not in text
-                and color != 3
-                and text.count("*") == 1
-                and text.rstrip().endswith("*")
+                "[" not in ms.text
+                and "|" not in ms.text
+                and ms.color != 3
+                and ms.text.count("*") == 1
+                and ms.text.rstrip().endswith("*")
             ):
                 is_action = False
 
@@ -1045,12 +1000,12 @@ class AOProtocol(asyncio.Protocol):
                 # msg = "}}}[❗] {{{" + text
                 if whisper_clients is None:
                     # This also sends the message across the GM clients
-                    self.client.area.broadcast_action(self.client, text)
+                    self.client.area.broadcast_action(self.client, ms.text)
 
         # Check whether or not the reserved character for Emote Tags is in the message
-        if "¨" in text:
-            emote = anim  # We'll use this variable for storing each new emote in our message
-            messages = text.split("¨")
+        if "¨" in ms.text:
+            emote = ms.anim  # We'll use this variable for storing each new emote in our message
+            messages = ms.text.split("¨")
             separator = " "
 
             # Iterate through the split message
@@ -1064,9 +1019,9 @@ class AOProtocol(asyncio.Protocol):
                     ]  # Update the emote variable with what we found inside the parentheses
                 else:
                     # If we swap emotes after a full stop, we add the separator variable (\p\p\p) to make it less abrupt
-                    text = stripped_message + separator if stripped_message.endswith(".") else stripped_message + " "
+                    ms.text = stripped_message + separator if stripped_message.endswith(".") else stripped_message + " "
                     emote_value = (
-                        anim if index == 0 else emote
+                        ms.anim if index == 0 else emote
                     )  # Use 'anim' if it's the first message, otherwise use the emote variable
                     additive_value = (
                         0 if index == 0 else 1
@@ -1074,134 +1029,134 @@ class AOProtocol(asyncio.Protocol):
 
                     self.client.area.send_ic(
                         self.client,
-                        msg_type,
-                        pre,
-                        folder,
+                        ms.msg_type,
+                        ms.pre,
+                        ms.folder,
                         emote_value,
-                        text,
-                        pos,
-                        sfx,
-                        emote_mod,
-                        cid,
-                        sfx_delay,
-                        button,
-                        self.client.evi_list[evidence],
-                        flip,
-                        ding,
-                        color,
-                        showname,
-                        charid_pair,
+                        ms.text,
+                        ms.pos,
+                        ms.sfx,
+                        ms.emote_mod,
+                        ms.cid,
+                        ms.sfx_delay,
+                        ms.button,
+                        self.client.evi_list[ms.evidence],
+                        ms.flip,
+                        ms.ding,
+                        ms.color,
+                        ms.showname,
+                        ms.charid_pair,
                         other_folder,
                         other_emote,
-                        offset_pair,
+                        ms.offset_pair,
                         other_offset,
                         other_flip,
-                        nonint_pre,
-                        sfx_looping,
-                        screenshake,
-                        frames_shake,
-                        frames_realization,
-                        frames_sfx,
+                        ms.nonint_pre,
+                        ms.sfx_looping,
+                        ms.screenshake,
+                        ms.frames_shake,
+                        ms.frames_realization,
+                        ms.frames_sfx,
                         additive_value,
-                        effect,
+                        ms.effect,
                         None,
-                        third_charid,
+                        ms.third_charid,
                         third_folder,
                         third_emote,
                         third_offset,
                         third_flip,
-                        video,
+                        ms.video,
                     )
 
             return
 
         # Additive only works on same-char messages
-        if additive and (
+        if ms.additive and (
             self.client.area.last_ic_message is None
-            or cid != self.client.area.last_ic_message[8]
+            or ms.cid != self.client.area.last_ic_message[8]
             or (self.client.area.last_ic_message[4].strip() == "" and self.client.area.last_ic_message[28] != 1)
         ):
-            additive = 0
+            ms.additive = 0
 
         self.client.area.send_ic(
             client=self.client,
-            msg_type=msg_type,
-            pre=pre,
-            folder=folder,
-            anim=anim,
+            msg_type=ms.msg_type,
+            pre=ms.pre,
+            folder=ms.folder,
+            anim=ms.anim,
             msg=msg,
-            pos=pos,
-            sfx=sfx,
-            emote_mod=emote_mod,
-            cid=cid,
-            sfx_delay=sfx_delay,
-            button=button,
-            evidence=evidence,
-            flip=flip,
-            ding=ding,
-            color=color,
-            showname=showname,
-            charid_pair=charid_pair,
+            pos=ms.pos,
+            sfx=ms.sfx,
+            emote_mod=ms.emote_mod,
+            cid=ms.cid,
+            sfx_delay=ms.sfx_delay,
+            button=ms.button,
+            evidence=ms.evidence,
+            flip=ms.flip,
+            ding=ms.ding,
+            color=ms.color,
+            showname=ms.showname,
+            charid_pair=ms.charid_pair,
             other_folder=other_folder,
             other_emote=other_emote,
-            offset_pair=offset_pair,
+            offset_pair=ms.offset_pair,
             other_offset=other_offset,
             other_flip=other_flip,
-            nonint_pre=nonint_pre,
-            sfx_looping=sfx_looping,
-            screenshake=screenshake,
-            frames_shake=frames_shake,
-            frames_realization=frames_realization,
-            frames_sfx=frames_sfx,
-            additive=additive,
-            effect=effect,
+            nonint_pre=ms.nonint_pre,
+            sfx_looping=ms.sfx_looping,
+            screenshake=ms.screenshake,
+            frames_shake=ms.frames_shake,
+            frames_realization=ms.frames_realization,
+            frames_sfx=ms.frames_sfx,
+            additive=ms.additive,
+            effect=ms.effect,
             targets=whisper_clients,
-            third_charid=third_charid,
+            third_charid=ms.third_charid,
             third_folder=third_folder,
             third_emote=third_emote,
             third_offset=third_offset,
             third_flip=third_flip,
-            video=video,
+            video=ms.video,
         )
         self.client.area.send_owner_ic(
             self.client.area.background,
             "MS",
-            msg_type,
-            pre,
-            folder,
-            anim,
+            ms.msg_type,
+            ms.pre,
+            ms.folder,
+            ms.anim,
             "}}}[" + str(self.client.area.id) + "] {{{" + msg,
-            pos,
-            sfx,
-            emote_mod,
-            cid,
-            sfx_delay,
-            button,
-            evidence,
-            flip,
-            ding,
-            color,
-            showname,
-            charid_pair,
+            ms.pos,
+            ms.sfx,
+            ms.emote_mod,
+            ms.cid,
+            ms.sfx_delay,
+            ms.button,
+            ms.evidence,
+            ms.flip,
+            ms.ding,
+            ms.color,
+            ms.showname,
+            ms.charid_pair,
             other_folder,
             other_emote,
-            offset_pair,
+            ms.offset_pair,
             other_offset,
             other_flip,
-            nonint_pre,
-            sfx_looping,
-            screenshake,
-            frames_shake,
-            frames_realization,
-            frames_sfx,
-            additive,
-            effect,
-            third_charid,
+            ms.nonint_pre,
+            ms.sfx_looping,
+            ms.screenshake,
+            ms.frames_shake,
+            ms.frames_realization,
+            ms.frames_sfx,
+            ms.additive,
+            ms.effect,
+            ms.third_charid,
             third_folder,
             third_emote,
             third_offset,
             third_flip,
-            video,
+            ms.video,
         )
 
         # DRO client support
@@ -1252,38 +1207,11 @@ class AOProtocol(asyncio.Protocol):
             return
 
         # Scrub text and OOC name for bad words, even if you're trying to pass bad words to a command as args.
-        if (
-            self.client.area.area_manager.censor_ooc
-            and self.server.censors is not None
-            and len(self.server.censors) > 0
-        ):
+        if self.client.area.area_manager.censor_ooc:
             # Censor the name
-            args[0] = censor(
-                args[0],
-                self.server.censors["whole"],
-                self.server.censors["replace"],
-                True,
-            )
-            args[0] = censor(
-                args[0],
-                self.server.censors["partial"],
-                self.server.censors["replace"],
-                False,
-            )
-
+            args[0] = self.server.censors.scrub(args[0])
             # Censor the text
-            args[1] = censor(
-                args[1],
-                self.server.censors["whole"],
-                self.server.censors["replace"],
-                True,
-            )
-            args[1] = censor(
-                args[1],
-                self.server.censors["partial"],
-                self.server.censors["replace"],
-                False,
-            )
+            args[1] = self.server.censors.scrub(args[1])
 
         if not self.client.is_valid_name(args[0]):
             self.client.send_ooc("Your OOC name is invalid!")
@@ -1356,19 +1284,7 @@ class AOProtocol(asyncio.Protocol):
                 preflist = self.client.server.supported_features.copy()
                 preflist.remove("arup")
                 self.client.send_command("FL", *preflist)
-                for hub in self.client.server.hub_manager.hubs:
-                    count = 0
-                    for c in hub.clients:
-                        if not c.area.hide_clients and not c.hidden:
-                            count = count + 1
-                    hub.count = count
-                self.client.send_command(
-                    "FA",
-                    *[
-                        "🌐 Hubs 🌐\n Double-Click me to see Areas\n  _______",
-                        *[f"[{hub.id}] {hub.name} (users: {hub.count})" for hub in self.client.server.hub_manager.hubs],
-                    ],
-                )
+                self.client.send_command("FA", *self.client.server.hub_manager.get_hub_list())
                 return
             if args[0].split("\n")[0] == "🌐 Hubs 🌐":
                 # self.client.send_ooc('Switching to the list of Areas...')
@@ -1498,12 +1414,13 @@ class AOProtocol(asyncio.Protocol):
                     lst[14] = 3
                     statement = tuple(lst)
                     targets = self.client.area.clients
+                    cache = {}
                     for c in targets:
                         # Blinded clients don't receive IC messages
                         if c.blinded:
                             continue
                         # Ignore those losers with listenpos for testimony
-                        c.send_command("MS", *statement)
+                        c.send_command("MS", *statement, cache=cache)
 
     def net_cmd_setcase(self, args):
         """Sets the casing preferences of the given client.
@@ -1752,8 +1669,9 @@ class AOProtocol(asyncio.Protocol):
         # TODO: Think if it is a desired behaviour or not.
         if args[0] in (0, 1):
             clients = (c for c in self.client.area.clients if c.id != self.client.id)
+            cache = {}
             for c in clients:
-                c.send_command("TT", args[0], args[1], args[2])
+                c.send_command("TT", args[0], args[1], args[2], cache=cache)
 
     def net_cmd_cu(self, args):
         """
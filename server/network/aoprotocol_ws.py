@@ -1,18 +1,46 @@
 import asyncio
+import logging
 
 from websockets import ConnectionClosed
 
 from server.network.aoprotocol import AOProtocol
 
+logger = logging.getLogger("aoprotocol_ws")
+
 
 class AOProtocolWS(AOProtocol):
     """A websocket wrapper around AOProtocol."""
 
     class TransportWrapper:
-        """A class to wrap asyncio's Transport class."""
+        """
+        A class to wrap asyncio's Transport class.
+
+        Like a TCP transport, it tells the protocol to pause writing once more
+        than the high watermark is queued and to resume once the writer gets
+        it under the low watermark, so slow websocket clients get the same
+        backpressure as everyone else.
+        """
 
-        def __init__(self, websocket):
+        def __init__(self, websocket, max_queue, protocol=None):
             self.ws = websocket
+            self.protocol = protocol
+            # Lists of encoded packets waiting for the writer, None closes the connection
+            self.queue = asyncio.Queue(max_queue)
+            self.queued_bytes = 0
+            self.high_water = 0
+            self.low_water = 0
+            self.paused = False
+            self.closing = False
+            self.writer = asyncio.ensure_future(self.ws_writer())
+
+        def set_write_buffer_limits(self, high=None, low=None):
+            """
+            Set the watermarks for pausing and resuming the protocol's writing.
+            :param high: queued bytes over which writing is paused, 0 or None to never pause
+            :param low: queued bytes under which writing resumes
+            """
+            self.high_water = high or 0
+            self.low_water = low if low is not None else self.high_water // 4
 
         def get_extra_info(self, key):
             """Get extra info about the client.
@@ -25,32 +53,82 @@ class AOProtocolWS(AOProtocol):
             if remote_address[0] == "127.0.0.1":
                 # See if proxy
                 try:
-                    remote_address = (self.ws.request_headers["X-Forwarded-For"], 0)
+                    remote_address = (self.ws.request.headers["X-Forwarded-For"], 0)
                 except Exception:
                     pass
             info = {"peername": remote_address}
             return info[key]
 
+        def get_write_buffer_size(self):
+            """Get the amount of bytes queued or buffered for this connection."""
+            return self.queued_bytes + self.ws.transport.get_write_buffer_size()
+
         def write(self, message):
-            """Write message to the socket.
+            """Queue a message for the writer task.
 
             :param message: message in bytes
 
             """
-            message = message.decode("utf-8")
-            asyncio.ensure_future(self.ws_try_writing_message(message))
+            self.writelines([message])
+
+        def writelines(self, packets):
+            """
+            Queue packets for the writer task, each is sent as its own frame.
+            :param packets: list of encoded packets
+            """
+            if self.closing:
+                return
+            try:
+                self.queue.put_nowait(packets)
+            except asyncio.QueueFull:
+                logger.warning("Disconnecting websocket client %s, send queue is full", self.ws.remote_address)
+                self.abort()
+                return
+            self.queued_bytes += sum(len(packet) for packet in packets)
+            if not self.paused and self.high_water and self.queued_bytes > self.high_water:
+                self.paused = True
+                if self.protocol is not None:
+                    self.protocol.pause_writing()
+
+        def is_closing(self):
+            """Whether the connection is closed or being closed."""
+            return self.closing
 
         def close(self):
-            """Disconnect the client by force."""
-            asyncio.ensure_future(self.ws.close())
+            """Disconnect the client once everything queued has been sent."""
+            if self.closing:
+                return
+            self.closing = True
+            try:
+                self.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                self.abort()
+
+        def abort(self):
+            """Disconnect the client by force, throwing away anything queued."""
+            self.closing = True
+            self.writer.cancel()
+            self.ws.transport.abort()
 
-        async def ws_try_writing_message(self, message):
+        async def ws_writer(self):
             """
-            Try writing the message if the client has not already closed
-            the connection.
+            Send queued packets in order, one per frame, since web clients
+            read each frame as a single packet.
             """
             try:
-                await self.ws.send(message)
+                while True:
+                    packets = await self.queue.get()
+                    if packets is None:
+                        await self.ws.close()
+                        return
+                    for packet in packets:
+                        # The packets are already UTF-8, send them as a text frame as-is
+                        await self.ws.send(packet, text=True)
+                        self.queued_bytes -= len(packet)
+                    if self.paused and self.queued_bytes <= self.low_water:
+                        self.paused = False
+                        if self.protocol is not None:
+                            self.protocol.resume_writing()
             except ConnectionClosed:
                 return
 
@@ -63,15 +141,18 @@ class AOProtocolWS(AOProtocol):
 
     def ws_on_connect(self):
         """Handle a new client connection."""
-        self.connection_made(self.TransportWrapper(self.ws))
+        self.ws_transport = self.TransportWrapper(self.ws, self.server.config["websocket_queue_size"], self)
+        self.connection_made(self.ws_transport)
 
     async def ws_handle(self):
         try:
-            data = await self.ws.recv()
+            # Take the frame as bytes, data_received would only encode it again
+            data = await self.ws.recv(decode=False)
             self.data_received(data)
         except Exception as exc:
             # Any event handled in data_received could raise any exception
             self.ws_connected = False
+            self.ws_transport.writer.cancel()
             self.connection_lost(exc)
 
 
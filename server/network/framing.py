@@ -0,0 +1,69 @@
+"""Incremental framing of the AO byte stream into `#%`-terminated packets."""
+
+TERMINATOR = b"#%"
+
+
+class PacketFramer:
+    """
+    Splits a stream of received bytes into AO packets without re-scanning
+    or copying data that has already been looked at.
+
+    Frames are handed out as memoryview slices of the internal buffer and are
+    only valid until the next frame is requested. The buffer is compacted once
+    per `feed` call instead of once per packet.
+    """
+
+    def __init__(self, max_size):
+        # Largest allowed frame in bytes, not counting the terminator
+        self.max_size = max_size
+        self.buffer = bytearray()
+        # How far into the buffer we've already searched for a terminator
+        self.scanned = 0
+        # Whether we're skipping the rest of an oversized frame
+        self.discarding = False
+        # Total amount of frames dropped for being oversized
+        self.dropped = 0
+
+    def feed(self, data):
+        """
+        Append received bytes and yield every complete frame.
+        :param data: bytes received from the network
+        :returns: yields memoryview slices, one per packet
+        """
+        if data:
+            # Null bytes are never valid in a packet, strip them from the new chunk only
+            self.buffer += data.replace(b"\0", b"")
+        buf = self.buffer
+        view = memoryview(buf)
+        start = 0
+        try:
+            while True:
+                # Back up one byte in case the terminator was split across reads
+                end = buf.find(TERMINATOR, max(start, self.scanned - 1))
+                if end == -1:
+                    self.scanned = len(buf)
+                    break
+                frame_start = start
+                start = self.scanned = end + len(TERMINATOR)
+                if self.discarding:
+                    # This is the tail end of a frame we already dropped
+                    self.discarding = False
+                    continue
+                if end - frame_start > self.max_size:
+                    self.dropped += 1
+                    continue
+                frame = view[frame_start:end]
+                try:
+                    yield frame
+                finally:
+                    frame.release()
+        finally:
+            view.release()
+            del buf[:start]
+            self.scanned -= start
+            if len(buf) > self.max_size:
+                # The pending frame is already too big, so stop buffering it
+                buf.clear()
+                self.scanned = 0
+                self.discarding = True
+                self.dropped += 1
@@ -1,6 +1,7 @@
 """Parser for MS (IC message) network commands."""
 
 from enum import Enum
+from operator import itemgetter
 
 
 class ArgType(Enum):
@@ -86,54 +87,171 @@ _DEFAULTS = {
     "pair_order": 0,
     "third_charid": -1,
     "video": "",
+    "blankpost": 0,
 }
 
 
-def _validate(args, fields):
-    """Check if args match the field types and convert INTs in place."""
-    if len(args) != len(fields):
-        return False
-    for i, (name, typ) in enumerate(fields):
-        if len(str(args[i])) == 0 and typ != ArgType.STR_OR_EMPTY:
-            return False
-        if typ == ArgType.INT:
-            try:
-                args[i] = int(args[i])
-            except ValueError:
-                return False
-    return True
+class ICMessage:
+    """A parsed MS message. Fields the sender's protocol doesn't have hold their defaults."""
+
+    __slots__ = (
+        "msg_type",
+        "pre",
+        "folder",
+        "anim",
+        "text",
+        "pos",
+        "sfx",
+        "emote_mod",
+        "cid",
+        "sfx_delay",
+        "button",
+        "evidence",
+        "flip",
+        "ding",
+        "color",
+        "showname",
+        "charid_pair",
+        "offset_pair",
+        "nonint_pre",
+        "sfx_looping",
+        "screenshake",
+        "frames_shake",
+        "frames_realization",
+        "frames_sfx",
+        "additive",
+        "effect",
+        "pair_order",
+        "third_charid",
+        "video",
+        "blankpost",
+    )
+
+    def __init__(
+        self,
+        msg_type,
+        pre,
+        folder,
+        anim,
+        text,
+        pos,
+        sfx,
+        emote_mod,
+        cid,
+        sfx_delay,
+        button,
+        evidence,
+        flip,
+        ding,
+        color,
+        showname,
+        charid_pair,
+        offset_pair,
+        nonint_pre,
+        sfx_looping,
+        screenshake,
+        frames_shake,
+        frames_realization,
+        frames_sfx,
+        additive,
+        effect,
+        pair_order,
+        third_charid,
+        video,
+        blankpost,
+    ):
+        self.msg_type = msg_type
+        self.pre = pre
+        self.folder = folder
+        self.anim = anim
+        self.text = text
+        self.pos = pos
+        self.sfx = sfx
+        self.emote_mod = emote_mod
+        self.cid = cid
+        self.sfx_delay = sfx_delay
+        self.button = button
+        self.evidence = evidence
+        self.flip = flip
+        self.ding = ding
+        self.color = color
+        self.showname = showname
+        self.charid_pair = charid_pair
+        self.offset_pair = offset_pair
+        self.nonint_pre = nonint_pre
+        self.sfx_looping = sfx_looping
+        self.screenshake = screenshake
+        self.frames_shake = frames_shake
+        self.frames_realization = frames_realization
+        self.frames_sfx = frames_sfx
+        self.additive = additive
+        self.effect = effect
+        self.pair_order = pair_order
+        self.third_charid = third_charid
+        self.video = video
+        self.blankpost = blankpost
+
+
+class _Schema:
+    """A protocol layout compiled down to the indices parse_ms has to look at."""
+
+    __slots__ = ("name", "required", "ints", "extra", "getter", "needs_pair_parsing")
+
+    def __init__(self, name, fields, needs_pair_parsing):
+        self.name = name
+        self.needs_pair_parsing = needs_pair_parsing
+        self.required = tuple(i for i, (_, typ) in enumerate(fields) if typ != ArgType.STR_OR_EMPTY)
+        self.ints = tuple(i for i, (_, typ) in enumerate(fields) if typ == ArgType.INT)
+        # Defaults for the fields this layout lacks are appended after the args,
+        # so a single itemgetter lays everything out in ICMessage order.
+        names = [name for name, _ in fields]
+        missing = [name for name in ICMessage.__slots__ if name not in names]
+        self.extra = [_DEFAULTS[name] for name in missing]
+        positions = names + missing
+        self.getter = itemgetter(*(positions.index(name) for name in ICMessage.__slots__))
+
+
+# Every layout has a distinct argument count, so the count alone picks the schema
+_SCHEMAS_BY_COUNT = {len(fields): _Schema(name, fields, pair) for name, fields, pair in _SCHEMAS}
 
 
 def parse_ms(args):
-    """Parse MS message arguments into a dict.
+    """Parse MS message arguments into an ICMessage.
 
-    Tries protocol schemas from most complete to least complete.
+    The protocol version is picked by the amount of arguments sent.
 
     :param args: raw arguments from the MS network command
-    :returns: dict with all MS fields, or None if parsing failed
+    :returns: ICMessage with all MS fields, or None if parsing failed
     """
-    for schema_name, fields, needs_pair_parsing in _SCHEMAS:
-        if _validate(args, fields):
-            ms = {f[0]: args[i] for i, f in enumerate(fields)}
-
-            # Fill defaults for missing optional fields
-            for key, default in _DEFAULTS.items():
-                ms.setdefault(key, default)
-
-            # DRO normalizes ding to 0 or 1
-            if schema_name == "dro" and ms["ding"] != 1:
-                ms["ding"] = 0
-
-            # 2.8+ encodes pair_order in charid_pair as "id^order"
-            if needs_pair_parsing:
-                try:
-                    pair_args = ms["charid_pair"].split("^")
-                    ms["charid_pair"] = int(pair_args[0])
-                    if len(pair_args) > 1:
-                        ms["pair_order"] = pair_args[1]
-                except ValueError:
-                    return None
-
-            return ms
-
-    return None
+    schema = _SCHEMAS_BY_COUNT.get(len(args))
+    if schema is None:
+        return None
+
+    values = list(args)
+    for i in schema.required:
+        if values[i] == "":
+            return None
+    try:
+        for i in schema.ints:
+            values[i] = int(values[i])
+    except ValueError:
+        return None
+
+    # DRO normalizes ding to 0 or 1
+    if schema.name == "dro" and values[13] != 1:
+        values[13] = 0
+
+    values += schema.extra
+    ms = ICMessage(*schema.getter(values))
+
+    # 2.8+ encodes pair_order in charid_pair as "id^order"
+    if schema.needs_pair_parsing:
+        pair_args = ms.charid_pair.split("^")
+        try:
+            ms.charid_pair = int(pair_args[0])
+        except ValueError:
+            return None
+        if len(pair_args) > 1:
+            ms.pair_order = pair_args[1]
+
+    return ms
@@ -0,0 +1,105 @@
+"""Token bucket rate limiting for floodguards and incoming packets."""
+
+import time
+
+
+class RateLimit:
+    """
+    How often an action may be done: `times_per_interval` times every
+    `interval_length` seconds, in bursts of up to `times_per_interval`.
+    Going over the limit mutes the action for `mute_length` seconds, or,
+    if that's 0, just until there's room again.
+    """
+
+    __slots__ = ("capacity", "mute_length", "rate")
+
+    def __init__(self, times_per_interval, interval_length, mute_length=0):
+        self.capacity = times_per_interval
+        self.rate = times_per_interval / interval_length
+        self.mute_length = mute_length
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build a limit from a floodguard config section.
+        :param config: dict with times_per_interval, interval_length and optionally mute_length
+        :returns: RateLimit, or None if the section doesn't limit anything
+        """
+        if config["interval_length"] <= 0 or config["times_per_interval"] <= 0:
+            return None
+        return cls(config["times_per_interval"], config["interval_length"], config.get("mute_length", 0))
+
+
+class RateLimiter:
+    """
+    Token buckets keyed by (ipid, action), so every client from the same
+    IPID shares one budget per action. Each check is a handful of float
+    operations on a single bucket, whatever the limit looks like.
+    """
+
+    def __init__(self, limits=None):
+        # action -> RateLimit
+        self.limits = {}
+        # (ipid, action) -> [tokens left, when tokens was last updated, muted until]
+        self.buckets = {}
+        self.rejected = 0
+        if limits is not None:
+            self.configure(limits)
+
+    def configure(self, limits):
+        """
+        Replace the limits, keeping the state of buckets whose action is still limited.
+        :param limits: dict of action -> floodguard config section
+        """
+        self.limits = {}
+        for action, config in limits.items():
+            limit = RateLimit.from_config(config)
+            if limit is not None:
+                self.limits[action] = limit
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if key[1] in self.limits}
+
+    def check(self, ipid, action, now=None):
+        """
+        Spend one use of an action if there's one left.
+        :param ipid: IPID doing the action
+        :param action: action name, see configure
+        :param now: current time.monotonic(), for tests
+        :returns: 0 if the action is allowed, otherwise how many seconds to wait
+        """
+        limit = self.limits.get(action)
+        if limit is None:
+            return 0
+        if now is None:
+            now = time.monotonic()
+        bucket = self.buckets.get((ipid, action))
+        if bucket is None:
+            self.buckets[ipid, action] = [limit.capacity - 1, now, 0.0]
+            return 0
+        tokens, updated, muted_until = bucket
+        if now < muted_until:
+            self.rejected += 1
+            return muted_until - now
+        tokens = min(limit.capacity, tokens + (now - updated) * limit.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0
+        bucket[0] = tokens
+        self.rejected += 1
+        if limit.mute_length:
+            bucket[2] = now + limit.mute_length
+            return limit.mute_length
+        return (1 - tokens) / limit.rate
+
+    def prune(self, now=None):
+        """Forget buckets that have filled back up, they're the same as a new one."""
+        if now is None:
+            now = time.monotonic()
+        full = [
+            key
+            for key, (tokens, updated, muted_until) in self.buckets.items()
+            if now >= muted_until
+            and tokens + (now - updated) * self.limits[key[1]].rate >= self.limits[key[1]].capacity
+        ]
+        for key in full:
+            del self.buckets[key]
@@ -0,0 +1,89 @@
+"""
+Cleaning up IC and OOC text: blankpost detection, link detection and
+escaping for Discord, shared by the IC/OOC handlers and the bridgebot.
+
+Every step is a str.translate or str.replace over a table built once at
+import, so each one is a single pass in C instead of a chain of Python calls
+or a regex compiled per message.
+"""
+
+from server.constants import contains_URL, dezalgo, remove_URL
+
+# Characters that don't count towards a message's length when checking for blankposts
+BLANKPOST_CHARACTERS = str.maketrans("", "", "{}\\`|(~) ")
+
+# AO2 text formatting characters, removed before looking for links or sending to Discord
+FORMATTING_CHARACTERS = "}{`|~º№√"
+STRIP_FORMATTING = str.maketrans("", "", FORMATTING_CHARACTERS)
+# Formatting escapes that are two characters long
+FORMATTING_ESCAPES = ("\\s", "\\f")
+
+# Characters with a meaning in Discord markdown, plus @ so nobody can ping from IC
+DISCORD_ESCAPES = str.maketrans({"@": "@\u200b", "*": "\\*", "_": "\\_"})
+# AO packet escapes, turned back into what they stand for on Discord
+DISCORD_PACKET_ESCAPES = (("<num>", "\\#"), ("<and>", "&"), ("<percent>", "%"), ("<dollar>", "$"))
+
+# Escaping text coming from Discord so AO2 shows formatting characters as they are
+ESCAPE_FORMATTING = str.maketrans({char: "\\" + char for char in FORMATTING_CHARACTERS})
+
+
+def is_blankpost(text):
+    """
+    Check whether an IC message is a blankpost: empty, or shorter than three
+    characters once formatting and spaces are left out (unless it's centered or
+    right aligned with <, > or =).
+    :param text: IC message
+    """
+    if text.strip() == "":
+        return True
+    return len(text.translate(BLANKPOST_CHARACTERS)) < 3 and not text.startswith(("<", ">", "="))
+
+
+def strip_formatting(text):
+    """
+    Remove AO2 text formatting characters from a message.
+    :param text: IC message
+    :returns: the message without formatting
+    """
+    text = text.translate(STRIP_FORMATTING)
+    for escape in FORMATTING_ESCAPES:
+        if escape in text:
+            text = text.replace(escape, "")
+    return text
+
+
+def contains_ic_link(text):
+    """
+    Check whether an IC message starts with a link, even one broken up with formatting characters.
+    :param text: IC message
+    """
+    return contains_URL(strip_formatting(text))
+
+
+def ic_to_discord(text):
+    """
+    Turn an IC message into something that shows the same on Discord.
+    :param text: IC message, after dezalgo
+    :returns: Discord message, "_ _" for blankposts
+    """
+    text = strip_formatting(text).translate(DISCORD_ESCAPES)
+    if "<" in text:
+        for escape, char in DISCORD_PACKET_ESCAPES:
+            text = text.replace(escape, char)
+    if not text.strip():
+        # Discord blankpost
+        return "_ _"
+    return text
+
+
+def discord_to_ic(text):
+    """
+    Turn a Discord message into an IC message, without links or formatting.
+    :param text: Discord message
+    :returns: IC message
+    """
+    text = remove_URL(dezalgo(text)).translate(ESCAPE_FORMATTING)
+    for escape in FORMATTING_ESCAPES:
+        if escape in text:
+            text = text.replace(escape, "")
+    return text
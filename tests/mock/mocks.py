@@ -29,6 +29,10 @@ class MockClient:
         msg += "#%"
         self.transport.write(msg.encode("utf-8"))
 
+    # AOProtocol drops pending output once the connection is lost
+    def drop_output(self) -> None:
+        pass
+
     # AOProtocol may call disconnect when timeouts happen
     def disconnect(self) -> None:
         try:
@@ -57,7 +61,12 @@ class MockServer:
     """
 
     def __init__(self, timeout: float = 1.0, client_factory: Optional[Callable] = None):
-        self.config = {"timeout": timeout}
+        self.config = {
+            "timeout": timeout,
+            "outbound_high_water": 256 * 1024,
+            "outbound_low_water": 64 * 1024,
+            "websocket_queue_size": 16,
+        }
         self.client_manager = MockClientManager()
         self._client_factory = client_factory or (lambda transport: MockClient(transport))
 
@@ -0,0 +1,137 @@
+import asyncio
+from unittest.mock import MagicMock
+
+from websockets import ConnectionClosed
+
+from server.network.aoprotocol_ws import AOProtocolWS
+
+
+class FakeWebSocket:
+    """Records what the writer sends, optionally blocking until released."""
+
+    def __init__(self):
+        self.remote_address = ("10.0.0.1", 1234)
+        self.transport = MagicMock()
+        self.transport.get_write_buffer_size.return_value = 0
+        self.sent = []
+        self.closed = False
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def send(self, message, text=None):
+        await self.gate.wait()
+        if self.closed:
+            raise ConnectionClosed(None, None)
+        self.sent.append((message, text))
+
+    async def close(self):
+        self.closed = True
+
+
+def test_writes_are_sent_in_order_as_text():
+    async def _run():
+        ws = FakeWebSocket()
+        transport = AOProtocolWS.TransportWrapper(ws, 16)
+        transport.write(b"CT#a#1#%")
+        await asyncio.sleep(0)
+        transport.write(b"CT#a#2#%")
+        await asyncio.sleep(0)
+        assert ws.sent == [(b"CT#a#1#%", True), (b"CT#a#2#%", True)]
+        assert transport.get_write_buffer_size() == 0
+        transport.abort()
+
+    asyncio.run(_run())
+
+
+def test_writes_queued_during_a_send_are_sent_as_separate_frames():
+    async def _run():
+        ws = FakeWebSocket()
+        ws.gate.clear()
+        transport = AOProtocolWS.TransportWrapper(ws, 16)
+        transport.write(b"BN#gs4#%")
+        await asyncio.sleep(0)
+        transport.write(b"MS#1#%")
+        transport.write(b"CT#a#b#%")
+        assert transport.get_write_buffer_size() == len(b"BN#gs4#%MS#1#%CT#a#b#%")
+        ws.gate.set()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        # Still one packet per frame, web clients don't split them
+        assert ws.sent == [(b"BN#gs4#%", True), (b"MS#1#%", True), (b"CT#a#b#%", True)]
+        transport.abort()
+
+    asyncio.run(_run())
+
+
+def test_close_sends_queued_writes_first():
+    async def _run():
+        ws = FakeWebSocket()
+        transport = AOProtocolWS.TransportWrapper(ws, 16)
+        transport.write(b"BD#Banned#%")
+        transport.close()
+        transport.write(b"CT#a#b#%")
+        await asyncio.wait_for(transport.writer, 1)
+        assert ws.sent == [(b"BD#Banned#%", True)]
+        assert ws.closed
+
+    asyncio.run(_run())
+
+
+def test_full_queue_drops_the_connection():
+    async def _run():
+        ws = FakeWebSocket()
+        ws.gate.clear()
+        transport = AOProtocolWS.TransportWrapper(ws, 2)
+        for _ in range(4):
+            transport.write(b"CT#a#b#%")
+        ws.transport.abort.assert_called_once()
+        await asyncio.sleep(0)
+        assert transport.writer.cancelled()
+
+    asyncio.run(_run())
+
+
+def test_is_closing_after_close():
+    async def _run():
+        transport = AOProtocolWS.TransportWrapper(FakeWebSocket(), 16)
+        assert not transport.is_closing()
+        transport.close()
+        assert transport.is_closing()
+        transport.abort()
+
+    asyncio.run(_run())
+
+
+def test_queue_over_high_water_pauses_protocol():
+    async def _run():
+        ws = FakeWebSocket()
+        ws.gate.clear()
+        protocol = MagicMock()
+        transport = AOProtocolWS.TransportWrapper(ws, 16, protocol)
+        transport.set_write_buffer_limits(high=20, low=10)
+        transport.write(b"CT#a#1234567890#%")
+        protocol.pause_writing.assert_not_called()
+        transport.write(b"CT#a#1234567890#%")
+        protocol.pause_writing.assert_called_once()
+        ws.gate.set()
+        for _ in range(4):
+            await asyncio.sleep(0)
+        protocol.resume_writing.assert_called_once()
+        transport.abort()
+
+    asyncio.run(_run())
+
+
+def test_writelines_sends_each_packet_as_a_frame():
+    async def _run():
+        ws = FakeWebSocket()
+        transport = AOProtocolWS.TransportWrapper(ws, 16)
+        transport.writelines([b"BN#gs4#%", b"CT#a#b#%"])
+        assert transport.queue.qsize() == 1
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert ws.sent == [(b"BN#gs4#%", True), (b"CT#a#b#%", True)]
+        assert transport.get_write_buffer_size() == 0
+        transport.abort()
+
+    asyncio.run(_run())
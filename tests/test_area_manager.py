@@ -0,0 +1,246 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from server.area_manager import AreaManager
+from server.client import Client
+from server.constants import encode_ao_command
+from server.exceptions import AreaError
+from server.network.aoprotocol import AOProtocol
+
+
+def _make_hub():
+    """Build a hub on top of a mocked hub manager and server."""
+    hub_manager = MagicMock()
+    hub_manager.server.char_list = ["Phoenix", "Edgeworth"]
+    hub_manager.clients = set()
+    hub_manager.server.client_manager.clients = set()
+    hub_manager.server.client_manager.spectator_count = 0
+    return AreaManager(hub_manager, "Hub 0")
+
+
+def test_join_packet_is_encoded_once():
+    hub = _make_hub()
+    with patch("server.area_manager.encode_ao_command", wraps=encode_ao_command) as encode:
+        first = hub.join_packet(("SC",), lambda: ("SC", hub.char_list))
+        second = hub.join_packet(("SC",), lambda: ("SC", hub.char_list))
+    assert first == second == b"SC#Phoenix#Edgeworth#%"
+    assert encode.call_count == 1
+
+
+def test_send_characters_uses_join_cache():
+    hub = _make_hub()
+    clients = [MagicMock(), MagicMock()]
+    for client in clients:
+        hub.send_characters(client)
+        client.send_raw_bytes.assert_called_once_with(b"SC#Phoenix#Edgeworth#%")
+    assert hub.join_cache == {("SC",): b"SC#Phoenix#Edgeworth#%"}
+
+
+def test_music_changes_invalidate_join_cache():
+    hub = _make_hub()
+    area = hub.create_area()
+    for change in (
+        lambda: setattr(hub, "music_list", [{"category": "==Music=="}]),
+        lambda: setattr(area, "music_list", [{"category": "==Music=="}]),
+        hub.clear_music,
+        area.clear_music,
+    ):
+        hub.join_packet(("FL", True), lambda: ("FL", ["arup"]))
+        version = hub.join_cache_version
+        change()
+        assert hub.join_cache == {}
+        assert hub.join_cache_version == version + 1
+
+
+def test_areas_with_the_same_lists_share_the_music_packet():
+    hub = _make_hub()
+    areas = [hub.create_area() for _ in range(2)]
+    for area in areas:
+        protocol = AOProtocol(hub.server)
+        protocol.client = MagicMock(area=area, music_ref="", is_mod=False)
+        protocol.client.server.hub_manager.hubs = [hub]
+        protocol.client.get_area_list.return_value = areas
+        protocol.client.music_view.return_value = MagicMock(key=(1, 2), names=["==Music=="], music_list=[])
+        protocol.net_cmd_rm([])
+    assert list(hub.join_cache) == [("SM", ("Area 0", "Area 1"), (1, 2))]
+
+
+def test_area_ids_follow_create_remove_and_swap():
+    hub = _make_hub()
+    areas = [hub.create_area() for _ in range(4)]
+    assert [a.id for a in areas] == [0, 1, 2, 3]
+
+    hub.swap_area(areas[1], areas[3])
+    assert [a.id for a in hub.areas] == [0, 1, 2, 3]
+    assert hub.get_area_by_id(1) is areas[3]
+
+    hub.remove_area(areas[2])
+    assert areas[2].id == -1
+    assert [a.id for a in hub.areas] == [0, 1, 2]
+    assert hub.get_area_by_id(2) is areas[1]
+
+
+def test_area_lookups_follow_renames():
+    hub = _make_hub()
+    first, second = hub.create_area(), hub.create_area()
+    second.name = "Courtroom 1"
+    assert hub.get_area_by_name("courtroom 1") is second
+    assert hub.get_area_by_abbreviation("CR1") is second
+    assert hub.get_area_by_abbreviation("A0") is first
+
+    second.name = "Lobby"
+    assert hub.get_area_by_name("Lobby", case_insensitive=False) is second
+    for lookup, key in (
+        (hub.get_area_by_name, "Courtroom 1"),
+        (hub.get_area_by_abbreviation, "CR1"),
+        (hub.get_area_by_id, 2),
+        (hub.get_area_by_id, -1),
+    ):
+        with pytest.raises(AreaError):
+            lookup(key)
+
+
+def test_area_lookup_prefers_first_duplicate():
+    hub = _make_hub()
+    first, second = hub.create_area(), hub.create_area()
+    first.name = second.name = "Lobby"
+    assert hub.get_area_by_name("lobby") is first
+    hub.swap_area(first, second)
+    assert hub.get_area_by_name("lobby") is second
+
+
+def _make_client(hub, user_id=0):
+    """Build a Client registered with the hub's mocked server."""
+    server = hub.server
+    transport = MagicMock()
+    transport.writelines.side_effect = lambda packets: transport.write(b"".join(packets))
+    client = Client(server, transport, user_id, user_id)
+    server.client_manager.clients.add(client)
+    return client
+
+
+@patch("server.area.database", MagicMock())
+def test_hub_membership_follows_area_changes():
+    hub = _make_hub()
+    first, second = hub.create_area(), hub.create_area()
+    clients = [_make_client(hub, 0), _make_client(hub, 1)]
+    for client in clients:
+        client.area = first
+        first.new_client(client)
+    assert hub.clients == hub.hub_manager.clients == set(clients)
+
+    first.remove_client(clients[0])
+    clients[0].area = second
+    second.new_client(clients[0])
+    assert hub.clients == set(clients)
+
+    second.remove_client(clients[0])
+    first.remove_client(clients[1])
+    assert hub.clients == hub.hub_manager.clients == set()
+
+
+@patch("server.area.database", MagicMock())
+def test_hub_counts_follow_client_visibility():
+    hub = _make_hub()
+    area = hub.create_area()
+    client = _make_client(hub)
+    client.area = area
+    area.new_client(client)
+    # Hasn't picked a character yet
+    assert (hub.count, hub.unhidden_count) == (0, 0)
+
+    client.char_id = 1
+    assert (hub.count, hub.unhidden_count) == (1, 1)
+
+    area.hide_clients = True
+    assert (hub.count, hub.unhidden_count) == (0, 1)
+    area.hide_clients = False
+    assert (hub.count, hub.unhidden_count) == (1, 1)
+
+    client._hidden = True
+    client.update_visibility()
+    assert (hub.count, hub.unhidden_count) == (0, 0)
+    client._hidden = False
+    client.update_visibility()
+
+    area.remove_client(client)
+    assert (hub.count, hub.unhidden_count) == (0, 0)
+
+
+def test_spectator_count_follows_char_id():
+    hub = _make_hub()
+    client = _make_client(hub)
+    client_manager = hub.server.client_manager
+    client.char_id = -1
+    assert client_manager.spectator_count == 1
+    client.char_id = -1
+    assert client_manager.spectator_count == 1
+    client.char_id = 0
+    assert client_manager.spectator_count == 0
+
+
+def _arup_written(client):
+    """ARUP packets written to a client, in order."""
+    written = b"".join(call.args[0] for call in client.transport.write.call_args_list)
+    return [packet for packet in written.split(b"%") if packet.startswith(b"ARUP#")]
+
+
+@patch("server.area.database", MagicMock())
+def test_arup_sends_each_client_its_own_view():
+    hub = _make_hub()
+    first, second, third = hub.create_area(), hub.create_area(), hub.create_area()
+    clients = [_make_client(hub, 0), _make_client(hub, 1)]
+    for client, area in zip(clients, (first, second)):
+        client.area = area
+        area.new_client(client)
+        client.char_id = client.id
+    clients[0].local_area_list = [first, second, third]
+    clients[1].local_area_list = [second, third]
+    third.status = "CASING"
+
+    hub.send_arup_players()
+    hub.send_arup_status()
+    assert _arup_written(clients[0]) == [b"ARUP#0#1#1#0#", b"ARUP#1###CASING#"]
+    assert _arup_written(clients[1]) == [b"ARUP#0#1#0#", b"ARUP#1##CASING#"]
+
+
+@patch("server.area.database", MagicMock())
+def test_arup_skips_unchanged_views():
+    hub = _make_hub()
+    area = hub.create_area()
+    client = _make_client(hub)
+    client.area = area
+    area.new_client(client)
+    client.local_area_list = [area]
+
+    hub.send_arup_lock()
+    hub.send_arup_lock()
+    assert _arup_written(client) == [b"ARUP#3##"]
+
+    area.locked = True
+    hub.send_arup_lock()
+    # Sending to a specific client always goes through, their area list may have been rebuilt
+    hub.send_arup_lock([client])
+    assert _arup_written(client) == [b"ARUP#3##", b"ARUP#3#LOCKED#", b"ARUP#3#LOCKED#"]
+
+
+@patch("server.area.database", MagicMock())
+def test_arup_coalesces_changes_within_delay():
+    hub = _make_hub()
+    area = hub.create_area()
+    client = _make_client(hub)
+    hub.server.config = {"arup_delay": 0.01}
+    client.area = area
+    area.new_client(client)
+    client.local_area_list = [area]
+
+    async def change_status():
+        for status in ("CASING", "RECESS", "LOOKING-FOR-PLAYERS"):
+            area.status = status
+            hub.send_arup_status()
+        await asyncio.sleep(0.05)
+
+    asyncio.run(change_status())
+    assert _arup_written(client) == [b"ARUP#1#LOOKING-FOR-PLAYERS#"]
@@ -0,0 +1,84 @@
+import random
+import re
+import string
+
+from server.censor import Censor
+
+
+def _legacy_censor(text, censor_list, replace="*", whole_words=True):
+    """The per-word re.sub loop constants.censor used before Censor, kept for comparison."""
+    if censor_list is None or len(censor_list) <= 0:
+        return text
+    regex = r"%s"
+    if whole_words:
+        regex = r"\b%s\b"
+    for word in censor_list:
+        text = re.sub(regex % word, len(word) * replace, text, flags=re.IGNORECASE)
+    return text
+
+
+def _legacy_scrub(text, whole, partial):
+    return _legacy_censor(_legacy_censor(text, whole, "*", True), partial, "*", False)
+
+
+def _random_word(rng):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10)))
+
+
+def _sample(seed=0, words=800, messages=200):
+    """A censor list about the size of ours, and chat messages with some censored words mixed in."""
+    rng = random.Random(seed)
+    whole = [_random_word(rng) for _ in range(words // 2)]
+    partial = [_random_word(rng) for _ in range(words // 2)]
+    vocabulary = [_random_word(rng) for _ in range(2000)]
+    texts = []
+    for i in range(messages):
+        text = [rng.choice(vocabulary) for _ in range(rng.randint(3, 25))]
+        if i % 3 == 0:
+            text.insert(rng.randrange(len(text)), rng.choice(whole).upper())
+        if i % 4 == 0:
+            text.insert(rng.randrange(len(text)), f"x{rng.choice(partial)}y!")
+        if i % 5 == 0:
+            text.insert(rng.randrange(len(text)), f"{rng.choice(whole)}ing")
+        texts.append(" ".join(text))
+    return whole, partial, texts
+
+
+def test_whole_and_partial_words():
+    censor = Censor(whole=["butt"], partial=["heck"], replace="#")
+    assert censor.scrub("Butt, butts and rebutt") == "####, butts and rebutt"
+    assert censor.scrub("What the HECK, checkmate") == "What the ####, c####mate"
+    assert censor.scrub("nothing to see") == "nothing to see"
+
+
+def test_overlapping_words_are_both_censored():
+    censor = Censor(partial=["ab", "bcd"])
+    assert censor.scrub("xabcdx abd") == "x****x **d"
+
+
+def test_regex_entries_still_work():
+    censor = Censor(whole=["b[a4]d"], partial=["fo+"], replace="*")
+    assert censor.scrub("b4d bad badge fooo") == "*** *** badge ****"
+    # Invalid entries are skipped instead of breaking every message
+    assert Censor(partial=["(", "heck"]).scrub("heck(") == "****("
+
+
+def test_regex_entries_replace_what_they_matched():
+    # The old loop put in as many characters as the regex itself had, whatever it matched
+    censor = Censor(whole=["b[a4]d"], partial=["fo+"])
+    assert censor.scrub("bad fooooo") == "*** ******"
+    assert _legacy_scrub("bad fooooo", ["b[a4]d"], ["fo+"]) == "****** ***"
+
+
+def test_from_config():
+    assert Censor.from_config(None).scrub("anything") == "anything"
+    censor = Censor.from_config({"whole": ["darn"], "partial": None, "replace": "-"})
+    assert censor.scrub("darn it") == "---- it"
+
+
+def test_matches_legacy_censor():
+    whole, partial, texts = _sample(seed=1, words=60)
+    texts += ["Some_words", "punctuation, everywhere... x", "ÜBER über", ""]
+    censor = Censor(whole, partial)
+    for text in texts:
+        assert censor.scrub(text) == _legacy_scrub(text, whole, partial)
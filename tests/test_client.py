@@ -0,0 +1,225 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+from server.client import Client
+from server.client_manager import ClientManager
+from server.constants import encode_ao_command
+from server.music import MusicIndex, MusicViews, music_versions
+
+_FLOODGUARD = {"times_per_interval": 1, "interval_length": 0, "mute_length": 0}
+
+
+def _make_client(user_id=0, software=""):
+    """Build a Client on top of a mocked server, area and transport."""
+    server = MagicMock()
+    server.config = {
+        "music_change_floodguard": _FLOODGUARD,
+        "wtce_floodguard": _FLOODGUARD,
+        "ooc_floodguard": _FLOODGUARD,
+        "slow_client_timeout": 30,
+        "slow_client_max_buffer": 1024,
+        "timer_resync_interval": 60,
+    }
+    transport = MagicMock()
+    transport.get_write_buffer_size.return_value = 0
+    # Like asyncio's TCP transports, which join the buffers into one write
+    transport.writelines.side_effect = lambda packets: transport.write(b"".join(packets))
+    client = Client(server, transport, user_id, user_id)
+    client.area.last_ic_message = None
+    client.area.pos_lock = []
+    client.software = software
+    return client
+
+
+def _ms_args(pos="wit"):
+    return ("1", "-", "Phoenix", "normal", "Hello", pos, "", 0, 0, 0, 0, 0, 0, 0, 0)
+
+
+def test_send_command_writes_encoded_packet():
+    client = _make_client()
+    client.send_command("CT", "name", "msg")
+    client.transport.write.assert_called_once_with(b"CT#name#msg#%")
+
+
+def test_broadcast_cache_encodes_each_variant_once():
+    clients = [_make_client(0), _make_client(1), _make_client(2, software="DRO")]
+    cache = {}
+    with patch("server.client.encode_ao_command", wraps=encode_ao_command) as encode:
+        for c in clients:
+            c.send_command("MS", *_ms_args(), cache=cache)
+    # One MS for the AO clients, plus the JSN and rewritten MS for the DRO client
+    assert encode.call_count == 3
+    assert clients[0].transport.write.call_args == clients[1].transport.write.call_args
+    assert clients[2].transport.write.call_count == 2
+
+
+def test_broadcast_cache_matches_uncached_output():
+    cached, uncached = _make_client(0), _make_client(1)
+    cached.send_command("MS", *_ms_args(), cache={})
+    uncached.send_command("MS", *_ms_args())
+    assert cached.transport.write.call_args == uncached.transport.write.call_args
+
+
+def test_broadcast_cache_skips_unhashable_args():
+    client = _make_client()
+    cache = {}
+    client.send_command("LP", ["1", "Phoenix"], cache=cache)
+    client.transport.write.assert_called_once_with(b"LP#['1', 'Phoenix']#%")
+    assert cache == {}
+
+
+def test_broadcast_cache_tells_equal_args_of_other_types_apart():
+    clients = [_make_client(0), _make_client(1), _make_client(2)]
+    cache = {}
+    for c, flag in zip(clients, (1, True, 1.0)):
+        c.send_command("ZZ", flag, cache=cache)
+    clients[0].transport.write.assert_called_once_with(b"ZZ#1#%")
+    clients[1].transport.write.assert_called_once_with(b"ZZ#True#%")
+    clients[2].transport.write.assert_called_once_with(b"ZZ#1.0#%")
+
+
+def test_music_packet_dropped_without_multilayer_audio():
+    client = _make_client()
+    cache = {}
+    client.send_command("MC", "ambience.ogg", -1, "", 1, 1, 0, cache=cache)
+    client.transport.write.assert_not_called()
+    assert client.playing_audio == ["", ""]
+
+
+def test_writes_coalesce_until_the_loop_runs():
+    async def _run():
+        client = _make_client()
+        client.send_command("BN", "gs4")
+        client.send_command("CT", "name", "msg")
+        client.transport.write.assert_not_called()
+        await asyncio.sleep(0)
+        client.transport.write.assert_called_once_with(b"BN#gs4#%CT#name#msg#%")
+
+    asyncio.run(_run())
+
+
+def test_flush_writes_queued_packets_right_away():
+    async def _run():
+        client = _make_client()
+        client.send_command("BN", "gs4")
+        client.send_command("CHECK", flush=True)
+        client.transport.write.assert_called_once_with(b"BN#gs4#%CHECK#%")
+        await asyncio.sleep(0)
+        client.transport.write.assert_called_once()
+
+    asyncio.run(_run())
+
+
+def test_disconnect_flushes_before_closing():
+    async def _run():
+        client = _make_client()
+        client.send_command("BD", "Banned")
+        client.disconnect()
+        client.transport.write.assert_called_once_with(b"BD#Banned#%")
+        client.transport.close.assert_called_once()
+
+    asyncio.run(_run())
+
+
+def test_paused_client_skips_non_essential_packets():
+    async def _run():
+        client = _make_client()
+        client.pause_writing()
+        client.send_command("TT", 0, "", 0)
+        client.send_command("CT", "name", "msg", flush=True)
+        client.transport.write.assert_called_once_with(b"CT#name#msg#%")
+        assert client.dropped_packets == 1
+
+        client.resume_writing()
+        assert client.slow_client_handle is None
+        client.send_command("TT", 0, "", 0, flush=True)
+        assert client.transport.write.call_count == 2
+
+    asyncio.run(_run())
+
+
+def test_slow_client_dropped_over_max_buffer():
+    async def _run():
+        client = _make_client()
+        client.pause_writing()
+        client.transport.get_write_buffer_size.return_value = 2048
+        client.send_command("CT", "name", "msg", flush=True)
+        client.transport.abort.assert_called_once()
+        assert not client.write_paused
+
+    asyncio.run(_run())
+
+
+def test_slow_client_dropped_after_timeout():
+    async def _run():
+        client = _make_client()
+        client.server.config["slow_client_timeout"] = 0.01
+        client.pause_writing()
+        await asyncio.sleep(0.05)
+        client.transport.abort.assert_called_once()
+
+    asyncio.run(_run())
+
+
+def test_keepalive_sweeper_drops_silent_clients():
+    client = _make_client()
+    quiet = _make_client(1)
+    manager = ClientManager.__new__(ClientManager)
+    manager.clients = {client, quiet}
+    quiet.transport.is_closing.return_value = False
+    client.transport.is_closing.return_value = False
+    quiet.last_seen -= 300
+    assert manager.disconnect_stale(250) == [quiet]
+    quiet.transport.abort.assert_called_once()
+    client.transport.abort.assert_not_called()
+    # Still in the list until connection_lost, but not disconnected again
+    quiet.transport.is_closing.return_value = True
+    assert manager.disconnect_stale(250) == []
+    quiet.transport.abort.assert_called_once()
+
+
+def test_timer_resent_only_when_changed_or_drifted():
+    client = _make_client()
+    timer = MagicMock()
+    client.area.timers = [timer]
+    client.send_timer_set_time(1, 60000, True)
+    assert client.timer_in_sync(1, timer, 59500, True)
+    # Paused, moved by a few seconds, or a different area's timer
+    assert not client.timer_in_sync(1, timer, 60000, False)
+    assert not client.timer_in_sync(1, timer, 55000, True)
+    assert not client.timer_in_sync(1, MagicMock(), 60000, True)
+
+    client.server.config["timer_resync_interval"] = 0
+    assert not client.timer_in_sync(1, timer, 60000, True)
+    # Paused and hidden timers don't drift
+    client.send_timer_set_time(1, 30000, False)
+    assert client.timer_in_sync(1, timer, 30000, False)
+    client.send_timer_set_time(1, None, False)
+    assert client.timer_in_sync(1, timer, None, False)
+    # A new format or interval has to be sent even if the time is the same
+    timer.format = "mm:ss"
+    assert not client.timer_in_sync(1, timer, None, False)
+
+
+def test_refresh_music_compares_versions_and_shares_packet():
+    music_list = [{"category": "==Music==", "songs": [{"name": "song.opus"}]}]
+    server_music = MagicMock(
+        music_list=music_list, music_index=MusicIndex(music_list), music_version=next(music_versions)
+    )
+    views = MusicViews()
+    clients = [_make_client(0), _make_client(1)]
+    for c in clients:
+        c.server.music_views = views
+        c.area.music_sources.return_value = [server_music]
+        c.area.client_music = False
+        c.refresh_music()
+    packet = clients[0].transport.write.call_args[0][0]
+    assert packet == b"FM#==Music==#song.opus#%"
+    assert clients[1].transport.write.call_args[0][0] is packet
+
+    # Same versions, nothing to send
+    clients[0].refresh_music()
+    assert clients[0].transport.write.call_count == 1
+    server_music.music_version = next(music_versions)
+    clients[0].refresh_music()
+    assert clients[0].transport.write.call_count == 2
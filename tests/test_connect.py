@@ -1,5 +1,8 @@
 import asyncio
 
+import websockets
+
+from server.network.aoprotocol_ws import new_websocket_client
 from tests.mock.mocks import MockServer, make_protocol_factory
 
 
@@ -32,3 +35,25 @@ def test_client_can_connect_and_receive_handshake():
             await srv.wait_closed()
 
     asyncio.run(_run())
+
+
+def test_websocket_client_receives_handshake_as_text():
+    """
+    Same as above over a websocket, the handshake must arrive as a text frame
+    since webAO doesn't read binary ones.
+    """
+
+    async def _run():
+        mock_server = MockServer(timeout=1)
+        srv = await websockets.serve(new_websocket_client(mock_server), "127.0.0.1", 0)
+
+        try:
+            port = srv.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://127.0.0.1:{port}") as ws:
+                data = await asyncio.wait_for(ws.recv(), timeout=1.0)
+                assert data == "decryptor#NOENCRYPT#%"
+        finally:
+            srv.close()
+            await srv.wait_closed()
+
+    asyncio.run(_run())
@@ -3,6 +3,7 @@ from server.constants import (
     contains_URL,
     derelative,
     dezalgo,
+    encode_ao_command,
     encode_ao_packet,
     remove_URL,
 )
@@ -45,6 +46,14 @@ def test_encode_ao_packet_replaces_specials():
     assert encoded[1] == "plain"
 
 
+def test_encode_ao_command_serializes_packet():
+    assert encode_ao_command("CT", ("name", "50% #1", 1)) == b"CT#name#50<percent> <num>1#1#%"
+    # Evidence entries are joined with &
+    assert encode_ao_command("LE", (("a", "b&c", "d"),)) == b"LE#a&b<and>c&d#%"
+    # Commands without arguments still end with #%
+    assert encode_ao_command("DONE", ()) == b"DONE#%"
+
+
 def test_derelative_removes_parent_traversal():
     s = "../../etc/passwd"
     assert ".." not in derelative(s)
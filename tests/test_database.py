@@ -0,0 +1,229 @@
+import asyncio
+import sqlite3
+from unittest.mock import MagicMock
+
+import arrow
+import pytest
+
+from server import database as database_module
+from server.database import Database, EventWriter
+
+
+def _make_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE area_event_types(type_id INTEGER PRIMARY KEY, type_name TEXT UNIQUE NOT NULL);
+        CREATE TABLE misc_event_types(type_id INTEGER PRIMARY KEY, type_name TEXT UNIQUE NOT NULL);
+        CREATE TABLE misc_events(event_subtype INTEGER NOT NULL REFERENCES misc_event_types(type_id), data TEXT);
+        INSERT INTO misc_event_types(type_id, type_name) VALUES (1, 'start'), (2, 'stop');
+        """
+    )
+    conn.close()
+
+
+def _rows(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute(
+        "SELECT type_name, data FROM misc_events JOIN misc_event_types ON event_subtype = type_id "
+        "ORDER BY misc_events.rowid"
+    ).fetchall()
+    conn.close()
+    return rows
+
+
+def _make_database(path):
+    """Build a Database on top of a bare test schema, without migrations or an event writer."""
+    database = Database.__new__(Database)
+    database.db = sqlite3.connect(path)
+    database.db.row_factory = sqlite3.Row
+    database.atoms = {}
+    database.load_atoms()
+    return database
+
+
+_INSERT = "INSERT INTO misc_events(event_subtype, data) VALUES (?, ?)"
+
+
+def test_event_writer_writes_queued_events(tmp_path):
+    path = tmp_path / "db.sqlite3"
+    _make_db(path)
+    writer = EventWriter(path, batch_interval=0.01)
+    for i in range(50):
+        writer.put(_INSERT, (1 if i % 2 else 2, str(i)))
+    writer.flush()
+    assert _rows(path) == [("start" if i % 2 else "stop", str(i)) for i in range(50)]
+    assert (writer.written, writer.depth) == (50, 0)
+    writer.close()
+
+
+def test_event_writer_keeps_batch_when_a_row_fails(tmp_path):
+    path = tmp_path / "db.sqlite3"
+    _make_db(path)
+    writer = EventWriter(path)
+    writer.put(_INSERT, (1, "before"))
+    # Unknown subtype, breaks the foreign key
+    writer.put(_INSERT, (3, "bad"))
+    writer.put(_INSERT, (1, "after"))
+    writer.put("INSERT INTO missing_table VALUES (?)", (1,))
+    writer.put(_INSERT, (2, "last"))
+    writer.close()
+    assert _rows(path) == [("start", "before"), ("start", "after"), ("stop", "last")]
+    assert (writer.written, writer.failed) == (3, 2)
+
+
+def test_event_writer_drops_events_when_full(tmp_path):
+    path = tmp_path / "db.sqlite3"
+    _make_db(path)
+    writer = EventWriter(path, queue_size=1)
+    # Pretend the writer thread is running but stuck, so the queue fills up
+    writer.thread = True
+    for i in range(3):
+        writer.put(_INSERT, (1, str(i)))
+    assert (writer.depth, writer.dropped) == (1, 2)
+
+
+def test_event_writer_close_writes_everything(tmp_path):
+    path = tmp_path / "db.sqlite3"
+    _make_db(path)
+    writer = EventWriter(path, batch_interval=10)
+    writer.put(_INSERT, (2, "last"))
+    writer.close()
+    assert _rows(path) == [("stop", "last")]
+    # Anything logged after shutting down is ignored
+    writer.put(_INSERT, (2, "late"))
+    assert writer.depth == 0
+
+
+def test_subtype_atoms_come_from_memory(tmp_path):
+    path = tmp_path / "db.sqlite3"
+    _make_db(path)
+    database = _make_database(path)
+    statements = []
+    database.db.set_trace_callback(statements.append)
+
+    assert database._subtype_atom("misc", "stop") == 2
+    assert statements == []
+
+    new_id = database._subtype_atom("area", "area.join")
+    assert database._subtype_atom("area", "area.join") == new_id
+    assert len([sql for sql in statements if "INSERT" in sql]) == 1
+    assert _make_database(path).atoms[("area", "area.join")] == new_id
+
+
+def test_handshake_identities_come_from_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(database_module, "DB_FILE", str(tmp_path / "db.sqlite3"))
+    database = Database()
+    statements = []
+    database.db.set_trace_callback(statements.append)
+
+    ipid = database.ipid("203.0.113.5")
+    assert database.ipid("203.0.113.6") == ipid + 1
+    # Only new IPs are written on the spot
+    assert [statement for statement in statements if "INSERT" in statement] == [
+        "\nINSERT INTO ipids(ipid, ip_address) VALUES (1, '203.0.113.5')\n",
+        "\nINSERT INTO ipids(ipid, ip_address) VALUES (2, '203.0.113.6')\n",
+    ]
+    statements.clear()
+    assert database.ipid("203.0.113.5") == ipid
+    database.add_hdid(ipid, "hdid")
+    assert database.find_connection_ban(ipid, "hdid") is None
+    assert statements == []
+
+    # The new HDID is saved in the background
+    database.shutdown()
+    reloaded = Database()
+    assert reloaded.ip_ipids == {"203.0.113.5": ipid, "203.0.113.6": ipid + 1}
+    assert reloaded.hdid_ipids == {"hdid": {ipid}}
+    reloaded.shutdown()
+
+
+def test_failed_ipid_write_hands_out_nothing(tmp_path, monkeypatch):
+    monkeypatch.setattr(database_module, "DB_FILE", str(tmp_path / "db.sqlite3"))
+    database = Database()
+    ipid = database.ipid("203.0.113.5")
+    # Someone else took the next IPID behind our back
+    with database.db as conn:
+        conn.execute("INSERT INTO ipids(ipid, ip_address) VALUES (?, ?)", (ipid + 1, "203.0.113.9"))
+
+    with pytest.raises(sqlite3.IntegrityError):
+        database.ipid("203.0.113.6")
+    assert "203.0.113.6" not in database.ip_ipids
+    assert database.next_ipid == ipid + 1
+    database.shutdown()
+
+
+def test_ban_index_follows_ban_and_unban(tmp_path, monkeypatch):
+    monkeypatch.setattr(database_module, "DB_FILE", str(tmp_path / "db.sqlite3"))
+    database = Database()
+    ipid = database.ipid("203.0.113.5")
+    mod = MagicMock(ipid=database.ipid("203.0.113.6"))
+
+    ban_id = database.ban(ipid, "spam", banned_by=mod)
+    database.ban("hdid", "spam", ban_type="hdid", ban_id=ban_id)
+    assert database.find_connection_ban(ipid, None).ban_id == ban_id
+    assert database.find_connection_ban(None, "hdid").ban_id == ban_id
+
+    # /unban passes the ID as typed
+    assert database.unban(str(ban_id))
+    assert database.find_connection_ban(ipid, "hdid") is None
+    assert (database.ipid_bans, database.hdid_bans) == ({}, {})
+    database.shutdown()
+
+
+def test_ban_does_not_wait_for_the_event_writer(tmp_path, monkeypatch):
+    monkeypatch.setattr(database_module, "DB_FILE", str(tmp_path / "db.sqlite3"))
+    database = Database()
+    ipid = database.ipid("203.0.113.5")
+    mod = MagicMock(ipid=database.ipid("203.0.113.6"))
+    # The HDID is still waiting to be written
+    database.events.put = MagicMock(return_value=True)
+    database.add_hdid(ipid, "hdid")
+    database.events.flush = MagicMock(side_effect=AssertionError("ban waited on the queue"))
+
+    ban_id = database.ban("hdid", "spam", ban_type="hdid", banned_by=mod)
+    assert database.find_connection_ban(None, "hdid").ban_id == ban_id
+    database.shutdown()
+
+
+def test_expired_bans_are_lifted_in_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(database_module, "DB_FILE", str(tmp_path / "db.sqlite3"))
+    database = Database()
+    mod = MagicMock(ipid=database.ipid("203.0.113.1"))
+    past = arrow.get().shift(seconds=-1).datetime
+    future = arrow.get().shift(hours=1).datetime
+    expired = database.ban(database.ipid("203.0.113.5"), "spam", banned_by=mod, unban_date=past)
+    lifted = database.ban(database.ipid("203.0.113.6"), "spam", banned_by=mod, unban_date=past)
+    pending = database.ban(database.ipid("203.0.113.7"), "spam", banned_by=mod, unban_date=future)
+    database.unban(lifted)
+
+    database.lift_expired_bans()
+    assert database.find_ban(ban_id=expired) is None
+    assert database.find_ban(ban_id=pending) is not None
+    assert list(database.unban_dates) == [pending]
+    assert [ban_id for _, ban_id in database.unban_heap] == [pending]
+    database.shutdown()
+
+    # Temporary bans are picked up again on startup
+    assert list(Database().unban_dates) == [pending]
+
+
+def test_unban_scheduler_wakes_up_for_new_bans(tmp_path, monkeypatch):
+    monkeypatch.setattr(database_module, "DB_FILE", str(tmp_path / "db.sqlite3"))
+    database = Database()
+    mod = MagicMock(ipid=database.ipid("203.0.113.1"))
+    ipid = database.ipid("203.0.113.5")
+
+    async def run():
+        scheduler = asyncio.ensure_future(database.unban_scheduler())
+        await asyncio.sleep(0.01)
+        ban_id = database.ban(ipid, "spam", banned_by=mod, unban_date=arrow.get().shift(seconds=0.05).datetime)
+        assert database.find_connection_ban(ipid, None) is not None
+        await asyncio.sleep(0.2)
+        scheduler.cancel()
+        return ban_id
+
+    ban_id = asyncio.run(run())
+    assert database.find_ban(ban_id=ban_id) is None
+    assert database.find_connection_ban(ipid, None) is None
+    database.shutdown()
@@ -0,0 +1,97 @@
+import asyncio
+import os
+from unittest.mock import MagicMock, patch
+
+from server import emotes
+from server.czar import CzarServer
+from server.emotes import EmoteCache, Emotes
+
+CHAR_INI = """[Options]
+name = Phoenix
+
+[Emotions]
+number = 2
+1 = Normal#-#normal#0#
+2 = Point#pointing#point#1#
+"""
+
+
+def _write_character(tmp_path, name="Phoenix", ini=CHAR_INI):
+    folder = tmp_path / "characters" / name
+    folder.mkdir(parents=True, exist_ok=True)
+    (folder / "char.ini").write_text(ini)
+    return str(folder / "char.ini")
+
+
+def test_emotes_load_on_first_use(tmp_path, monkeypatch):
+    _write_character(tmp_path)
+    monkeypatch.setattr(emotes, "char_dir", str(tmp_path / "characters"))
+    with patch("server.emotes.read_char_ini", wraps=emotes.read_char_ini) as read:
+        phoenix = Emotes("Phoenix")
+        assert read.call_count == 0
+        assert phoenix.validate("pointing", "point", "")
+        assert not phoenix.validate("", "thinking", "")
+        assert read.call_count == 1
+    assert Emotes("Edgeworth").validate("", "anything", "")
+
+
+def test_cache_parses_each_version_once(tmp_path):
+    char_path = _write_character(tmp_path)
+    cache = EmoteCache(str(tmp_path / "emotes.json"))
+    with patch("server.emotes.read_char_ini", wraps=emotes.read_char_ini) as read:
+        expected = cache.get(char_path)
+        assert cache.get(char_path) is expected
+        assert read.call_count == 1
+
+        # Another server process starting with the saved cache doesn't parse it either
+        cache.save()
+        restarted = EmoteCache(str(tmp_path / "emotes.json"))
+        restarted.load()
+        assert restarted.get(char_path) == expected
+        assert read.call_count == 1
+
+        _write_character(tmp_path, ini=CHAR_INI.replace("number = 2", "number = 1"))
+        stat = os.stat(char_path)
+        os.utime(char_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        assert restarted.get(char_path) == {("-", "normal", "")}
+        assert read.call_count == 2
+
+
+def test_cache_ignores_broken_file(tmp_path):
+    (tmp_path / "emotes.json").write_text("{not json")
+    cache = EmoteCache(str(tmp_path / "emotes.json"))
+    cache.load()
+    assert cache.entries == {}
+
+
+def test_warm_loads_every_character(tmp_path, monkeypatch):
+    _write_character(tmp_path, "Phoenix")
+    _write_character(tmp_path, "Maya")
+    monkeypatch.setattr(emotes, "char_dir", str(tmp_path / "characters"))
+    cache = EmoteCache(str(tmp_path / "emotes.json"))
+    characters = [Emotes(name, cache) for name in ("Phoenix", "Maya", "Missingno")]
+    cache.warm(characters)
+    assert all(character._emotes is not None for character in characters)
+    assert cache.parsed == 2
+    assert os.path.isfile(tmp_path / "emotes.json")
+
+
+def test_failed_warm_is_logged(caplog):
+    async def _run():
+        server = MagicMock(emote_warmers=set(), char_emotes={})
+        server.emote_cache.warm.side_effect = OSError("disk on fire")
+        server.emotes_warmed = lambda task: CzarServer.emotes_warmed(server, task)
+        CzarServer.warm_emotes(server)
+        (task,) = server.emote_warmers
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert server.emote_warmers == set()
+
+    asyncio.run(_run())
+    assert "Couldn't load character emotes" in caplog.text
+    assert "disk on fire" in caplog.text
+
+
+def test_malformed_line_keeps_emotes_read_before_it(tmp_path):
+    char_path = _write_character(tmp_path, ini=CHAR_INI.replace("number = 2", "number = 3") + "3 = Broken\n")
+    assert emotes.read_char_ini(char_path) == {("-", "normal", ""), ("pointing", "point", "")}
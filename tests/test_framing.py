@@ -0,0 +1,96 @@
+"""Tests for the incremental packet framer."""
+
+from server.network.framing import PacketFramer
+
+
+def _frames(framer, data):
+    return [bytes(frame) for frame in framer.feed(data)]
+
+
+def _legacy_split(buffer, data):
+    """The string based splitting that AOProtocol used before the framer, kept for comparison."""
+    buffer = buffer + data.decode("utf-8", "ignore")
+    buffer = buffer.translate({ord(c): None for c in "\0"})
+    messages = []
+    while "#%" in buffer:
+        spl = buffer.split("#%", 1)
+        buffer = spl[1]
+        messages.append(spl[0])
+    return buffer, messages
+
+
+def test_feed_yields_complete_frames():
+    framer = PacketFramer(1024)
+    assert _frames(framer, b"HI#hdid#%ID#0#czar#%") == [b"HI#hdid", b"ID#0#czar"]
+    assert framer.buffer == b""
+
+
+def test_feed_keeps_partial_frame():
+    framer = PacketFramer(1024)
+    assert _frames(framer, b"CT#name#hel") == []
+    assert _frames(framer, b"lo#%CH#") == [b"CT#name#hello"]
+    assert framer.buffer == b"CH#"
+
+
+def test_feed_terminator_split_across_reads():
+    framer = PacketFramer(1024)
+    assert _frames(framer, b"CH#0#") == []
+    assert _frames(framer, b"%") == [b"CH#0"]
+    assert _frames(framer, b"CH#1") == []
+    assert _frames(framer, b"#") == []
+    assert _frames(framer, b"%") == [b"CH#1"]
+
+
+def test_feed_strips_null_bytes():
+    framer = PacketFramer(1024)
+    assert _frames(framer, b"C\0H#0\0#\0%") == [b"CH#0"]
+
+
+def test_feed_drops_oversized_frame():
+    framer = PacketFramer(16)
+    assert _frames(framer, b"CT#" + b"a" * 32 + b"#%CH#0#%") == [b"CH#0"]
+    assert framer.dropped == 1
+
+
+def test_feed_discards_oversized_partial_frame():
+    framer = PacketFramer(16)
+    assert _frames(framer, b"CT#" + b"a" * 32) == []
+    assert framer.dropped == 1
+    assert framer.buffer == b""
+    # The rest of the oversized frame is thrown away, the next one goes through
+    assert _frames(framer, b"aaaa#%CH#0#%") == [b"CH#0"]
+    assert framer.dropped == 1
+
+
+def test_feed_consumes_frame_on_error():
+    framer = PacketFramer(1024)
+    try:
+        for frame in framer.feed(b"MS#bad#%CH#0#%"):
+            raise ValueError(bytes(frame))
+    except ValueError:
+        pass
+    assert _frames(framer, b"") == [b"CH#0"]
+
+
+def test_feed_matches_legacy_split():
+    chunks = [b"HI#abc#%ID#0#cz", b"ar#1.0#%", b"CT#n#h\xc3\xa9", b"llo#%MS#", b"1#2#%CH", b"#0#", b"%"]
+    framer = PacketFramer(1024)
+    buffer = ""
+    for chunk in chunks:
+        buffer, expected = _legacy_split(buffer, chunk)
+        assert [str(frame, "utf-8", "ignore") for frame in framer.feed(chunk)] == expected
+
+
+def test_feed_decodes_character_split_across_reads():
+    framer = PacketFramer(1024)
+    assert _frames(framer, b"CT#n#h\xc3") == []
+    frames = [str(frame, "utf-8", "ignore") for frame in framer.feed(b"\xa9llo#%")]
+    assert frames == ["CT#n#h\u00e9llo"]
+
+
+def test_large_read_matches_legacy_split():
+    """A large read full of small packets, as sent when a client floods or reconnects (timed in scripts/benchmark.py)."""
+    data = b"CT#Phoenix#Objection!#0#%" * 2000
+    _, expected = _legacy_split("", data)
+    framer = PacketFramer(1024)
+    assert [str(frame, "utf-8", "ignore") for frame in framer.feed(data)] == expected
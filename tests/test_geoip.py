@@ -0,0 +1,140 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import geoip2.errors
+
+from server.czar import CzarServer
+from server.geoip import ASNResolver
+from server.network.aoprotocol import AOProtocol
+
+
+def _make_reader():
+    """A GeoIP reader where 10.x.x.x addresses belong to AS 64500 and everything else is unknown."""
+
+    def asn(ip):
+        if not ip.startswith("10."):
+            raise geoip2.errors.AddressNotFoundError(ip)
+        return MagicMock(autonomous_system_number=64500)
+
+    reader = MagicMock()
+    reader.asn.side_effect = asn
+    return reader
+
+
+def test_resolve_caches_lookups():
+    resolver = ASNResolver(_make_reader())
+
+    async def resolve():
+        return [await resolver.resolve(ip) for ip in ("10.0.0.1", "10.0.0.1", "192.0.2.1")]
+
+    assert asyncio.run(resolve()) == ["64500", "64500", "Loopback"]
+    assert resolver.reader.asn.call_count == 2
+    assert (resolver.hits, resolver.misses) == (1, 2)
+    assert resolver.get("10.0.0.1") == "64500"
+
+
+def test_simultaneous_lookups_share_one_read():
+    resolver = ASNResolver(_make_reader())
+
+    async def resolve():
+        return await asyncio.gather(*[resolver.resolve("10.0.0.1") for _ in range(5)])
+
+    assert asyncio.run(resolve()) == ["64500"] * 5
+    assert resolver.reader.asn.call_count == 1
+    assert resolver.pending == {}
+
+
+def test_cache_expires_and_evicts():
+    resolver = ASNResolver(_make_reader(), max_size=2, ttl=0)
+    resolver.put("10.0.0.1", "64500")
+    assert resolver.get("10.0.0.1") is None
+    assert resolver.cache == {}
+
+    resolver.ttl = 3600
+    for ip in ("10.0.0.1", "10.0.0.2", "10.0.0.3"):
+        resolver.put(ip, "64500")
+    assert list(resolver.cache) == ["10.0.0.2", "10.0.0.3"]
+    # Reading an entry makes it the most recently used
+    resolver.get("10.0.0.2")
+    resolver.put("10.0.0.4", "64500")
+    assert list(resolver.cache) == ["10.0.0.2", "10.0.0.4"]
+
+
+def test_handshake_waits_for_asn_check():
+    async def _run():
+        protocol = AOProtocol(MagicMock())
+        protocol.client = MagicMock(hdid="", asn_check=asyncio.get_running_loop().create_future())
+        protocol.client.transport.is_closing.return_value = False
+        with patch("server.network.aoprotocol.database") as database:
+            protocol.net_cmd_hi(["hdid"])
+            database.add_hdid.assert_not_called()
+            protocol.client.asn_check.set_result(None)
+            await asyncio.sleep(0)
+            database.add_hdid.assert_called_once_with(protocol.client.ipid, "hdid")
+
+    asyncio.run(_run())
+
+
+def test_handshake_dropped_if_banned_while_waiting():
+    async def _run():
+        protocol = AOProtocol(MagicMock())
+        protocol.client = MagicMock(hdid="", asn_check=asyncio.get_running_loop().create_future())
+        with patch("server.network.aoprotocol.database") as database:
+            protocol.net_cmd_hi(["hdid"])
+            protocol.client.transport.is_closing.return_value = True
+            protocol.client.asn_check.set_result(None)
+            await asyncio.sleep(0)
+            database.add_hdid.assert_not_called()
+
+    asyncio.run(_run())
+
+
+def _make_server(ban_asn=None):
+    server = MagicMock(useGeoIp=True)
+    server.asn_resolver = ASNResolver(_make_reader())
+    server.ipRange_bans.match.return_value = None
+    server.ipRange_bans.match_asn.side_effect = lambda asn: 1 if asn == ban_asn else None
+    server.check_asn_ban = lambda client, peername: CzarServer.check_asn_ban(server, client, peername)
+    return server
+
+
+def _connect(server, ip):
+    transport = MagicMock()
+    transport.get_extra_info.return_value = (ip, 27016)
+    transport.is_closing.return_value = False
+    server.client_manager.new_client.return_value = MagicMock(transport=transport, asn_check=None)
+    return CzarServer.new_client(server, transport)
+
+
+def test_client_joins_area_once_asn_is_cleared():
+    async def _run():
+        server = _make_server()
+        client = _connect(server, "10.0.0.1")
+        client.area.new_client.assert_not_called()
+        await client.asn_check
+        client.area.new_client.assert_called_once_with(client)
+
+    asyncio.run(_run())
+
+
+def test_client_from_banned_asn_never_joins_area():
+    async def _run():
+        server = _make_server(ban_asn="64500")
+        client = _connect(server, "10.0.0.1")
+        await client.asn_check
+        client.disconnect.assert_called_once()
+        client.area.new_client.assert_not_called()
+
+    asyncio.run(_run())
+
+
+def test_failed_asn_lookup_lets_client_in():
+    async def _run():
+        server = _make_server(ban_asn="64500")
+        server.asn_resolver.reader.asn.side_effect = OSError("broken database")
+        client = _connect(server, "10.0.0.1")
+        await client.asn_check
+        client.disconnect.assert_not_called()
+        client.area.new_client.assert_called_once_with(client)
+
+    asyncio.run(_run())
@@ -0,0 +1,77 @@
+import random
+
+from server.ipranges import IPRangeBans
+
+
+def _legacy_match(lines, peername, asn):
+    """The string prefix matching CzarServer.new_client used before IPRangeBans, kept for comparison."""
+    for line, rangeBan in enumerate(lines):
+        if rangeBan != "" and (
+            (peername.startswith(rangeBan) and (rangeBan.endswith(".") or rangeBan.endswith(":"))) or asn == rangeBan
+        ):
+            return line
+    return None
+
+
+def _sample_lines():
+    with open("config_sample/iprange_ban.txt", "r", encoding="utf-8") as ipranges:
+        return ipranges.read().splitlines()
+
+
+def test_legacy_prefixes_and_asns():
+    bans = IPRangeBans(["# comment", "", "10.1.", "2001:db8:", "13335", "192.168."])
+    assert bans.match("10.1.200.3") == 2
+    assert bans.match("10.10.0.1") is None
+    assert bans.match("2001:db8::1") == 3
+    assert bans.match("2001:db9::1") is None
+    assert bans.match("8.8.8.8", "13335") == 4
+    assert bans.match("8.8.8.8", "15169") is None
+    assert bans.match("192.168.0.1", "13335") == 4
+
+
+def test_double_colon_prefix():
+    bans = IPRangeBans(["2001:db8::", "::"])
+    assert bans.match("2001:db8::1") == 0
+    assert bans.match("2001:db8::") == 0
+    assert bans.match("2001:db8:1::1") == 0
+    assert bans.match("2001:db9::1") is None
+    # A bare :: would ban everyone, it's skipped
+    assert bans.ranges == 1
+
+
+def test_cidr_and_single_addresses():
+    bans = IPRangeBans(["10.0.0.0/12", "2001:db8:abcd::/48", "203.0.113.7"])
+    assert bans.match("10.15.255.255") == 0
+    assert bans.match("10.16.0.0") is None
+    assert bans.match("2001:db8:abcd:1::1") == 1
+    assert bans.match("2001:db8:abce::1") is None
+    assert bans.match("203.0.113.7") == 2
+    assert bans.match("203.0.113.8") is None
+    # IPv4 clients on a dual stack socket
+    assert bans.match("::ffff:10.1.2.3") == 0
+
+
+def test_first_matching_line_wins():
+    bans = IPRangeBans(["10.1.2.", "10.", "10.1."])
+    assert bans.match("10.1.2.3") == 0
+    assert bans.match("10.1.3.3") == 1
+
+
+def test_invalid_entries_are_skipped():
+    bans = IPRangeBans(["104.244.7", "not an ip", "1.2.3.4.5.", "10."])
+    assert bans.ranges == 1
+    assert bans.match("104.244.7.1") is None
+    assert bans.match("10.0.0.1") == 3
+    assert bans.match("garbage") is None
+
+
+def test_matches_legacy_on_sample_list():
+    lines = _sample_lines()
+    bans = IPRangeBans(lines)
+    rng = random.Random(0)
+    addresses = [f"{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}.1" for _ in range(500)]
+    addresses += ["23.129.64.10", "45.154.35.200", "104.244.72.1", "127.0.0.1"]
+    asns = ["Loopback", "16276", "15169"]
+    for address in addresses:
+        for asn in asns:
+            assert bans.match(address, asn) == _legacy_match(lines, address, asn)
@@ -1,6 +1,6 @@
 """Tests for the MS (IC message) parser."""
 
-from server.network.ms_parser import parse_ms
+from server.network.ms_parser import _DEFAULTS, _SCHEMAS, ArgType, ICMessage, parse_ms
 
 
 # Base 15 fields used by all protocols
@@ -30,15 +30,15 @@ def test_parse_pre26():
     ms = parse_ms(args)
 
     assert ms is not None
-    assert ms["msg_type"] == "1"
-    assert ms["text"] == "Hello"
-    assert ms["emote_mod"] == 1
-    assert ms["cid"] == 5
+    assert ms.msg_type == "1"
+    assert ms.text == "Hello"
+    assert ms.emote_mod == 1
+    assert ms.cid == 5
     # Check defaults are applied
-    assert ms["showname"] == ""
-    assert ms["charid_pair"] == -1
-    assert ms["pair_order"] == 0
-    assert ms["video"] == ""
+    assert ms.showname == ""
+    assert ms.charid_pair == -1
+    assert ms.pair_order == 0
+    assert ms.video == ""
 
 
 def test_parse_v26():
@@ -52,13 +52,13 @@ def test_parse_v26():
     ms = parse_ms(args)
 
     assert ms is not None
-    assert ms["showname"] == "TestName"
-    assert ms["charid_pair"] == 3
-    assert ms["offset_pair"] == 10
-    assert ms["nonint_pre"] == 1
+    assert ms.showname == "TestName"
+    assert ms.charid_pair == 3
+    assert ms.offset_pair == 10
+    assert ms.nonint_pre == 1
     # Check defaults for 2.8+ fields
-    assert ms["sfx_looping"] == "0"
-    assert ms["effect"] == ""
+    assert ms.sfx_looping == "0"
+    assert ms.effect == ""
 
 
 def test_parse_v28():
@@ -79,17 +79,17 @@ def test_parse_v28():
     ms = parse_ms(args)
 
     assert ms is not None
-    assert ms["showname"] == "ShowName"
-    assert ms["charid_pair"] == 7
-    assert ms["pair_order"] == "1"
-    assert ms["offset_pair"] == "15"
-    assert ms["sfx_looping"] == "1"
-    assert ms["screenshake"] == 1
-    assert ms["frames_shake"] == "1-5"
-    assert ms["effect"] == "effect1"
+    assert ms.showname == "ShowName"
+    assert ms.charid_pair == 7
+    assert ms.pair_order == "1"
+    assert ms.offset_pair == "15"
+    assert ms.sfx_looping == "1"
+    assert ms.screenshake == 1
+    assert ms.frames_shake == "1-5"
+    assert ms.effect == "effect1"
     # Check defaults
-    assert ms["third_charid"] == -1
-    assert ms["video"] == ""
+    assert ms.third_charid == -1
+    assert ms.video == ""
 
 
 def test_parse_v28_no_pair_order():
@@ -110,8 +110,8 @@ def test_parse_v28_no_pair_order():
     ms = parse_ms(args)
 
     assert ms is not None
-    assert ms["charid_pair"] == 5
-    assert ms["pair_order"] == 0  # default
+    assert ms.charid_pair == 5
+    assert ms.pair_order == 0  # default
 
 
 def test_parse_ao_golden():
@@ -133,10 +133,10 @@ def test_parse_ao_golden():
     ms = parse_ms(args)
 
     assert ms is not None
-    assert ms["charid_pair"] == 2
-    assert ms["pair_order"] == "0"
-    assert ms["third_charid"] == 8
-    assert ms["video"] == ""  # default
+    assert ms.charid_pair == 2
+    assert ms.pair_order == "0"
+    assert ms.third_charid == 8
+    assert ms.video == ""  # default
 
 
 def test_parse_kfo():
@@ -159,12 +159,12 @@ def test_parse_kfo():
     ms = parse_ms(args)
 
     assert ms is not None
-    assert ms["showname"] == "KFOName"
-    assert ms["charid_pair"] == 4
-    assert ms["pair_order"] == "2"
-    assert ms["third_charid"] == 9
-    assert ms["video"] == "video.webm"
-    assert ms["effect"] == "zoom"
+    assert ms.showname == "KFOName"
+    assert ms.charid_pair == 4
+    assert ms.pair_order == "2"
+    assert ms.third_charid == 9
+    assert ms.video == "video.webm"
+    assert ms.effect == "zoom"
 
 
 def test_parse_dro():
@@ -177,11 +177,11 @@ def test_parse_dro():
     ms = parse_ms(args)
 
     assert ms is not None
-    assert ms["showname"] == "DROName"
-    assert ms["video"] == "vid.webm"
+    assert ms.showname == "DROName"
+    assert ms.video == "vid.webm"
     # DRO uses defaults for pair fields
-    assert ms["charid_pair"] == -1
-    assert ms["pair_order"] == 0
+    assert ms.charid_pair == -1
+    assert ms.pair_order == 0
 
 
 def test_parse_dro_ding_normalization():
@@ -192,12 +192,12 @@ def test_parse_dro_ding_normalization():
     ms = parse_ms(args)
 
     assert ms is not None
-    assert ms["ding"] == 0  # normalized
+    assert ms.ding == 0  # normalized
 
     # Test ding=1 is preserved
     args[13] = "1"
     ms = parse_ms(args)
-    assert ms["ding"] == 1
+    assert ms.ding == 1
 
 
 def test_parse_invalid_returns_none():
@@ -243,6 +243,69 @@ def test_parse_empty_optional_strings():
     ms = parse_ms(args)
 
     assert ms is not None
-    assert ms["pre"] == ""
-    assert ms["anim"] == ""
-    assert ms["text"] == ""
+    assert ms.pre == ""
+    assert ms.anim == ""
+    assert ms.text == ""
+
+
+def test_parse_does_not_modify_args():
+    """Test that INT conversion doesn't write back into the packet arguments."""
+    args = _base_args()
+    parse_ms(args)
+    assert args == _base_args()
+
+
+def _legacy_parse_ms(args):
+    """The schema-by-schema parser parse_ms replaced, kept for comparison."""
+    for schema_name, fields, needs_pair_parsing in _SCHEMAS:
+        if len(args) != len(fields):
+            continue
+        values = list(args)
+        valid = True
+        for i, (name, typ) in enumerate(fields):
+            if len(str(values[i])) == 0 and typ != ArgType.STR_OR_EMPTY:
+                valid = False
+                break
+            if typ == ArgType.INT:
+                try:
+                    values[i] = int(values[i])
+                except ValueError:
+                    valid = False
+                    break
+        if not valid:
+            continue
+        ms = {f[0]: values[i] for i, f in enumerate(fields)}
+        for key, default in _DEFAULTS.items():
+            ms.setdefault(key, default)
+        if schema_name == "dro" and ms["ding"] != 1:
+            ms["ding"] = 0
+        if needs_pair_parsing:
+            try:
+                pair_args = ms["charid_pair"].split("^")
+                ms["charid_pair"] = int(pair_args[0])
+                if len(pair_args) > 1:
+                    ms["pair_order"] = pair_args[1]
+            except ValueError:
+                return None
+        return ms
+    return None
+
+
+def _all_protocol_args():
+    v28 = ["Name", "2^1", "5", "0", "1", "1", "1-5", "", "", "1", "zoom"]
+    return [
+        _base_args(),
+        _base_args() + ["Name", "3", "10", "1"],
+        _base_args() + ["Name", "vid.webm", "0"],
+        _base_args() + v28,
+        _base_args() + v28 + ["8"],
+        _base_args() + v28 + ["8", "video.webm"],
+    ]
+
+
+def test_parse_matches_legacy_parser():
+    """Test every protocol layout parses to the same fields as before."""
+    for args in _all_protocol_args():
+        expected = _legacy_parse_ms(args)
+        ms = parse_ms(args)
+        assert {name: getattr(ms, name) for name in ICMessage.__slots__} == expected
@@ -0,0 +1,233 @@
+import asyncio
+import os
+import random
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+import yaml
+
+from server.exceptions import ServerError
+from server.music import (
+    MusicIndex,
+    MusicListCache,
+    MusicViews,
+    find_track,
+    is_category,
+    music_list_names,
+    music_versions,
+    pick_from_pools,
+    pick_vote,
+)
+
+
+def _legacy_get_song_data(music_list, music):
+    """The linear scan CzarServer.get_song_data did before MusicIndex, kept for comparison."""
+    for item in music_list:
+        if "category" not in item:
+            continue
+        if item["category"] == music:
+            return item["category"], 0
+        for song in item["songs"]:
+            if song["name"] == music:
+                length = -1
+                if "length" in song:
+                    length = song["length"]
+                if "path" in song:
+                    return song["path"], length
+                return song["name"], length
+    raise ServerError("Music not found.")
+
+
+def _sample_list():
+    with open("config_sample/music.yaml", "r", encoding="utf-8") as music:
+        return yaml.safe_load(music)
+
+
+def _generated_list(categories=50, songs=100):
+    return [
+        {
+            "category": f"=={c}==",
+            "songs": [{"name": f"{c}/track {s}.opus", "length": s} for s in range(songs)],
+        }
+        for c in range(categories)
+    ]
+
+
+def test_matches_legacy_lookup():
+    music_list = [{"use_unique_folder": False}] + _sample_list()
+    music_list.append(
+        {
+            "category": "==Streams==",
+            "songs": [
+                {"name": "radio", "path": "https://example.com/radio.mp3"},
+                {"name": "Logic and Trick.opus", "length": 90},
+            ],
+        }
+    )
+    index = MusicIndex(music_list)
+    names = [item["category"] for item in music_list[1:]]
+    names += [song["name"] for item in music_list[1:] for song in item["songs"]]
+    for name in names:
+        assert find_track([index], name) == _legacy_get_song_data(music_list, name)
+    with pytest.raises(ServerError):
+        find_track([index], "missing.opus")
+
+
+def test_layers_are_searched_in_order():
+    server = MusicIndex(_sample_list())
+    hub = MusicIndex([{"category": "==Hub==", "songs": [{"name": "Logic and Trick.opus", "length": 60}]}])
+    assert find_track([server, hub], "Logic and Trick.opus") == ("Logic and Trick.opus", -1)
+    assert find_track([hub, server], "Logic and Trick.opus") == ("Logic and Trick.opus", 60)
+    assert is_category([server, hub], "==Hub==")
+    assert not is_category([server], "==Hub==")
+
+
+def test_playlists_with():
+    music_list = [
+        {"category": "==A==", "songs": [{"name": "one"}, {"name": "two"}, {"name": "one"}]},
+        {"category": "==B==", "songs": [{"name": "one"}]},
+        {"category": "==Empty=="},
+    ]
+    index = MusicIndex(music_list)
+    assert index.playlists_with("one") == [music_list[0]["songs"], music_list[1]["songs"]]
+    assert index.playlists_with("two") == [music_list[0]["songs"]]
+    assert index.playlists_with("missing") == []
+    assert len(index.playlists_with("")) == 3
+
+
+def _source(music_list):
+    return SimpleNamespace(
+        music_list=music_list, music_index=MusicIndex(music_list), music_version=next(music_versions)
+    )
+
+
+def test_views_are_shared_per_version():
+    server = _source(_sample_list())
+    hub = _source([{"category": "==Hub==", "songs": [{"name": "hub.opus"}]}])
+    views = MusicViews()
+    view = views.get([server, hub])
+    assert views.get([server, hub]) is view
+    assert view.music_list == server.music_list + hub.music_list
+    assert view.names == music_list_names(view.music_list)
+    assert view.packet.startswith(b"FM#") and view.packet.endswith(b"#hub.opus#%")
+    assert views.get([server]) is not view
+
+    # A new version of any layer is a different view
+    hub.music_version = next(music_versions)
+    assert views.get([server, hub]) is not view
+
+
+def test_views_keep_the_most_recently_used():
+    views = MusicViews(max_size=2)
+    a, b, c = _source([]), _source([]), _source([])
+    first = views.get([a])
+    views.get([b])
+    assert views.get([a]) is first
+    views.get([c])
+    assert views.get([a]) is first
+    assert len(views.views) == 2
+
+
+def test_music_list_cache_parses_each_version_once(tmp_path):
+    path = tmp_path / "courtroom.yaml"
+    path.write_text("- use_unique_folder: true\n- category: ==Court==\n  songs:\n  - name: trial.opus\n")
+    cache = MusicListCache()
+    music_list, index = cache.load(str(path))
+    assert music_list[1]["songs"][0]["name"] == "courtroom/trial.opus"
+    assert find_track([index], "courtroom/trial.opus") == ("courtroom/trial.opus", -1)
+    # Loading it again hands out the same list, without prefixing the names twice
+    assert cache.load(str(path)) == (music_list, index)
+    assert cache.load(str(path))[0] is music_list
+    assert music_list[1]["songs"][0]["name"] == "courtroom/trial.opus"
+
+    path.write_text("- category: ==Court==\n  songs:\n  - name: verdict.opus\n")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    reloaded, _ = cache.load(str(path))
+    assert reloaded is not music_list
+    assert music_list_names(reloaded) == ["==Court==", "verdict.opus"]
+
+
+def test_music_list_cache_preload(tmp_path):
+    (tmp_path / "read_only").mkdir()
+    (tmp_path / "a.yaml").write_text("- category: ==A==\n  songs: []\n")
+    (tmp_path / "read_only" / "b.yaml").write_text("- category: ==B==\n  songs: []\n")
+    (tmp_path / "broken.yaml").write_text("- [")
+    cache = MusicListCache()
+    cache.preload(str(tmp_path))
+    assert len(cache.lists) == 2
+    assert cache.load(f"{tmp_path}/read_only/b.yaml")[0] is cache.lists[str(tmp_path / "read_only" / "b.yaml")][1]
+
+
+def test_music_list_cache_refreshes_off_the_loop(tmp_path):
+    path = tmp_path / "courtroom.yaml"
+    path.write_text("- category: ==Court==\n  songs:\n  - name: trial.opus\n")
+    cache = MusicListCache()
+    music_list, _ = cache.load(str(path))
+
+    async def _run():
+        path.write_text("- category: ==Court==\n  songs:\n  - name: verdict.opus\n")
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        with patch("server.music.os.stat", side_effect=AssertionError("stat on the loop")):
+            assert cache.isfile(str(path))
+            # The cached list is handed out right away, the file is checked on a thread
+            assert cache.load(str(path))[0] is music_list
+        await cache.refreshing[str(path)]
+        await asyncio.sleep(0)
+        assert music_list_names(cache.load(str(path))[0]) == ["==Court==", "verdict.opus"]
+        await cache.refreshing[str(path)]
+
+        path.unlink()
+        cache.load(str(path))
+        await asyncio.gather(cache.refreshing[str(path)], return_exceptions=True)
+        await asyncio.sleep(0)
+        assert not cache.isfile(str(path))
+
+    asyncio.run(_run())
+
+
+def test_jukebox_pool_matches_legacy_filter():
+    music_list = [
+        {
+            "category": "==A==",
+            "songs": [{"name": "one", "length": -1}, {"name": "two"}, {"name": "three", "length": 90}],
+        },
+        {"category": "==B==", "songs": [{"name": "one", "length": -1}, {"name": "four", "length": -1}]},
+    ]
+    index = MusicIndex(music_list)
+    for current in ["", "one", "two", "four", "missing"]:
+        legacy = [
+            song
+            for playlist in index.playlists_with(current)
+            for song in playlist
+            if ("length" not in song or song["length"] == -1) and song["name"] != current
+        ]
+        assert list(index.jukebox_pool(current)) == legacy
+    assert index.jukebox_pool("one") is index.jukebox_pool("one")
+
+
+def test_pick_from_pools_is_uniform_over_all_songs():
+    random.seed(0)
+    pools = [("a", "b"), (), ("c",)]
+    picks = [pick_from_pools(pools) for _ in range(3000)]
+    assert {name: picks.count(name) for name in "abc"} == pytest.approx({"a": 1000, "b": 1000, "c": 1000}, rel=0.1)
+    assert pick_from_pools([(), ()]) is None
+
+
+def test_pick_vote_is_weighted_by_chance():
+    random.seed(0)
+    votes = [SimpleNamespace(name=name, chance=chance) for name, chance in (("a", 0), ("b", 3), ("c", 1))]
+    picks = [pick_vote(votes).name for _ in range(4000)]
+    assert picks.count("a") == 0
+    assert picks.count("b") == pytest.approx(3000, rel=0.1)
+    # Nothing left with a chance, any of them will do
+    assert pick_vote([SimpleNamespace(chance=0)]) is not None
+    assert pick_vote([]) is None
+
+
+def test_pick_vote_maps_each_position_to_its_vote():
+    votes = [SimpleNamespace(name=name, chance=chance) for name, chance in (("a", 0), ("b", 3), ("c", 1), ("d", 2))]
+    with patch("server.music.random.randrange", side_effect=range(6)):
+        assert [pick_vote(votes).name for _ in range(6)] == ["b", "b", "b", "c", "d", "d"]
@@ -0,0 +1,72 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from server.network.aoprotocol import AOProtocol
+from server.ratelimit import RateLimiter
+
+_MUSIC = {"times_per_interval": 3, "interval_length": 20, "mute_length": 180}
+
+
+def test_bucket_allows_bursts_then_mutes():
+    limiter = RateLimiter({"music": _MUSIC})
+    assert [limiter.check(1, "music", now=0) for _ in range(3)] == [0, 0, 0]
+    assert limiter.check(1, "music", now=1) == 180
+    # Still muted, asking again doesn't extend it
+    assert limiter.check(1, "music", now=100) == 81
+    assert limiter.check(1, "music", now=181) == 0
+    assert limiter.rejected == 2
+
+
+def test_bucket_refills_over_time():
+    limiter = RateLimiter({b"MS": {"times_per_interval": 2, "interval_length": 10}})
+    assert limiter.check(1, b"MS", now=0) == 0
+    assert limiter.check(1, b"MS", now=0) == 0
+    # One use comes back every 5 seconds
+    assert limiter.check(1, b"MS", now=2) == pytest.approx(3)
+    assert limiter.check(1, b"MS", now=5) == 0
+    assert limiter.check(1, b"MS", now=5) == pytest.approx(5)
+
+
+def test_ipids_and_actions_have_separate_buckets():
+    limiter = RateLimiter({"ooc": {"times_per_interval": 1, "interval_length": 5, "mute_length": 30}})
+    assert limiter.check(1, "ooc", now=0) == 0
+    assert limiter.check(2, "ooc", now=0) == 0
+    assert limiter.check(1, "wtce", now=0) == 0
+    assert limiter.check(1, "ooc", now=0) == 30
+
+
+def test_disabled_limits_and_pruning():
+    limiter = RateLimiter({"wtce": {"times_per_interval": 1, "interval_length": 0, "mute_length": 0}, "music": _MUSIC})
+    assert limiter.limits.keys() == {"music"}
+    assert all(limiter.check(1, "wtce", now=0) == 0 for _ in range(10))
+    limiter.check(1, "music", now=0)
+    limiter.check(2, "music", now=0)
+    limiter.check(2, "music", now=0)
+    limiter.prune(now=7)
+    assert list(limiter.buckets) == [(2, "music")]
+    limiter.prune(now=14)
+    assert limiter.buckets == {}
+
+
+def test_flooded_packets_are_dropped_before_dispatch():
+    server = MagicMock()
+    server.config = {"packet_size": 1024}
+    server.client_manager.rate_limiter = RateLimiter({b"MS": {"times_per_interval": 2, "interval_length": 60}})
+    protocol = AOProtocol(server)
+    protocol.client = MagicMock(ipid=7, is_mod=False)
+    protocol.client.area.owners = set()
+    net_cmd_ms = MagicMock()
+    net_cmd_ct = MagicMock()
+    with patch.dict(AOProtocol.net_cmd_dispatcher, {"MS": net_cmd_ms, "CT": net_cmd_ct}):
+        protocol.data_received(b"MS#1#%MS#2#%MS#3#%CT#name#hi#%MS#4#%")
+    assert [call.args[1] for call in net_cmd_ms.call_args_list] == [["1"], ["2"]]
+    net_cmd_ct.assert_called_once()
+    # Told once that they're flooding, not once per dropped packet
+    protocol.client.send_ooc.assert_called_once()
+
+    # Mods aren't limited
+    protocol.client.is_mod = True
+    with patch.dict(AOProtocol.net_cmd_dispatcher, {"MS": net_cmd_ms}):
+        protocol.data_received(b"MS#5#%")
+    assert net_cmd_ms.call_args_list[-1].args[1] == ["5"]
@@ -0,0 +1,91 @@
+import random
+import re
+
+from server.constants import contains_URL, dezalgo, remove_URL
+from server.sanitize import contains_ic_link, discord_to_ic, ic_to_discord, is_blankpost
+
+# The chains net_cmd_ms and send_discord_chat used before server.sanitize, kept for comparison
+
+
+def _legacy_is_blankpost(text):
+    return text.strip() == "" or (
+        # Originally [{}\\`|(~~)], the duplicate ~ only made Python warn about it
+        len(re.sub(r"[{}\\`|(~)]", "", text).replace(" ", "")) < 3
+        and not text.startswith("<")
+        and not text.startswith(">")
+        and not text.startswith("=")
+    )
+
+
+def _legacy_strip(text):
+    return (
+        text.replace("}", "")
+        .replace("{", "")
+        .replace("`", "")
+        .replace("|", "")
+        .replace("~", "")
+        .replace("º", "")
+        .replace("№", "")
+        .replace("√", "")
+        .replace("\\s", "")
+        .replace("\\f", "")
+    )
+
+
+def _legacy_ic_to_discord(text):
+    txt = _legacy_strip(text)
+    txt = txt.replace("@", "@\u200b")
+    txt = txt.replace("<num>", "\\#")
+    txt = txt.replace("<and>", "&")
+    txt = txt.replace("<percent>", "%")
+    txt = txt.replace("<dollar>", "$")
+    txt = txt.replace("*", "\\*")
+    txt = txt.replace("_", "\\_")
+    if not txt.strip():
+        txt = "_ _"
+    return txt
+
+
+def _legacy_discord_to_ic(text):
+    text = remove_URL(dezalgo(text))
+    return (
+        text.replace("}", "\\}")
+        .replace("{", "\\{")
+        .replace("`", "\\`")
+        .replace("|", "\\|")
+        .replace("~", "\\~")
+        .replace("º", "\\º")
+        .replace("№", "\\№")
+        .replace("√", "\\√")
+        .replace("\\s", "")
+        .replace("\\f", "")
+    )
+
+
+_EXAMPLES = ["", "   ", "hi", "hello", "<3", "~~~", "h|ttp://x", "\\shttp://x", "{}{}ok", "@everyone"]
+
+
+def _random_texts(count=3000):
+    """Short strings made mostly of the characters the sanitizer cares about."""
+    rng = random.Random(0)
+    pieces = list("{}\\`|()~º№√@*_<>= aZ\u0301\u0301s f") + ["http", "://", "<num>", "<and>", "<percent>", "<dollar>"]
+    texts = ["".join(rng.choice(pieces) for _ in range(rng.randint(0, 12))) for _ in range(count)]
+    return texts + _EXAMPLES
+
+
+def test_matches_legacy_chains():
+    for text in _random_texts():
+        assert is_blankpost(text) == _legacy_is_blankpost(text), text
+        assert contains_ic_link(text) == contains_URL(_legacy_strip(text)), text
+        assert ic_to_discord(text) == _legacy_ic_to_discord(text), text
+        assert discord_to_ic(text) == _legacy_discord_to_ic(text), text
+
+
+def test_examples():
+    assert is_blankpost("~~ `|")
+    assert not is_blankpost("<3")
+    assert contains_ic_link("h{t}tp://example.com")
+    assert not contains_ic_link("see http://example.com")
+    assert ic_to_discord("@everyone *waves* <num>1") == "@\u200beveryone \\*waves\\* \\#1"
+    assert ic_to_discord("{}") == "_ _"
+    assert discord_to_ic("look {here} http://example.com") == "look \\{here\\} "